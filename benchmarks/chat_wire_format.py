@@ -0,0 +1,86 @@
+"""聊天消息编码格式的微基准测试
+
+比较 JSON 与二进制格式（chat_wire.bin1）编码/解码一条消息的耗时以及线上字节数。
+"udp" 场景对应频道广播（每条消息单独编码，二进制格式每条都带用户名定义），
+"ws" 场景对应 WebSocket 聊天室（按批合并，用户名在连接上只定义一次）。
+
+用法:
+    python benchmarks/chat_wire_format.py [--messages 20000] [--batch 32] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_wire import ChatDecoder, ChatEncoder, decode_any
+
+USERS = ["alice", "bob", "张三", "李四", "system"]
+TEXTS = ["ok", "明天上午十点开会，记得带电脑", "see you at the standup in five minutes",
+         "文件已经上传到共享目录了，大家可以直接下载"]
+
+
+def sample_messages(count):
+    return [{"username": USERS[i % len(USERS)], "message": TEXTS[i % len(TEXTS)],
+             "id": i + 1, "ts": 1700000000.0 + i} for i in range(count)]
+
+
+def measure(encode, decode, batches):
+    started = time.perf_counter()
+    frames = [encode(batch) for batch in batches]
+    encoded = time.perf_counter()
+    decoded_count = sum(len(decode(frame)) for frame in frames)
+    finished = time.perf_counter()
+    messages = sum(len(batch) for batch in batches)
+    assert decoded_count == messages
+    return {
+        "encode_us": round((encoded - started) / messages * 1e6, 3),
+        "decode_us": round((finished - encoded) / messages * 1e6, 3),
+        "bytes": round(sum(len(frame) for frame in frames) / messages, 1),
+    }
+
+
+def run(messages, batch):
+    single = [[message] for message in messages]
+    grouped = [messages[i:i + batch] for i in range(0, len(messages), batch)]
+
+    def json_ascii(batch):
+        return json.dumps(batch[0]).encode("utf-8")
+
+    def json_utf8(batch):
+        return json.dumps(batch, ensure_ascii=False).encode("utf-8")
+
+    def json_decode(frame):
+        value = json.loads(frame)
+        return value if isinstance(value, list) else [value]
+
+    udp_encoder, udp_decoder = ChatEncoder(always_define=True), ChatDecoder()
+    ws_encoder, ws_decoder = ChatEncoder(), ChatDecoder()
+    return {
+        "udp_json": measure(json_ascii, json_decode, single),
+        "udp_bin1": measure(udp_encoder.encode, lambda f: decode_any(f, udp_decoder)[0], single),
+        "ws_json": measure(json_utf8, json_decode, grouped),
+        "ws_bin1": measure(ws_encoder.encode, lambda f: decode_any(f, ws_decoder)[0], grouped),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000, help="消息条数")
+    parser.add_argument("--batch", type=int, default=32, help="WebSocket 场景每帧合并的消息数")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    args = parser.parse_args()
+
+    results = run(sample_messages(args.messages), args.batch)
+    if args.json:
+        print(json.dumps(results))
+        return
+    print(f"{'格式':<12}{'编码(us/条)':>14}{'解码(us/条)':>14}{'字节/条':>10}")
+    for name, stats in results.items():
+        print(f"{name:<12}{stats['encode_us']:>14}{stats['decode_us']:>14}{stats['bytes']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+"""LANChat 全服务负载测试
+
+在进程内启动 main_app，同时施加以下负载，并按子系统输出吞吐量与 p50/p99/p999 延迟：
+
+- chat:      N 个 WebSocket 聊天客户端（/message/ws），按固定速率发送带时间戳的消息
+- voice:     若干语音房间，每个成员每 20ms 向 /voice/ws/{room_id} 推送一帧合成 PCM
+- upload:    并发分块上传（测量每个分块请求）
+- download:  并发完整下载（测量每次下载）
+- broadcast: 多个 UDP 频道广播器（端口 25896），按固定速率广播
+
+延迟均以发送时刻为准，只统计预热结束后、测量窗口内发出的消息。客户端与服务端
+运行在同一进程中，结果适合用于同一台机器上不同版本之间的对比。
+
+用法:
+    python benchmarks/load_test.py [--seconds 10] [--only chat,voice] [--json] [--output result.json]
+    python benchmarks/load_test.py --compare baseline.json
+    python benchmarks/load_test.py --only voice --voice-rooms 40 --workers 4   # 多进程语音转发
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SUBSYSTEMS = ["chat", "voice", "upload", "download", "broadcast"]
+WARMUP = 1.0
+FILE_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Recorder:
+    """记录测量窗口内发出的请求/消息的延迟与字节数（列表追加在多线程下是安全的）"""
+
+    def __init__(self, start: float, seconds: float):
+        self.start = start
+        self.end = start + seconds
+        self.seconds = seconds
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+
+    def in_window(self, sent_at: float) -> bool:
+        return self.start <= sent_at < self.end
+
+    def record(self, sent_at: float, nbytes: int = 0, now: float = None):
+        if self.in_window(sent_at):
+            self.latencies.append(((now or time.perf_counter()) - sent_at) * 1000)
+            self.bytes += nbytes
+
+    def summary(self) -> dict:
+        result = {
+            "count": len(self.latencies),
+            "throughput_per_s": round(len(self.latencies) / self.seconds, 2),
+            "p50_ms": round(percentile(self.latencies, 50), 3),
+            "p99_ms": round(percentile(self.latencies, 99), 3),
+            "p999_ms": round(percentile(self.latencies, 99.9), 3),
+            "max_ms": round(max(self.latencies, default=0.0), 3),
+            "errors": self.errors,
+        }
+        if self.bytes:
+            result["mb_per_s"] = round(self.bytes / self.seconds / 1024 / 1024, 2)
+        return result
+
+
+def start_server(port, workers=0):
+    import uvicorn
+    import voice_workers
+    from main import main_app
+
+    if workers:
+        voice_workers.start_pool(workers, port)
+    server = uvicorn.Server(uvicorn.Config(main_app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+# ---------- 聊天 ----------
+
+async def chat_load(port, recorder, clients, rate, wire_format):
+    import websockets
+    from chat_wire import WIRE_FORMAT, ChatDecoder, ChatEncoder, decode_any
+
+    uri = f"ws://127.0.0.1:{port}/message/ws"
+    if wire_format == WIRE_FORMAT:
+        uri += f"?format={WIRE_FORMAT}"
+
+    async def client(index):
+        decoder, encoder = ChatDecoder(), ChatEncoder()
+        binary = False
+        async with websockets.connect(uri, max_queue=None) as ws:
+            async def receive():
+                nonlocal binary
+                while True:
+                    messages, is_binary = decode_any(await ws.recv(), decoder)
+                    binary = binary or is_binary
+                    now = time.perf_counter()
+                    for message in messages:
+                        try:
+                            recorder.record(float(message["message"]), now=now)
+                        except (KeyError, ValueError):
+                            pass
+
+            receiver = asyncio.create_task(receive())
+            await asyncio.sleep(random.random() / rate)
+            try:
+                while time.perf_counter() < recorder.end:
+                    message = {"username": f"bench{index}", "message": repr(time.perf_counter())}
+                    await ws.send(encoder.encode([message]) if binary else json.dumps(message))
+                    await asyncio.sleep(1 / rate)
+                await asyncio.sleep(0.5)
+            finally:
+                receiver.cancel()
+
+    await asyncio.gather(*(client(i) for i in range(clients)))
+
+
+# ---------- 语音 ----------
+
+async def voice_load(port, recorder, rooms, peers):
+    import requests
+    import websockets
+    from voice_proto import CHUNK, PT_PCM16, RATE, SAMPLE_WIDTH, pack_frame, unpack_frame
+
+    frame_duration = CHUNK / RATE
+
+    def placed_port(room):
+        # 多进程模式下按分配结果连接房间所在的工作进程
+        placement = requests.get(f"http://127.0.0.1:{port}/workers/placement/bench{room}").json()
+        return placement.get("port") or port
+
+    ports = {room: await asyncio.to_thread(placed_port, room) for room in range(rooms)}
+
+    async def peer(room):
+        uri = f"ws://127.0.0.1:{ports[room]}/voice/ws/bench{room}?codecs=pcm16"
+        ssrc, seq, timestamp = random.getrandbits(32), 0, 0
+        async with websockets.connect(uri, max_queue=None) as ws:
+            async def receive():
+                while True:
+                    data = await ws.recv()
+                    if isinstance(data, str):
+                        continue  # 编解码器协商等控制消息
+                    frame = unpack_frame(data)
+                    if frame is not None and len(frame.payload) >= 8:
+                        recorder.record(struct.unpack_from("!d", frame.payload)[0], len(data))
+
+            receiver = asyncio.create_task(receive())
+            deadline = time.perf_counter() + random.random() * frame_duration
+            try:
+                while time.perf_counter() < recorder.end:
+                    deadline += frame_duration
+                    await asyncio.sleep(max(0.0, deadline - time.perf_counter()))
+                    payload = struct.pack("!d", time.perf_counter()).ljust(CHUNK * SAMPLE_WIDTH, b"\0")
+                    await ws.send(pack_frame(PT_PCM16, seq, timestamp, ssrc, payload))
+                    seq = (seq + 1) & 0xFFFF
+                    timestamp = (timestamp + CHUNK) & 0xFFFFFFFF
+                await asyncio.sleep(0.5)
+            finally:
+                receiver.cancel()
+
+    await asyncio.gather(*(peer(room) for room in range(rooms) for _ in range(peers)))
+
+
+# ---------- 文件传输 ----------
+
+def upload_file(session, base_url, name, payloads, recorder=None):
+    status = session.post(f"{base_url}/upload/init", json={
+        "filename": name,
+        "size": sum(len(p) for p in payloads),
+        "chunk_size": FILE_CHUNK_SIZE,
+        "chunk_hashes": [hashlib.sha256(p).hexdigest() for p in payloads],
+    }).json()
+    for i, payload in enumerate(payloads):
+        sent_at = time.perf_counter()
+        response = session.put(f"{base_url}/upload/{status['upload_id']}/chunks/{i}", data=payload)
+        if recorder is not None:
+            if response.ok:
+                recorder.record(sent_at, len(payload))
+            elif recorder.in_window(sent_at):
+                recorder.errors += 1
+    session.post(f"{base_url}/upload/{status['upload_id']}/commit").raise_for_status()
+
+
+def upload_worker(port, index, size, recorder):
+    """循环分块上传，每轮内容不同，避免命中去重"""
+    import requests
+
+    session = requests.Session()
+    data = os.urandom(FILE_CHUNK_SIZE)
+    chunks = max(1, size // FILE_CHUNK_SIZE)
+    round_no = 0
+    while time.perf_counter() < recorder.end:
+        salt = struct.pack("!II", index, round_no)
+        upload_file(session, f"http://127.0.0.1:{port}/file", f"load_upload_{index}.bin",
+                    [salt + data[8:] for _ in range(chunks)], recorder)
+        round_no += 1
+
+
+def download_worker(port, name, recorder):
+    import requests
+
+    session = requests.Session()
+    url = f"http://127.0.0.1:{port}/file/download/{name}"
+    while time.perf_counter() < recorder.end:
+        sent_at = time.perf_counter()
+        nbytes = 0
+        # 随机数据不可压缩，明确不请求压缩
+        with session.get(url, headers={"Accept-Encoding": "identity"}, stream=True) as response:
+            if not response.ok:
+                recorder.errors += 1
+                continue
+            for block in response.iter_content(1024 * 1024):
+                nbytes += len(block)
+        recorder.record(sent_at, nbytes)
+
+
+# ---------- UDP 频道广播 ----------
+
+def broadcast_worker(broadcaster, rate, recorder, stop):
+    while not stop.is_set() and time.perf_counter() < recorder.end:
+        broadcaster.broadcast({"username": "bench", "message": repr(time.perf_counter())})
+        time.sleep(1 / rate)
+
+
+def start_broadcasters(count, rate, recorder):
+    from msg_server import MessageBroadcaster
+
+    def on_message(message, addr):
+        try:
+            recorder.record(float(message["message"]))
+        except (KeyError, ValueError):
+            pass
+
+    broadcasters = []
+    for _ in range(count):
+        broadcaster = MessageBroadcaster("loadtest", "broadcast")
+        broadcaster.start(on_message)
+        broadcasters.append(broadcaster)
+    stop = threading.Event()
+    threads = [threading.Thread(target=broadcast_worker, args=(b, rate, recorder, stop), daemon=True)
+               for b in broadcasters]
+    return broadcasters, threads, stop
+
+
+# ---------- 汇总 ----------
+
+def run(args) -> dict:
+    import requests
+
+    workdir = tempfile.mkdtemp(prefix="lanchat_load_")
+    os.chdir(workdir)  # 上传目录与聊天记录都放在临时目录中
+    start_server(args.port, args.workers)
+    if args.workers:
+        time.sleep(2)  # 等待工作进程接入总线
+    enabled = set(args.only.split(",")) if args.only else set(SUBSYSTEMS)
+
+    start = time.perf_counter() + WARMUP
+    recorders = {name: Recorder(start, args.seconds) for name in SUBSYSTEMS if name in enabled}
+    threads = []
+    broadcasters = []
+    stop_broadcast = threading.Event()
+
+    if "download" in recorders:
+        # 先上传一个供下载的文件
+        payloads = [os.urandom(FILE_CHUNK_SIZE) for _ in range(max(1, args.file_mb * 1024 * 1024 // FILE_CHUNK_SIZE))]
+        upload_file(requests.Session(), f"http://127.0.0.1:{args.port}/file", "load_download.bin", payloads)
+        threads += [threading.Thread(target=download_worker, args=(args.port, "load_download.bin",
+                                                                   recorders["download"]), daemon=True)
+                    for _ in range(args.downloads)]
+    if "upload" in recorders:
+        threads += [threading.Thread(target=upload_worker, args=(args.port, i, args.file_mb * 1024 * 1024,
+                                                                 recorders["upload"]), daemon=True)
+                    for i in range(args.uploads)]
+    if "broadcast" in recorders:
+        broadcasters, broadcast_threads, stop_broadcast = start_broadcasters(
+            args.broadcasters, args.broadcast_rate, recorders["broadcast"])
+        threads += broadcast_threads
+    for thread in threads:
+        thread.start()
+
+    async def clients():
+        tasks = []
+        if "chat" in recorders:
+            tasks.append(chat_load(args.port, recorders["chat"], args.chat_clients, args.chat_rate,
+                                   args.chat_format))
+        if "voice" in recorders:
+            tasks.append(voice_load(args.port, recorders["voice"], args.voice_rooms, args.voice_peers))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(clients())
+    deadline = start + args.seconds + 5
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.perf_counter()))
+    stop_broadcast.set()
+    time.sleep(0.5)
+    for broadcaster in broadcasters:
+        broadcaster.stop()
+    if args.workers:
+        import voice_workers
+        voice_workers.stop_pool()
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("json", "output", "compare")},
+        },
+        "results": {name: recorder.summary() for name, recorder in recorders.items()},
+    }
+
+
+def _change(current, baseline):
+    if not baseline:
+        return ""
+    return f"{(current - baseline) / baseline * 100:+.1f}%"
+
+
+def print_table(report, baseline=None):
+    base_results = (baseline or {}).get("results", {})
+    header = f"{'子系统':<10}{'数量':>8}{'吞吐/s':>10}{'MB/s':>8}{'p50(ms)':>10}{'p99(ms)':>10}{'p999(ms)':>10}{'错误':>6}"
+    print(header)
+    for name, stats in report["results"].items():
+        print(f"{name:<10}{stats['count']:>8}{stats['throughput_per_s']:>10}{stats.get('mb_per_s', '-'):>8}"
+              f"{stats['p50_ms']:>10}{stats['p99_ms']:>10}{stats['p999_ms']:>10}{stats['errors']:>6}")
+        base = base_results.get(name)
+        if base:
+            print(f"{'  对比':<10}{'':>8}{_change(stats['throughput_per_s'], base['throughput_per_s']):>10}"
+                  f"{_change(stats.get('mb_per_s', 0), base.get('mb_per_s', 0)):>8}"
+                  f"{_change(stats['p50_ms'], base['p50_ms']):>10}{_change(stats['p99_ms'], base['p99_ms']):>10}"
+                  f"{_change(stats['p999_ms'], base['p999_ms']):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=18766)
+    parser.add_argument("--seconds", type=float, default=10.0, help="测量时长")
+    parser.add_argument("--only", help=f"只运行指定子系统，逗号分隔: {','.join(SUBSYSTEMS)}")
+    parser.add_argument("--chat-clients", type=int, default=20)
+    parser.add_argument("--chat-rate", type=float, default=5.0, help="每个聊天客户端每秒发送的消息数")
+    parser.add_argument("--chat-format", default="json", choices=["json", "bin1"])
+    parser.add_argument("--voice-rooms", type=int, default=2)
+    parser.add_argument("--voice-peers", type=int, default=4, help="每个语音房间的成员数")
+    parser.add_argument("--workers", type=int, default=0, help="语音工作进程数（0 为单进程）")
+    parser.add_argument("--uploads", type=int, default=2, help="并发上传数")
+    parser.add_argument("--downloads", type=int, default=2, help="并发下载数")
+    parser.add_argument("--file-mb", type=int, default=16, help="上传/下载的文件大小")
+    parser.add_argument("--broadcasters", type=int, default=3, help="UDP 频道广播器数量")
+    parser.add_argument("--broadcast-rate", type=float, default=20.0, help="每个广播器每秒发送的消息数")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    parser.add_argument("--output", help="把 JSON 结果写入文件")
+    parser.add_argument("--compare", help="与之前保存的 JSON 结果对比")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    report = run(args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+        return
+    print_table(report, baseline)
+
+
+if __name__ == "__main__":
+    main()
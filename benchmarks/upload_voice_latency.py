@@ -0,0 +1,149 @@
+"""上传并发时的语音帧转发延迟基准测试
+
+在进程内启动文件服务与语音中继，先测量空载时的语音帧转发延迟，
+再在多个并发分块上传进行时测量一次，对比事件循环是否被磁盘 I/O 阻塞。
+
+用法:
+    python benchmarks/upload_voice_latency.py [--uploads 4] [--size-mb 64] [--seconds 5] [--json]
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FRAME_INTERVAL = 0.02  # 16kHz 下 320 个采样点
+FRAME_SIZE = 640
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def start_server(port):
+    import uvicorn
+    from fastapi import FastAPI
+    from file_tsf import app as file_app
+    from voice_chat import app as voice_app
+
+    app = FastAPI()
+    app.mount("/file", file_app)
+    app.mount("/voice", voice_app)
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+async def measure_voice(port, seconds):
+    """两个客户端加入同一房间，一个按固定间隔发送带时间戳的帧，另一个记录延迟"""
+    import websockets
+
+    uri = f"ws://127.0.0.1:{port}/voice/ws/bench"
+    latencies = []
+    async with websockets.connect(uri) as sender, websockets.connect(uri) as receiver:
+        await asyncio.sleep(0.2)
+
+        async def receive():
+            while True:
+                data = await receiver.recv()
+                if isinstance(data, str):
+                    continue  # 编解码器协商等控制消息
+                sent_at = struct.unpack("!d", data[:8])[0]
+                latencies.append((time.perf_counter() - sent_at) * 1000)
+
+        recv_task = asyncio.create_task(receive())
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            frame = struct.pack("!d", time.perf_counter()).ljust(FRAME_SIZE, b"\0")
+            await sender.send(frame)
+            await asyncio.sleep(FRAME_INTERVAL)
+        await asyncio.sleep(0.2)
+        recv_task.cancel()
+    return latencies
+
+
+def upload_worker(port, index, size, stop):
+    """循环执行分块上传，直到 stop 被设置"""
+    import requests
+
+    data = os.urandom(CHUNK_SIZE)
+    chunks = max(1, size // CHUNK_SIZE)
+    session = requests.Session()
+    base_url = f"http://127.0.0.1:{port}/file"
+    round_no = 0
+    while not stop.is_set():
+        # 每轮使用不同的分块内容，避免命中去重
+        salt = struct.pack("!II", index, round_no)
+        payloads = [salt + data[8:] for _ in range(chunks)]
+        status = session.post(f"{base_url}/upload/init", json={
+            "filename": f"bench_{index}.bin",
+            "size": chunks * CHUNK_SIZE,
+            "chunk_size": CHUNK_SIZE,
+            "chunk_hashes": [hashlib.sha256(p).hexdigest() for p in payloads],
+        }).json()
+        for i, payload in enumerate(payloads):
+            if stop.is_set():
+                return
+            session.put(f"{base_url}/upload/{status['upload_id']}/chunks/{i}", data=payload)
+        session.post(f"{base_url}/upload/{status['upload_id']}/commit")
+        round_no += 1
+
+
+def summarize(latencies):
+    return {
+        "frames": len(latencies),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "max_ms": round(max(latencies, default=0.0), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=18765)
+    parser.add_argument("--uploads", type=int, default=4, help="并发上传数量")
+    parser.add_argument("--size-mb", type=int, default=64, help="每次上传的文件大小")
+    parser.add_argument("--seconds", type=float, default=5.0, help="每个阶段的测量时长")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="lanchat_bench_"))
+    start_server(args.port)
+
+    results = {"idle": summarize(asyncio.run(measure_voice(args.port, args.seconds)))}
+
+    stop = threading.Event()
+    workers = [
+        threading.Thread(target=upload_worker,
+                         args=(args.port, i, args.size_mb * 1024 * 1024, stop), daemon=True)
+        for i in range(args.uploads)
+    ]
+    for worker in workers:
+        worker.start()
+    time.sleep(0.5)
+    results[f"uploads_x{args.uploads}"] = summarize(asyncio.run(measure_voice(args.port, args.seconds)))
+    stop.set()
+
+    if args.json:
+        print(json.dumps(results))
+        return
+    print(f"{'阶段':<14}{'帧数':>8}{'p50(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}")
+    for phase, stats in results.items():
+        print(f"{phase:<14}{stats['frames']:>8}{stats['p50_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+HASH_READ_SIZE = 1024 * 1024
+
+
+def hash_file(path: str) -> str:
+    """计算整个文件的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_READ_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_valid_hash(digest: str) -> bool:
+    return len(digest) == 64 and all(c in "0123456789abcdef" for c in digest)
+
+
+class BlobStore:
+    """按内容寻址的去重文件存储
+
+    文件内容以 SHA-256 命名保存在 <root>/.blobs/ 下，文件名 -> 哈希的索引与
+    每个 blob 的引用计数保存在 <root>/.index.json。相同内容只保存一份，
+    同名但内容不同的文件会被自动重命名而不是互相覆盖，引用计数归零的 blob
+    由 gc() 回收。
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.blob_dir = os.path.join(root, ".blobs")
+        self.index_path = os.path.join(root, ".index.json")
+        self._lock = threading.RLock()
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self._files: Dict[str, dict] = {}
+        self._refs: Dict[str, int] = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self._files = index.get("files", {})
+        self._refs = index.get("refs", {})
+
+    def _save(self):
+        """原子地写入索引"""
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"files": self._files, "refs": self._refs}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        """是否已保存该内容"""
+        return is_valid_hash(digest) and os.path.exists(self.blob_path(digest))
+
+    def blob_size(self, digest: str) -> int:
+        return os.path.getsize(self.blob_path(digest))
+
+    def _unique_name(self, filename: str, digest: str) -> str:
+        """同名文件内容不同时生成 name (1).ext 形式的新文件名"""
+        entry = self._files.get(filename)
+        if entry is None or entry["hash"] == digest:
+            return filename
+        stem, ext = os.path.splitext(filename)
+        n = 1
+        while True:
+            candidate = f"{stem} ({n}){ext}"
+            entry = self._files.get(candidate)
+            if entry is None or entry["hash"] == digest:
+                return candidate
+            n += 1
+
+    def link(self, filename: str, digest: str) -> Optional[str]:
+        """为已存在的 blob 添加文件名引用，返回最终文件名；blob 不存在时返回 None"""
+        with self._lock:
+            if not self.has(digest):
+                return None
+            name = self._unique_name(filename, digest)
+            if name not in self._files:
+                self._files[name] = {"hash": digest, "size": self.blob_size(digest)}
+                self._refs[digest] = self._refs.get(digest, 0) + 1
+                self._save()
+            return name
+
+    def add_file(self, src_path: str, filename: str, digest: Optional[str] = None) -> str:
+        """将临时文件移入存储（内容已存在时直接丢弃），返回最终文件名"""
+        digest = digest or hash_file(src_path)
+        with self._lock:
+            blob_path = self.blob_path(digest)
+            if os.path.exists(blob_path):
+                os.remove(src_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(src_path, blob_path)
+            return self.link(filename, digest)
+
+    def lookup(self, filename: str) -> Optional[dict]:
+        """返回 {"hash", "size"}，文件不存在时返回 None"""
+        with self._lock:
+            entry = self._files.get(filename)
+            return dict(entry) if entry else None
+
+    def resolve(self, filename: str) -> Optional[str]:
+        """文件名 -> blob 路径"""
+        entry = self.lookup(filename)
+        return self.blob_path(entry["hash"]) if entry else None
+
+    def remove(self, filename: str) -> bool:
+        """删除文件名引用（blob 在 gc 时回收）"""
+        with self._lock:
+            entry = self._files.pop(filename, None)
+            if entry is None:
+                return False
+            digest = entry["hash"]
+            self._refs[digest] = self._refs.get(digest, 1) - 1
+            if self._refs[digest] <= 0:
+                del self._refs[digest]
+            self._save()
+            return True
+
+    def list_files(self) -> List[dict]:
+        with self._lock:
+            return [{"filename": name, **entry} for name, entry in sorted(self._files.items())]
+
+    def gc(self) -> dict:
+        """回收没有任何文件名引用的 blob"""
+        removed = 0
+        freed = 0
+        with self._lock:
+            for sub in os.listdir(self.blob_dir):
+                sub_dir = os.path.join(self.blob_dir, sub)
+                if not os.path.isdir(sub_dir):
+                    continue
+                for digest in os.listdir(sub_dir):
+                    if self._refs.get(digest, 0) > 0:
+                        continue
+                    path = os.path.join(sub_dir, digest)
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                    removed += 1
+        return {"removed": removed, "freed": freed}
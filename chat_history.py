@@ -0,0 +1,185 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+# 数据库路径，可用环境变量 LANCHAT_HISTORY 或 main.py 的 --history 参数指定
+HISTORY_PATH = os.environ.get("LANCHAT_HISTORY", "chat_history.db")
+# 新消息先在内存中累积，由写线程每 FLUSH_INTERVAL 秒或累积 WRITE_BATCH 条后在一个事务中写入
+WRITE_BATCH = 256
+FLUSH_INTERVAL = 0.05
+# 保留的消息条数，超出后删除最旧的消息
+RETAIN_MESSAGES = 1_000_000
+PRUNE_EVERY = 1000
+MAX_PAGE = 200
+# trigram 分词支持中文子串搜索，但查询至少要 3 个字符，更短的查询退回 LIKE
+TRIGRAM_MIN = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    channel TEXT NOT NULL,
+    ts REAL NOT NULL,
+    username TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel, id);
+"""
+
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    username, message, content='messages', content_rowid='id', tokenize='{tokenizer}'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, username, message) VALUES (new.id, new.username, new.message);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, username, message)
+    VALUES ('delete', old.id, old.username, old.message);
+END;
+"""
+
+_COLUMNS = "id, ts, username, message"
+
+
+def _row(row) -> dict:
+    return {"id": row[0], "ts": row[1], "username": row[2], "message": row[3]}
+
+
+class ChatHistory:
+    """持久化的聊天记录（SQLite）
+
+    消息 ID 全局递增并在内存中分配，append() 不访问磁盘；写线程批量写入，
+    WAL 模式下读写互不阻塞。按 (频道, ID) 建索引，翻页和断线重连后的补发
+    都是索引范围查询，不扫描整个日志；全文搜索使用 FTS5（不可用时退回 LIKE）。
+    """
+
+    def __init__(self, path: str = HISTORY_PATH):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self.fts = self._create_fts()
+        self.next_id = (self._conn.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0) + 1
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._last_prune = self.next_id
+        self.running = True
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _create_fts(self) -> Optional[str]:
+        for tokenizer in ("trigram", "unicode61"):
+            try:
+                self._conn.executescript(_FTS_SCHEMA.format(tokenizer=tokenizer))
+                return tokenizer
+            except sqlite3.OperationalError:
+                continue
+        return None
+
+    def append(self, channel: str, message: dict) -> dict:
+        """记录一条消息，返回带 ID 和时间戳的记录"""
+        record = {
+            "username": str(message.get("username", "Unknown")),
+            "message": str(message.get("message", "")),
+            "ts": round(time.time(), 3),
+        }
+        with self._pending_lock:
+            record["id"] = self.next_id
+            self.next_id += 1
+            self._pending.append((record["id"], channel, record["ts"], record["username"], record["message"]))
+            if len(self._pending) >= WRITE_BATCH:
+                self._wakeup.set()
+        return record
+
+    def _flush(self):
+        """把累积的消息写入数据库（调用方持有 _db_lock）"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO messages (id, channel, ts, username, message) VALUES (?, ?, ?, ?, ?)", pending
+            )
+        last_id = pending[-1][0]
+        if last_id - self._last_prune >= PRUNE_EVERY:
+            self._last_prune = last_id
+            with self._conn:
+                self._conn.execute("DELETE FROM messages WHERE id <= ?", (last_id - RETAIN_MESSAGES,))
+
+    def flush(self):
+        with self._db_lock:
+            self._flush()
+
+    def _write_loop(self):
+        while self.running:
+            self._wakeup.wait(FLUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"写入聊天记录失败: {e}")
+
+    def _query(self, sql: str, params) -> List[dict]:
+        with self._db_lock:
+            self._flush()  # 保证刚发送的消息也能查到
+            return [_row(row) for row in self._conn.execute(sql, params)]
+
+    def page(self, channel: str, before: Optional[int] = None, limit: int = 50) -> List[dict]:
+        """ID 小于 before 的最近 limit 条消息（按时间顺序），用于向前翻页"""
+        limit = max(1, min(limit, MAX_PAGE))
+        rows = self._query(
+            f"SELECT {_COLUMNS} FROM messages WHERE channel = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (channel, before if before is not None else self.next_id, limit),
+        )
+        rows.reverse()
+        return rows
+
+    def since(self, channel: str, after_id: int, upto: Optional[int] = None, limit: int = MAX_PAGE) -> List[dict]:
+        """ID 在 (after_id, upto) 之间的消息，超过 limit 条时只返回最新的 limit 条"""
+        rows = self._query(
+            f"SELECT {_COLUMNS} FROM messages WHERE channel = ? AND id > ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (channel, after_id, upto if upto is not None else self.next_id, limit),
+        )
+        rows.reverse()
+        return rows
+
+    def search(self, channel: str, query: str, limit: int = 50) -> List[dict]:
+        """全文搜索用户名和消息内容，按时间从新到旧返回"""
+        limit = max(1, min(limit, MAX_PAGE))
+        query = query.strip()
+        if not query:
+            return []
+        if self.fts and (self.fts != "trigram" or len(query) >= TRIGRAM_MIN):
+            # 整体作为短语匹配，避免用户输入被解析为 FTS 查询语法
+            phrase = '"' + query.replace('"', '""') + '"'
+            return self._query(
+                f"SELECT {_COLUMNS} FROM messages WHERE id IN "
+                "(SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?) "
+                "AND channel = ? ORDER BY id DESC LIMIT ?",
+                (phrase, channel, limit),
+            )
+        pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        return self._query(
+            f"SELECT {_COLUMNS} FROM messages WHERE channel = ? "
+            "AND (message LIKE ? ESCAPE '\\' OR username LIKE ? ESCAPE '\\') ORDER BY id DESC LIMIT ?",
+            (channel, pattern, pattern, limit),
+        )
+
+    def stats(self) -> dict:
+        with self._pending_lock:
+            pending = len(self._pending)
+        return {"next_id": self.next_id, "pending_writes": pending, "fts": self.fts}
+
+    def close(self):
+        self.running = False
+        self._wakeup.set()
+        self._writer.join(timeout=1)
+        with self._db_lock:
+            self._flush()
+            self._conn.close()
@@ -0,0 +1,142 @@
+import json
+import struct
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# 聊天消息的二进制编码（bin1）
+#   帧      MAGIC | VERSION | 记录...
+#   USER    类型 | 用户编号 u16 | 名字长度 u8 | UTF-8 用户名
+#   CHAT    类型 | 消息ID u32 | 时间戳 f64 | 用户编号 u16 | 长度 u32 | UTF-8 消息
+# 首字节 0xC3 不是合法的 JSON 开头（'{' 或 '['），收到的数据可据此区分两种格式。
+# 用户名只在流中第一次出现时以 USER 记录定义，之后的消息只带编号。
+WIRE_FORMAT = "bin1"
+MAGIC = 0xC3
+VERSION = 1
+REC_USER = 1
+REC_CHAT = 2
+
+HEADER = struct.pack("!BB", MAGIC, VERSION)
+_USER = struct.Struct("!BHB")
+_CHAT = struct.Struct("!BIdHI")
+MAX_USERNAME = 255
+MAX_USERS = 0xFFFF
+
+
+def is_binary(data) -> bool:
+    return isinstance(data, (bytes, bytearray, memoryview)) and len(data) >= 2 and data[0] == MAGIC
+
+
+def parse_formats(value: Optional[str]) -> List[str]:
+    if not value:
+        return []
+    return [item.strip().lower() for item in value.split(",") if item.strip()]
+
+
+def _username_bytes(name: str) -> bytes:
+    raw = name.encode("utf-8")
+    if len(raw) > MAX_USERNAME:
+        raw = raw[:MAX_USERNAME].decode("utf-8", "ignore").encode("utf-8")
+    return raw
+
+
+def pack_chat(user: int, message: str, msg_id: int = 0, ts: float = 0.0) -> bytes:
+    text = message.encode("utf-8")
+    return _CHAT.pack(REC_CHAT, msg_id & 0xFFFFFFFF, ts, user, len(text)) + text
+
+
+class UsernameTable:
+    """用户名 -> 编号，多个流可共用一张表（各流自己记录已定义过哪些编号）"""
+
+    def __init__(self):
+        self._index: Dict[str, int] = {}
+        self._defines: List[bytes] = []
+
+    def index(self, name: str) -> int:
+        index = self._index.get(name)
+        if index is None:
+            if len(self._defines) >= MAX_USERS:
+                raise ValueError("用户名表已满")
+            index = self._index[name] = len(self._defines)
+            raw = _username_bytes(name)
+            self._defines.append(_USER.pack(REC_USER, index, len(raw)) + raw)
+        return index
+
+    def define(self, index: int) -> bytes:
+        return self._defines[index]
+
+    def __len__(self):
+        return len(self._defines)
+
+
+class ChatEncoder:
+    """单个有序流的编码器
+
+    always_define=True 用于接收方可能随时加入、看不到流开头的场合（UDP 频道），
+    每帧都带上用到的用户名定义。
+    """
+
+    def __init__(self, always_define: bool = False):
+        self.table = UsernameTable()
+        self.always_define = always_define
+        self._defined = set()
+
+    def encode(self, messages: Iterable[dict]) -> bytes:
+        parts = [HEADER]
+        sent = set()
+        for message in messages:
+            user = self.table.index(str(message.get("username", "Unknown")))
+            if user not in sent and (self.always_define or user not in self._defined):
+                parts.append(self.table.define(user))
+                self._defined.add(user)
+                sent.add(user)
+            parts.append(pack_chat(user, str(message.get("message", "")),
+                                   message.get("id", 0), message.get("ts", 0.0)))
+        return b"".join(parts)
+
+
+class ChatDecoder:
+    """单个有序流的解码器，记住对端定义过的用户名"""
+
+    def __init__(self):
+        self._users: Dict[int, str] = {}
+
+    def decode(self, data) -> List[dict]:
+        data = bytes(data)
+        if len(data) < 2 or data[0] != MAGIC:
+            raise ValueError("不是二进制聊天帧")
+        if data[1] != VERSION:
+            raise ValueError(f"不支持的二进制格式版本: {data[1]}")
+        messages = []
+        offset = 2
+        try:
+            while offset < len(data):
+                kind = data[offset]
+                if kind == REC_USER:
+                    _, index, length = _USER.unpack_from(data, offset)
+                    offset += _USER.size
+                    self._users[index] = data[offset:offset + length].decode("utf-8")
+                    offset += length
+                elif kind == REC_CHAT:
+                    _, msg_id, ts, user, length = _CHAT.unpack_from(data, offset)
+                    offset += _CHAT.size
+                    if offset + length > len(data):
+                        raise ValueError("消息被截断")
+                    message = {"username": self._users.get(user, "Unknown"),
+                               "message": data[offset:offset + length].decode("utf-8")}
+                    offset += length
+                    if msg_id:
+                        message["id"] = msg_id
+                        message["ts"] = ts
+                    messages.append(message)
+                else:
+                    raise ValueError(f"未知的记录类型: {kind}")
+        except (struct.error, UnicodeDecodeError) as e:
+            raise ValueError(f"二进制聊天帧格式错误: {e}")
+        return messages
+
+
+def decode_any(data, decoder: ChatDecoder) -> Tuple[List[dict], bool]:
+    """解码二进制帧或 JSON（对象或数组），返回 (消息列表, 是否为二进制)"""
+    if is_binary(data):
+        return decoder.decode(data), True
+    value = json.loads(data)
+    return (value if isinstance(value, list) else [value]), False
@@ -3,6 +3,7 @@ import requests
 import websockets
 import asyncio
 import json
+import time
 from rich.console import Console
 from rich.table import Table
 from rich.live import Live
@@ -11,38 +12,78 @@ import pyperclip
 from voice_chat import VoiceChatService
 from rich.prompt import Prompt
 import threading
-from msg_server import MessageBroadcaster  
+from msg_server import MessageBroadcaster, DEFAULT_CHANNEL, open_history
+from chat_wire import WIRE_FORMAT, ChatDecoder, ChatEncoder, decode_any
 import re
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from rich.progress import Progress
+from swarm import SwarmDownloader
+from profiler import MAX_PROFILE_SECONDS, profile as run_profile
+from compression import (
+    available_codecs, negotiate, is_compressible, compress_chunk,
+    StreamDecompressor, TransferStats
+)
+
+# 分块上传参数
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # 4MB
+UPLOAD_PARALLELISM = 4  # 同时发送的分块数
+DOWNLOAD_FOLDER = "downloads"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# 进入频道时显示的历史消息条数
+HISTORY_ON_JOIN = 20
 
 console = Console()
 
 class CommandHandler:
-    def __init__(self, host, port):
+    def __init__(self, host, port, audio=None):
         self.host = host
         self.port = port
+        self.audio = audio  # 语音通话的音频后端描述，None 表示默认
         self.base_url = f"http://{host}:{port}"
         self.ws_base_url = f"ws://{host}:{port}"
         self.chat_task = None
+        self.last_chat_id = None
         self.username = None
-        try:
-            self.message_broadcaster = MessageBroadcaster()  # 不再需要指定端口
-        except Exception as e:
-            rprint(f"[red]初始化消息广播器失败: {e}[/red]")
-            raise
+        # 设备列表缓存，配合 ETag 避免重复传输未变化的列表
+        self._devices_cache = []
+        self._devices_etag = None
+        # 进入频道时才创建（每个频道使用独立的组播组）
+        self.message_broadcaster = None
 
     async def ws_handle_chat(self):
         """处理聊天消息"""
-        uri = f"{self.ws_base_url}/message/ws"
+        # 请求使用二进制格式，旧版服务端会忽略该参数并继续使用 JSON
+        uri = f"{self.ws_base_url}/message/ws?format={WIRE_FORMAT}"
+        if self.last_chat_id is not None:
+            # 重连时只补发离线期间的消息
+            uri += f"&last_id={self.last_chat_id}"
+        encoder, decoder = ChatEncoder(), ChatDecoder()
+        binary = False  # 收到服务端的二进制帧后才改用二进制发送
+
         async with websockets.connect(uri) as ws:
             rprint("[green]✓[/green] 已连接到聊天室")
+
+            async def send_chat(message: dict):
+                await ws.send(encoder.encode([message]) if binary else json.dumps(message))
+
             # 接收消息的任务
             async def receive_messages():
+                nonlocal binary
                 while True:
                     try:
                         msg = await ws.recv()
-                        data = json.loads(msg)
-                        rprint(f"\n[bold blue]{data['username']}[/bold blue]: {data['message']}")
-                        print(">>> ", end='', flush=True)
+                        # 服务端会把积压的多条消息合并成一个数组（或一个二进制帧）发送
+                        items, is_binary = decode_any(msg, decoder)
+                        binary = binary or is_binary
+                        for item in items:
+                            if "id" in item:
+                                self.last_chat_id = item["id"]
+                            rprint(f"\n[bold blue]{item['username']}[/bold blue]: {item['message']}")
+                        if items:
+                            print(">>> ", end='', flush=True)
                     except Exception as e:
                         rprint(f"[red]接收消息错误: {e}[/red]")
                         break
@@ -58,7 +99,7 @@ class CommandHandler:
                         if message.lower() in ['/quit', '/exit']:
                             break
                         # 发送消息时包含用户名
-                        await ws.send_json({
+                        await send_chat({
                             "username": self.username,
                             "message": message
                         })
@@ -68,7 +109,7 @@ class CommandHandler:
 
             try:
                 # 发送加入聊天室的通知
-                await ws.send_json({
+                await send_chat({
                     "username": "system",
                     "message": f"{self.username} 加入了聊天室"
                 })
@@ -83,27 +124,42 @@ class CommandHandler:
             finally:
                 # 发送离开聊天室的通知
                 try:
-                    await ws.send_json({
+                    await send_chat({
                         "username": "system",
                         "message": f"{self.username} 离开了聊天室"
                     })
                 except:
                     pass
 
-    def boardcast_start_chat(self):
-        """启动聊天客户端"""
+    def boardcast_start_chat(self, channel: str = DEFAULT_CHANNEL, transport: str = "auto"):
+        """启动聊天客户端
+        channel: 频道名，每个频道对应一个组播组
+        transport: auto（优先组播，失败回退广播）/ multicast / broadcast
+        """
         if not self.username:
             self.username = Prompt.ask("请输入你的用户名")
+        try:
+            self.message_broadcaster = MessageBroadcaster(channel, transport, self.host)
+        except Exception as e:
+            rprint(f"[red]初始化消息广播器失败: {e}[/red]")
+            return
             
+        # 显示本机保存的该频道最近的聊天记录
+        history = open_history()
+        for record in history.page(channel, limit=HISTORY_ON_JOIN):
+            rprint(f"[dim]{time.strftime('%m-%d %H:%M', time.localtime(record['ts']))}[/dim] "
+                   f"[bold blue]{record['username']}[/bold blue]: {record['message']}")
+
         def handle_message(message: dict, addr):
             username = message.get('username', 'Unknown')
             msg = message.get('message', '')
             if username != self.username:  # 不显示自己的消息
+                history.append(channel, message)
                 rprint(f"\n[bold blue]{username}[/bold blue]: {msg}")
                 print(">>> ", end='', flush=True)
                 
         self.message_broadcaster.start(handle_message)
-        rprint("[green]✓[/green] 已加入聊天室")
+        rprint(f"[green]✓[/green] 已加入聊天室: {channel}")
         
         # 发送加入通知
         self.message_broadcaster.broadcast({
@@ -117,10 +173,9 @@ class CommandHandler:
                 if message.lower() in ['/quit', '/exit']:
                     break
                     
-                self.message_broadcaster.broadcast({
-                    "username": self.username,
-                    "message": message
-                })
+                outgoing = {"username": self.username, "message": message}
+                self.message_broadcaster.broadcast(outgoing)
+                history.append(channel, outgoing)
         finally:
             # 发送离开通知
             self.message_broadcaster.broadcast({
@@ -129,13 +184,28 @@ class CommandHandler:
             })
             self.message_broadcaster.stop()
 
+    def fetch_devices(self):
+        """获取在线设备列表，列表未变化时服务器返回 304 并使用本地缓存
+        return: 设备列表，失败时返回 None
+        """
+        headers = {}
+        if self._devices_etag:
+            headers["If-None-Match"] = self._devices_etag
+        response = requests.get(f"{self.base_url}/discovery/devices", headers=headers)
+        if response.status_code == 304:
+            return self._devices_cache
+        if response.status_code != 200:
+            rprint(f"[red]获取设备列表失败: {response.status_code}[/red]")
+            return None
+        self._devices_cache = response.json()
+        self._devices_etag = response.headers.get("ETag")
+        return self._devices_cache
+
     def show_online_devices(self):
         """显示在线设备列表"""
         try:
-            response = requests.get(f"{self.base_url}/discovery/devices")
-            if response.status_code == 200:
-                devices = response.json()
-                
+            devices = self.fetch_devices()
+            if devices is not None:
                 table = Table(title="在线设备")
                 table.add_column("设备名称")
                 table.add_column("IP地址")
@@ -152,54 +222,65 @@ class CommandHandler:
                         str(device['port'])
                     )
                 console.print(table)
-            else:
-                rprint(f"[red]获取设备列表失败: {response.status_code}[/red]")
         except Exception as e:
             rprint(f"[red]获取设备列表出错: {e}[/red]")
 
-    def create_voice_room(self):
-        """创建并加入语音房间"""
+    def create_voice_room(self, mix: bool = False):
+        """创建并加入语音房间，mix=True 时由服务端混音（适合人数较多的房间）"""
         import random
         import string
         room_id = ''.join(random.choices(string.ascii_letters + string.digits, k=6))
         ws_url = f"{self.ws_base_url}/voice/ws/{room_id}"
+        if mix:
+            ws_url += "?mode=mix"
         rprint(f"[green]✓[/green] 语音房间已创建！")
         rprint(f"房间ID: {room_id}")
         rprint(f"WebSocket URL: {ws_url}")
         
         # 自动加入创建的房间
-        self.join_voice_room(room_id)
+        self.join_voice_room(ws_url)
 
     def join_voice_room(self, ws_room_url):
         """加入语音房间"""
+        ws_room_url, _, query = ws_room_url.partition("?")
+        mode = query[len("mode="):] if query.startswith("mode=") else None
         ws_room_url=ws_room_url.split("/")
         
         ip,port=ws_room_url[2].split(":")
         
         room_id = ws_room_url[-1]
+        port = self._voice_room_port(ip, port, room_id)
         rprint(f"[green]✓[/green] 正在连接语音房间...")
         rprint(f"房间ID: {room_id}")
         rprint(f"WebSocket URL: {ws_room_url}")
         # 启动语音客户端
         try:
-            asyncio.run(VoiceChatService.connect_voice_chat(ip, port, room_id))
+            asyncio.run(VoiceChatService.connect_voice_chat(ip, port, room_id, mode, self.audio))
         except KeyboardInterrupt:
             rprint("[yellow]已断开语音连接[/yellow]")
         except Exception as e:
             rprint(f"[red]连接语音房间失败: {e}[/red]")
 
+    @staticmethod
+    def _voice_room_port(ip, port, room_id):
+        """多进程模式下房间由某个语音工作进程承载，询问其端口；单进程或旧版服务端使用原端口"""
+        try:
+            response = requests.get(f"http://{ip}:{port}/workers/placement/{room_id}", timeout=3)
+            if response.ok:
+                return response.json().get("port") or port
+        except (requests.RequestException, ValueError):
+            pass
+        return port
+
     def get_target_device(self, param: str = None) -> tuple:
         """获取目标设备的IP和端口
         param: 可以是设备序号(-n)或IP:端口格式
         return: (ip, port) or None
         """
         try:
-            response = requests.get(f"{self.base_url}/discovery/devices")
-            if response.status_code != 200:
-                rprint(f"[red]获取设备列表失败: {response.status_code}[/red]")
+            devices = self.fetch_devices()
+            if devices is None:
                 return None
-                
-            devices = response.json()
             if not devices:
                 rprint("[yellow]当前没有发现其他设备[/yellow]")
                 return None
@@ -269,22 +350,289 @@ class CommandHandler:
                 return
                 
             ip, port = target
-            
-            with open(file_path, "rb") as file:
-                files = {"file": file}
-                url = f"http://{ip}:{port}/file/upload"
-                response = requests.post(url, files=files)
-                
-                if response.status_code == 200:
+            base_url = f"http://{ip}:{port}/file"
+
+            with self._make_session(UPLOAD_PARALLELISM) as session:
+                if self._chunked_upload(session, base_url, file_path):
                     rprint(f"[green]✓[/green] 文件上传成功！")
-                else:
-                    rprint(f"[red]文件上传失败: {response.status_code}[/red]")
                     
         except FileNotFoundError:
             rprint(f"[red]文件不存在: {file_path}[/red]")
         except Exception as e:
             rprint(f"[red]文件上传出错: {e}[/red]")
 
+    @staticmethod
+    def _make_session(pool_size: int) -> requests.Session:
+        """创建带连接池的会话，分块并发发送时复用TCP连接"""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        return session
+
+    @staticmethod
+    def _hash_chunks(file_path: str, chunk_size: int) -> tuple:
+        """一次读取同时计算每个分块和整个文件的 SHA-256"""
+        chunk_hashes = []
+        file_hash = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data and chunk_hashes:
+                    break
+                chunk_hashes.append(hashlib.sha256(data).hexdigest())
+                file_hash.update(data)
+                if len(data) < chunk_size:
+                    break
+        return chunk_hashes, file_hash.hexdigest()
+
+    def _chunked_upload(self, session, base_url: str, file_path: str) -> bool:
+        """分块上传：init 获取已接收分块 -> 并发发送缺失分块 -> commit"""
+        size = os.path.getsize(file_path)
+        filename = os.path.basename(file_path)
+        chunk_hashes, file_hash = self._hash_chunks(file_path, UPLOAD_CHUNK_SIZE)
+
+        # 对端已有相同内容时只添加文件名，跳过传输
+        if session.head(f"{base_url}/blobs/{file_hash}").status_code == 200:
+            response = session.post(f"{base_url}/link", json={
+                "filename": filename,
+                "sha256": file_hash,
+            })
+            if response.status_code == 200:
+                rprint(f"[green]对端已有相同内容，已跳过传输: {response.json()['filename']}[/green]")
+                return True
+
+        response = session.post(f"{base_url}/upload/init", json={
+            "filename": filename,
+            "size": size,
+            "chunk_size": UPLOAD_CHUNK_SIZE,
+            "chunk_hashes": chunk_hashes,
+            "sha256": file_hash,
+        })
+        if response.status_code == 404:
+            # 对端为旧版本，不支持分块上传
+            return self._legacy_upload(session, base_url, file_path)
+        if response.status_code != 200:
+            rprint(f"[red]初始化上传失败: {response.status_code}[/red]")
+            return False
+
+        status = response.json()
+        upload_id = status["upload_id"]
+        received = set(status["received"])
+        pending = [i for i in range(len(chunk_hashes)) if i not in received]
+        if received:
+            rprint(f"[yellow]续传: 已有 {len(received)}/{len(chunk_hashes)} 个分块[/yellow]")
+
+        def read_chunk(index):
+            with open(file_path, "rb") as f:
+                f.seek(index * UPLOAD_CHUNK_SIZE)
+                return f.read(UPLOAD_CHUNK_SIZE)
+
+        # 与对端协商压缩算法，并抽样判断数据是否值得压缩
+        codec = negotiate(status.get("codecs", []))
+        if codec and pending and not is_compressible(codec, read_chunk(pending[0])):
+            codec = None
+        stats = TransferStats(codec)
+
+        def send_chunk(index):
+            data = read_chunk(index)
+            body = data
+            headers = {"Content-Type": "application/octet-stream"}
+            if codec:
+                with stats.measure():
+                    compressed = compress_chunk(codec, data)
+                # 单个分块压缩后反而变大时原样发送
+                if len(compressed) < len(data):
+                    body = compressed
+                    headers["Content-Encoding"] = codec
+            resp = session.put(
+                f"{base_url}/upload/{upload_id}/chunks/{index}",
+                data=body,
+                headers=headers
+            )
+            resp.raise_for_status()
+            stats.add(len(data), len(body))
+            return len(data)
+
+        with Progress() as progress:
+            task = progress.add_task("上传中", total=size,
+                                     completed=min(size, len(received) * UPLOAD_CHUNK_SIZE))
+            with ThreadPoolExecutor(max_workers=UPLOAD_PARALLELISM) as pool:
+                futures = [pool.submit(send_chunk, i) for i in pending]
+                for future in as_completed(futures):
+                    progress.advance(task, future.result())
+
+        response = session.post(f"{base_url}/upload/{upload_id}/commit")
+        if response.status_code != 200:
+            rprint(f"[red]提交上传失败: {response.status_code}[/red]")
+            return False
+        stored_name = response.json().get("filename", filename)
+        if stored_name != filename:
+            rprint(f"[yellow]对端已有同名文件，已保存为: {stored_name}[/yellow]")
+        rprint(f"传输统计: {stats}")
+        return True
+
+    @staticmethod
+    def _legacy_upload(session, base_url: str, file_path: str) -> bool:
+        """单次 multipart 上传（兼容旧版本对端）"""
+        with open(file_path, "rb") as file:
+            response = session.post(f"{base_url}/upload", files={"file": file})
+        if response.status_code != 200:
+            rprint(f"[red]文件上传失败: {response.status_code}[/red]")
+            return False
+        return True
+
+    def download_file(self, file_name: str, source: str):
+        """下载文件，支持断点续传；本地已是最新版本时不重复下载
+        file_name: 文件名
+        source: 源设备 IP:端口
+        """
+        try:
+            os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+            file_path = os.path.join(DOWNLOAD_FOLDER, os.path.basename(file_name))
+            part_path = file_path + ".part"
+            etags = self._load_etags()
+            url = f"http://{source}/file/download/{file_name}"
+
+            headers = {}
+            offset = 0
+            part_etag = etags.get(part_path)
+            if os.path.exists(part_path) and part_etag:
+                # 仅当远端文件未变化时续传，否则 If-Range 使服务器返回完整文件
+                offset = os.path.getsize(part_path)
+                headers["Range"] = f"bytes={offset}-"
+                headers["If-Range"] = part_etag
+            else:
+                # 完整下载时请求流式压缩
+                headers["Accept-Encoding"] = ", ".join(available_codecs())
+                if os.path.exists(file_path) and etags.get(file_path):
+                    headers["If-None-Match"] = etags[file_path]
+
+            with requests.get(url, headers=headers, stream=True) as response:
+                if response.status_code == 304:
+                    rprint(f"[green]✓[/green] 本地文件已是最新: {file_path}")
+                    return
+                if response.status_code not in (200, 206):
+                    rprint(f"[red]文件下载失败: {response.status_code}[/red]")
+                    return
+
+                if response.status_code == 200:
+                    offset = 0
+                # 压缩表示使用弱 ETag，保存对应的强 ETag 以便续传时使用 If-Range
+                etag = response.headers.get("ETag")
+                if etag and etag.startswith("W/"):
+                    etag = etag[2:]
+                etags[part_path] = etag
+                self._save_etags(etags)
+
+                codec = response.headers.get("Content-Encoding")
+                length = response.headers.get("X-Uncompressed-Length") or response.headers.get("Content-Length", 0)
+                total = offset + int(length)
+                # 解压后长度不得超过服务器声明的原始长度（防止解压炸弹）
+                decompressor = StreamDecompressor(codec, int(length)) if codec else None
+                stats = TransferStats(codec)
+                with open(part_path, "r+b" if offset else "wb") as f, Progress() as progress:
+                    f.seek(offset)
+                    f.truncate()
+                    task = progress.add_task("下载中", total=total, completed=offset)
+                    for chunk in response.raw.stream(DOWNLOAD_CHUNK_SIZE, decode_content=False):
+                        wire_length = len(chunk)
+                        if decompressor:
+                            with stats.measure():
+                                chunk = decompressor.decompress(chunk)
+                        stats.add(len(chunk), wire_length)
+                        f.write(chunk)
+                        progress.advance(task, len(chunk))
+                    received = f.tell()
+                if decompressor:
+                    decompressor.finish()
+
+            # 连接中断或数据流被截断时保留 .part 文件，下次续传
+            if received != total:
+                rprint(f"[red]下载不完整: {received}/{total} 字节，重新执行可续传[/red]")
+                return
+            os.replace(part_path, file_path)
+            etags.pop(part_path, None)
+            etags[file_path] = etag
+            self._save_etags(etags)
+            rprint(f"[green]✓[/green] 文件下载成功: {file_path} ({stats})")
+        except Exception as e:
+            rprint(f"[red]文件下载出错: {e}[/red]")
+
+    def swarm_download(self, file_name: str):
+        """从所有持有该文件的在线设备并行下载（多源下载）"""
+        try:
+            devices = self.fetch_devices()
+            if devices is None:
+                return
+            peers = [(device['ip'], device['port']) for device in devices]
+            if not peers:
+                rprint("[yellow]当前没有发现其他设备[/yellow]")
+                return
+
+            os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+            dest_path = os.path.join(DOWNLOAD_FOLDER, os.path.basename(file_name))
+            downloader = SwarmDownloader(file_name, peers, dest_path)
+            if not downloader.fetch_manifests():
+                rprint(f"[red]没有设备持有文件: {file_name}[/red]")
+                return
+            rprint(f"[green]✓[/green] {len(downloader.peers)} 个设备持有该文件，开始多源下载")
+
+            with Progress() as progress:
+                task = progress.add_task("下载中", total=downloader.size)
+                ok = downloader.run(lambda n: progress.advance(task, n))
+
+            if not ok:
+                rprint("[red]多源下载未完成，可重新执行以续传[/red]")
+                return
+            for peer in downloader.peers:
+                rprint(f"  {peer}: {peer.bytes_received / 1024 / 1024:.1f} MB, "
+                       f"{peer.throughput / 1024 / 1024:.1f} MB/s")
+            rprint(f"[green]✓[/green] 文件下载成功: {dest_path}")
+        except Exception as e:
+            rprint(f"[red]多源下载出错: {e}[/red]")
+
+    def profile(self, seconds: float = 10.0):
+        """对本进程的所有线程采样，结果保存为折叠栈文件（可用 flamegraph.pl 或 speedscope 打开）"""
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            rprint(f"[red]采样时长须在 0~{MAX_PROFILE_SECONDS} 秒之间[/red]")
+            return
+        try:
+            rprint(f"正在采样 {seconds:g} 秒...")
+            profiler = run_profile(seconds)
+            path = f"profile-{time.strftime('%Y%m%d-%H%M%S')}.collapsed"
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(profiler.collapsed())
+            rprint(f"[green]✓[/green] 共 {profiler.samples} 次采样，已保存到 {path}")
+
+            # 按每个栈最内层的函数汇总，显示最耗时的几项
+            leaves = {}
+            for stack, count in profiler.stacks.items():
+                leaf = stack.rsplit(";", 1)[-1]
+                leaves[leaf] = leaves.get(leaf, 0) + count
+            total = sum(leaves.values()) or 1
+            table = Table(title="采样最多的函数（含空闲等待）")
+            table.add_column("函数", style="cyan")
+            table.add_column("占比", justify="right")
+            for leaf, count in sorted(leaves.items(), key=lambda item: -item[1])[:15]:
+                table.add_row(leaf, f"{count / total:.1%}")
+            console.print(table)
+        except Exception as e:
+            rprint(f"[red]采样失败: {e}[/red]")
+
+    @staticmethod
+    def _load_etags() -> dict:
+        """读取本地已下载文件的 ETag 记录"""
+        try:
+            with open(os.path.join(DOWNLOAD_FOLDER, ".etags.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    @staticmethod
+    def _save_etags(etags: dict):
+        with open(os.path.join(DOWNLOAD_FOLDER, ".etags.json"), "w", encoding="utf-8") as f:
+            json.dump(etags, f)
+
     def show_help(self):
         """显示帮助信息"""
         help_table = Table(title="命令帮助")
@@ -293,12 +641,14 @@ class CommandHandler:
         help_table.add_column("用法")
         
         commands = [
-            ("chat", "进入群聊模式", "/chat"),
-            ("voice", "创建语音房间", "/voice"),
+            ("chat", "进入群聊模式（可指定频道）", "/chat [频道] [broadcast]"),
+            ("voice", "创建语音房间（mix 为服务端混音）", "/voice [mix]"),
             ("join", "加入语音房间", "/join <房间ID>"),
             ("devices", "显示在线设备", "/devices"),
             ("upload", "上传文件", "/upload <文件路径>"),
             ("download", "下载文件", "/download <文件名>"),
+            ("swarm", "从多个设备并行下载文件", "/swarm <文件名>"),
+            ("profile", "采样分析各线程耗时，保存为火焰图折叠栈", "/profile [秒数]"),
             ("help", "显示此帮助", "/help"),
             ("quit", "退出程序", "/quit"),
         ]
@@ -0,0 +1,211 @@
+import threading
+import time
+import zlib
+from typing import Iterable, List, Optional
+
+# 可选的高性能压缩库，未安装时回退到标准库 zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# 抽样压缩率高于该值时认为数据不可压缩（如已压缩的 zip/视频）
+INCOMPRESSIBLE_RATIO = 0.9
+SAMPLE_SIZE = 256 * 1024
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 6
+
+
+def available_codecs() -> List[str]:
+    """本机支持的压缩算法，按优先级排序"""
+    codecs = []
+    if zstandard is not None:
+        codecs.append("zstd")
+    if lz4 is not None:
+        codecs.append("lz4")
+    codecs.append("deflate")
+    return codecs
+
+
+def negotiate(offered: Iterable[str]) -> Optional[str]:
+    """从对端支持的算法中选出本机优先级最高的一个"""
+    offered = {codec.strip().split(";")[0].lower() for codec in offered}
+    for codec in available_codecs():
+        if codec in offered:
+            return codec
+    return None
+
+
+def parse_accept_encoding(header: Optional[str]) -> List[str]:
+    if not header:
+        return []
+    return [item.split(";")[0].strip().lower() for item in header.split(",") if item.strip()]
+
+
+class StreamCompressor:
+    """流式压缩器，compress() 可多次调用，最后调用 flush()"""
+
+    def __init__(self, codec: str):
+        self.codec = codec
+        if codec == "zstd":
+            self._obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        elif codec == "lz4":
+            self._obj = lz4.frame.LZ4FrameCompressor()
+            self._header = self._obj.begin()
+        elif codec == "deflate":
+            self._obj = zlib.compressobj(ZLIB_LEVEL)
+        else:
+            raise ValueError(f"不支持的压缩算法: {codec}")
+
+    def compress(self, data: bytes) -> bytes:
+        if self.codec == "lz4":
+            header, self._header = self._header, b""
+            return header + self._obj.compress(data)
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        if self.codec == "lz4":
+            header, self._header = self._header, b""
+            return header + self._obj.flush()
+        return self._obj.flush()
+
+
+class _BoundedSink:
+    """zstd 解压输出的接收端，累计长度超过 limit 时立即报错，不再继续解压"""
+
+    def __init__(self, limit: Optional[int]):
+        self.limit = limit
+        self.size = 0
+        self.parts: List[bytes] = []
+
+    def write(self, data) -> int:
+        self.size += len(data)
+        if self.limit is not None and self.size > self.limit:
+            raise ValueError("解压后数据超出预期长度")
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts.clear()
+        return data
+
+
+class StreamDecompressor:
+    """流式解压器，max_size 限制解压后的总长度（防止解压炸弹）
+
+    三种算法都边解压边检查长度，单个很小的恶意分块也不会先在内存中
+    完整展开再被拒绝。
+    """
+
+    def __init__(self, codec: str, max_size: Optional[int] = None):
+        self.codec = codec
+        self.max_size = max_size
+        self.total = 0
+        if codec == "zstd":
+            self._sink = _BoundedSink(max_size)
+            self._obj = zstandard.ZstdDecompressor().stream_writer(self._sink)
+        elif codec == "lz4":
+            self._obj = lz4.frame.LZ4FrameDecompressor()
+        elif codec == "deflate":
+            self._obj = zlib.decompressobj()
+        else:
+            raise ValueError(f"不支持的压缩算法: {codec}")
+
+    def decompress(self, data: bytes) -> bytes:
+        # 多取 1 字节，用于判断是否超出上限
+        limit = None if self.max_size is None else self.max_size - self.total + 1
+        if self.codec == "zstd":
+            self._obj.write(data)
+            out = self._sink.take()
+        elif self.codec == "lz4":
+            out = self._obj.decompress(data, max_length=-1 if limit is None else limit)
+        else:
+            out = self._obj.decompress(data, limit or 0)
+        self.total += len(out)
+        if self.max_size is not None and self.total > self.max_size:
+            raise ValueError("解压后数据超出预期长度")
+        return out
+
+    def finish(self):
+        """数据流结束后调用，压缩流被截断时报错
+
+        zstd 的 stream_writer 无法得知帧是否结束，截断由调用方按解压后长度判断。
+        """
+        if self.codec != "zstd" and not self._obj.eof:
+            raise ValueError("压缩数据流不完整")
+
+
+def compress_chunk(codec: str, data: bytes) -> bytes:
+    """一次性压缩单个分块"""
+    compressor = StreamCompressor(codec)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_chunk(codec: str, data: bytes, max_size: int) -> bytes:
+    """一次性解压单个分块，结果不得超过 max_size"""
+    return StreamDecompressor(codec, max_size).decompress(data)
+
+
+def is_compressible(codec: str, sample: bytes) -> bool:
+    """抽样压缩，判断数据是否值得压缩"""
+    sample = sample[:SAMPLE_SIZE]
+    if not sample:
+        return False
+    return len(compress_chunk(codec, sample)) < len(sample) * INCOMPRESSIBLE_RATIO
+
+
+class TransferStats:
+    """单次传输的压缩统计：原始字节数、线路字节数与压缩/解压耗费的 CPU 时间"""
+
+    def __init__(self, codec: Optional[str] = None):
+        self.codec = codec
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def measure(self):
+        """返回计时器，用法: with stats.measure(): ..."""
+        return _CpuTimer(self)
+
+    def add(self, raw: int, wire: int):
+        with self._lock:
+            self.raw_bytes += raw
+            self.wire_bytes += wire
+
+    @property
+    def ratio(self) -> float:
+        return self.wire_bytes / self.raw_bytes if self.raw_bytes else 1.0
+
+    def to_dict(self) -> dict:
+        return {
+            "codec": self.codec or "identity",
+            "raw_bytes": self.raw_bytes,
+            "wire_bytes": self.wire_bytes,
+            "ratio": round(self.ratio, 4),
+            "cpu_seconds": round(self.cpu_seconds, 4),
+        }
+
+    def __str__(self):
+        if not self.codec:
+            return "未压缩"
+        return f"{self.codec} 压缩率 {self.ratio:.1%}，CPU {self.cpu_seconds:.2f}s"
+
+
+class _CpuTimer:
+    def __init__(self, stats: TransferStats):
+        self.stats = stats
+
+    def __enter__(self):
+        self._start = time.thread_time()
+
+    def __exit__(self, *exc):
+        elapsed = time.thread_time() - self._start
+        with self.stats._lock:
+            self.stats.cpu_seconds += elapsed
@@ -1,31 +1,315 @@
 import argparse
-from zeroconf import ServiceBrowser, Zeroconf, ServiceInfo
+from zeroconf import ServiceBrowser, Zeroconf, ServiceInfo, current_time_millis
+from zeroconf.asyncio import AsyncServiceInfo
+import asyncio
 import socket
 import uuid
 import signal
 import sys
-from fastapi import APIRouter
-from typing import List, Dict
+import threading
+import time
+import json
+from collections import deque
+from fastapi import APIRouter, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import Callable, List, Dict, Optional, Set
+from metrics import registry
 
 router = APIRouter()
 discovery_service = None  # Global variable to store service instance
 
+# 本机提供的服务能力，通过 TXT 记录广播
+CAPABILITIES = ("chat", "voice", "file")
+# 设备超过该时间未被确认在线即视为过期（秒）
+DEVICE_TTL = 120
+SWEEP_INTERVAL = 30
+# 保留的变更记录数量，超出范围的增量查询返回完整快照
+CHANGE_LOG_SIZE = 1024
+# 事件流每个订阅者可缓冲的事件数，超出时要求客户端重新同步
+EVENT_QUEUE_SIZE = 256
+# DNS 记录类与类型（RFC 1035 / 3596 / 2782），查询 Zeroconf 缓存时使用
+_CLASS_IN = 1
+_TYPE_A = 1
+_TYPE_AAAA = 28
+_TYPE_SRV = 33
+KEEPALIVE_INTERVAL = 15
+# 异步解析参数
+RESOLVE_TIMEOUT_MS = 3000
+MAX_CONCURRENT_RESOLVES = 16
+NEGATIVE_TTL = 10  # 解析失败的结果缓存时间（秒）
+
+RESOLVE_LATENCY = registry.histogram("lanchat_discovery_resolve_seconds", "mDNS 服务异步解析耗时（秒）")
+RESOLVES = registry.counter(
+    "lanchat_discovery_resolves_total", "服务解析次数（cache: 命中缓存，ok: 解析成功，failed: 超时或失败）",
+    ["result"]
+)
+_RESOLVED_FROM_CACHE = RESOLVES.labels("cache")
+_RESOLVED_OK = RESOLVES.labels("ok")
+_RESOLVE_FAILED = RESOLVES.labels("failed")
+registry.gauge(
+    "lanchat_discovery_peers", "当前已发现的设备数",
+    fn=lambda: len(discovery_service.registry) if discovery_service is not None else 0
+)
+
+
+class ResolveCache:
+    """服务解析结果缓存
+
+    成功的结果按收到的 SRV 与 A/AAAA 记录剩余的 TTL 缓存，失败的结果（负缓存）
+    缓存 NEGATIVE_TTL 秒，避免同一个无响应的服务名被反复解析。
+    """
+
+    def __init__(self, zeroconf: Zeroconf, negative_ttl: float = NEGATIVE_TTL):
+        self.zeroconf = zeroconf
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[str, tuple] = {}  # name -> (info 或 None, 过期时间)
+
+    def record_ttl(self, info: ServiceInfo) -> float:
+        """取 zeroconf 记录缓存中该服务的 SRV 与 A/AAAA 记录最短的剩余 TTL
+
+        info.dns_service()/dns_addresses() 是按 ServiceInfo 的默认 TTL 在本地
+        构造的记录，不是网络上收到的，因此从记录缓存中读取。
+        """
+        cache = self.zeroconf.cache
+        records = cache.get_all_by_details(info.name, _TYPE_SRV, _CLASS_IN)
+        if info.server:
+            for type_ in (_TYPE_A, _TYPE_AAAA):
+                records.extend(cache.get_all_by_details(info.server, type_, _CLASS_IN))
+        now = current_time_millis()
+        ttls = [r.get_remaining_ttl(now) for r in records]
+        ttls = [ttl for ttl in ttls if ttl > 0]
+        return min(ttls) if ttls else DEVICE_TTL
+
+    def get(self, name: str):
+        """返回 (命中, info)，info 为 None 表示负缓存命中"""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return False, None
+            if entry[1] < time.monotonic():
+                del self._entries[name]
+                return False, None
+            return True, entry[0]
+
+    def put(self, name: str, info: Optional[ServiceInfo]):
+        ttl = self.record_ttl(info) if info is not None else self.negative_ttl
+        with self._lock:
+            self._entries[name] = (info, time.monotonic() + ttl)
+
+    def invalidate(self, name: str):
+        with self._lock:
+            self._entries.pop(name, None)
+
+
+class DeviceRegistry:
+    """线程安全的设备注册表
+
+    以服务名为主键，并维护按 IP 与按能力的二级索引。每个条目记录首次发现
+    与最后确认在线的时间，变化（join/update/leave）会推送给订阅者。
+    每次变化递增版本号并写入有限长度的变更记录，用于 ETag 与增量查询。
+    Zeroconf 回调运行在其自身线程中，所有读写都在锁内完成。
+    """
+
+    def __init__(self, ttl: float = DEVICE_TTL):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._devices: Dict[str, dict] = {}
+        self._by_ip: Dict[str, Set[str]] = {}
+        self._by_capability: Dict[str, Set[str]] = {}
+        self._listeners: List[Callable[[dict], None]] = []
+        # 进程级纪元，重启后版本号从 0 开始，ETag 仍不会与重启前混淆
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self._changes = deque(maxlen=CHANGE_LOG_SIZE)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._devices)
+
+    def __contains__(self, name: str):
+        with self._lock:
+            return name in self._devices
+
+    @staticmethod
+    def _public(device: dict) -> dict:
+        return {
+            "name": device["name"],
+            "ip": device["ip"],
+            "port": device["port"],
+            "capabilities": sorted(device["capabilities"]),
+            "last_seen": device["last_seen"],
+        }
+
+    def _index(self, device: dict):
+        self._by_ip.setdefault(device["ip"], set()).add(device["name"])
+        for cap in device["capabilities"]:
+            self._by_capability.setdefault(cap, set()).add(device["name"])
+
+    def _unindex(self, device: dict):
+        names = self._by_ip.get(device["ip"])
+        if names is not None:
+            names.discard(device["name"])
+            if not names:
+                del self._by_ip[device["ip"]]
+        for cap in device["capabilities"]:
+            names = self._by_capability.get(cap)
+            if names is not None:
+                names.discard(device["name"])
+                if not names:
+                    del self._by_capability[cap]
+
+    def upsert(self, name: str, ip: str, port: int, capabilities=()) -> Optional[str]:
+        """添加或更新设备，返回事件类型 join/update，无变化时返回 None"""
+        now = time.time()
+        capabilities = frozenset(capabilities)
+        with self._lock:
+            device = self._devices.get(name)
+            if device is not None:
+                device["last_seen"] = now
+                if (device["ip"], device["port"], device["capabilities"]) == (ip, port, capabilities):
+                    return None
+                self._unindex(device)
+                device.update(ip=ip, port=port, capabilities=capabilities)
+                event = "update"
+            else:
+                device = {
+                    "name": name,
+                    "ip": ip,
+                    "port": port,
+                    "capabilities": capabilities,
+                    "first_seen": now,
+                    "last_seen": now,
+                }
+                self._devices[name] = device
+                event = "join"
+            self._index(device)
+            self._emit(event, device)
+            return event
+
+    def touch(self, name: str) -> bool:
+        """刷新设备的最后在线时间"""
+        with self._lock:
+            device = self._devices.get(name)
+            if device is None:
+                return False
+            device["last_seen"] = time.time()
+            return True
+
+    def remove(self, name: str) -> bool:
+        with self._lock:
+            device = self._devices.pop(name, None)
+            if device is None:
+                return False
+            self._unindex(device)
+            self._emit("leave", device)
+            return True
+
+    def get(self, name: str) -> Optional[dict]:
+        with self._lock:
+            device = self._devices.get(name)
+            return self._public(device) if device else None
+
+    def by_ip(self, ip: str) -> List[dict]:
+        with self._lock:
+            return [self._public(self._devices[n]) for n in sorted(self._by_ip.get(ip, ()))]
+
+    def with_capability(self, capability: str) -> List[dict]:
+        with self._lock:
+            names = sorted(self._by_capability.get(capability, ()))
+            return [self._public(self._devices[n]) for n in names]
+
+    def snapshot(self) -> List[dict]:
+        """按发现顺序返回所有设备的副本"""
+        with self._lock:
+            return [self._public(d) for d in self._devices.values()]
+
+    def versioned_snapshot(self) -> tuple:
+        """原子地返回 (版本号, 设备列表)"""
+        with self._lock:
+            return self.version, self.snapshot()
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.epoch}-{self.version}"'
+
+    def cursor(self, version: int) -> str:
+        """增量查询与事件流使用的游标 "纪元:版本号"，重启后旧游标不会被误认"""
+        return f"{self.epoch}:{version}"
+
+    def parse_cursor(self, cursor: Optional[str]) -> Optional[int]:
+        """游标 -> 版本号；格式错误或属于其他纪元（服务已重启）时返回 None，应发送完整快照"""
+        epoch, _, version = (cursor or "").rpartition(":")
+        if epoch != self.epoch or not version.isdigit():
+            return None
+        return int(version)
+
+    def changes_since(self, version: int) -> Optional[List[dict]]:
+        """返回指定版本之后的变更；变更记录已被淘汰时返回 None"""
+        with self._lock:
+            if version > self.version:
+                return None
+            if version == self.version:
+                return []
+            if not self._changes or self._changes[0]["version"] > version + 1:
+                return None
+            return [e for e in self._changes if e["version"] > version]
+
+    def expired(self, now: Optional[float] = None) -> List[str]:
+        """返回超过 TTL 未确认在线的设备名"""
+        now = now or time.time()
+        with self._lock:
+            return [n for n, d in self._devices.items() if now - d["last_seen"] > self.ttl]
+
+    def subscribe(self, callback: Callable[[dict], None]) -> Callable[[], None]:
+        """订阅设备变化事件，返回取消订阅的函数"""
+        with self._lock:
+            self._listeners.append(callback)
+
+        def unsubscribe():
+            with self._lock:
+                if callback in self._listeners:
+                    self._listeners.remove(callback)
+        return unsubscribe
+
+    def _emit(self, event_type: str, device: dict):
+        self.version += 1
+        event = {
+            "type": event_type,
+            "version": self.version,
+            "device": self._public(device),
+            "time": time.time(),
+        }
+        self._changes.append(event)
+        for callback in list(self._listeners):
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"[DISCOVERY] 事件订阅者出错: {e}")
+
+
 class DiscoveryService:
     def __init__(self, service_name, port, local_ip):
         self.zeroconf = Zeroconf()
         self.service_name = service_name
         self.port = port
         self.local_ip = local_ip
-        self._devices = []  # 改用下划线前缀的私有变量
+        self.registry = DeviceRegistry()
         self.info = None
         self.browser = None
         # Add service type definition
         self.service_type = "_lanchat._tcp.local."
+        self._is_running = False
+        self._sweeper = None
+        self.resolve_cache = ResolveCache(self.zeroconf)
+        self._resolving: Set[str] = set()
+        self._resolving_lock = threading.Lock()
+        self._resolve_semaphore = None  # 在 zeroconf 的事件循环中创建
 
     @property
     def devices(self):
         """获取发现的设备列表"""
-        return self._devices
+        return self.registry.snapshot()
 
     def get_free_port(self):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -40,7 +324,7 @@ class DiscoveryService:
                 f"{self.service_name}.{self.service_type}",
                 addresses=[socket.inet_aton(self.local_ip)],  # Use self.local_ip instead
                 port=self.port,
-                properties={'version': '1.0'},
+                properties={'version': '1.0', 'caps': ','.join(CAPABILITIES)},
             )
             self.zeroconf.register_service(self.info)
             print(f"✅ 服务已注册: {self.service_name} ({self.local_ip}:{self.port})")
@@ -50,53 +334,108 @@ class DiscoveryService:
     def start_discovery(self):
         """Start discovering other services"""
         try:
+            self._is_running = True
             self.browser = ServiceBrowser(self.zeroconf, self.service_type, self)
+            self._sweeper = threading.Thread(target=self._sweep_loop, daemon=True)
+            self._sweeper.start()
             print("✅ 服务发现已启动")
         except Exception as e:
             print(f"❌ 服务发现启动失败: {e}")
+
+    @staticmethod
+    def _parse_capabilities(info: ServiceInfo) -> Set[str]:
+        caps = (info.properties or {}).get(b'caps') or b''
+        return {c for c in caps.decode('utf-8', 'ignore').split(',') if c}
+
+    def _handle_info(self, name, info):
+        """根据解析到的服务信息更新注册表"""
+        if not info or not info.addresses:
+            return
+        ip = socket.inet_ntoa(info.addresses[0])
+        port = info.port
+
+        # 过滤掉链路本地地址和本机地址
+        if ip.startswith("169.254.") or (ip == self.local_ip and port == self.port):
+            return
+
+        event = self.registry.upsert(name, ip, port, self._parse_capabilities(info))
+        if event == "join":
+            print(f"[DISCOVERY] 新设备加入: {name} ({ip}:{port})")
+            print(f"[STATUS] 当前已发现设备数量: {len(self.registry)}")
+        elif event == "update":
+            print(f"[UPDATE] 设备信息已更新: {name} ({ip}:{port})")
         
-    def add_service(self, zeroconf, type_, name):
-        info = zeroconf.get_service_info(type_, name)
-        if info:
-            ip = socket.inet_ntoa(info.addresses[0])
-            port = info.port
-            
-            # 过滤掉链路本地地址和本机地址
-            if ip.startswith("169.254.") or (ip == self.local_ip and port == self.port):
+    def _schedule_resolve(self, type_, name):
+        """在浏览器回调中调度解析，回调本身从不阻塞
+
+        先查解析缓存与 zeroconf 记录缓存，都未命中时才把异步解析提交到
+        zeroconf 自己的事件循环，并发解析数量受信号量限制。
+        """
+        hit, info = self.resolve_cache.get(name)
+        if hit:
+            _RESOLVED_FROM_CACHE.inc()
+            self._handle_info(name, info)
+            return
+
+        info = ServiceInfo(type_, name)
+        if info.load_from_cache(self.zeroconf):
+            _RESOLVED_FROM_CACHE.inc()
+            self.resolve_cache.put(name, info)
+            self._handle_info(name, info)
+            return
+
+        with self._resolving_lock:
+            if name in self._resolving:
                 return
-                
-            device = {
-                "name": name,
-                "ip": ip,
-                "port": port
-            }
-            if device not in self._devices:
-                self._devices.append(device)
-                print(f"[DISCOVERY] 新设备加入: {name} ({ip}:{port})")
-                print(f"[STATUS] 当前已发现设备数量: {len(self._devices)}")
+            self._resolving.add(name)
+        asyncio.run_coroutine_threadsafe(self._resolve(type_, name), self.zeroconf.loop)
+
+    async def _resolve(self, type_, name):
+        if self._resolve_semaphore is None:
+            self._resolve_semaphore = asyncio.Semaphore(MAX_CONCURRENT_RESOLVES)
+        try:
+            async with self._resolve_semaphore:
+                info = AsyncServiceInfo(type_, name)
+                # 只统计实际的网络解析，不含排队等待信号量的时间
+                with RESOLVE_LATENCY.time():
+                    ok = await info.async_request(self.zeroconf, RESOLVE_TIMEOUT_MS)
+            (_RESOLVED_OK if ok else _RESOLVE_FAILED).inc()
+            self.resolve_cache.put(name, info if ok else None)
+            if ok:
+                self._handle_info(name, info)
+        except Exception as e:
+            _RESOLVE_FAILED.inc()
+            print(f"[DISCOVERY] 解析服务失败: {name}: {e}")
+        finally:
+            with self._resolving_lock:
+                self._resolving.discard(name)
+
+    def add_service(self, zeroconf, type_, name):
+        self._schedule_resolve(type_, name)
 
     def remove_service(self, zeroconf, type_, name):
-        self._devices = [d for d in self._devices if d["name"] != name]
-        print(f"[DISCOVERY] 设备离开: {name}")
-        print(f"[STATUS] 当前已发现设备数量: {len(self._devices)}")
+        self.resolve_cache.invalidate(name)
+        if self.registry.remove(name):
+            print(f"[DISCOVERY] 设备离开: {name}")
+            print(f"[STATUS] 当前已发现设备数量: {len(self.registry)}")
 
     def update_service(self, zeroconf, service_type, name):
-        info = zeroconf.get_service_info(service_type, name)
-        if info:
-            updated_device = {
-                "name": name.split(".")[0],
-                "ip": socket.inet_ntoa(info.addresses[0]),
-                "port": info.port
-            }
-            for device in self.devices:
-                if device["name"] == updated_device["name"]:
-                    device.update(updated_device)
-                    self.add_device(updated_device["name"], updated_device["ip"], updated_device["port"])
-                    print(f"[UPDATE] 设备信息已更新: {device['name']} ({device['ip']}:{device['port']})")
-                    break
+        self.resolve_cache.invalidate(name)
+        self._schedule_resolve(service_type, name)
+
+    def _sweep_loop(self):
+        """定期清理过期设备：缓存中记录仍有效的刷新在线时间，否则移除"""
+        while self._is_running:
+            time.sleep(SWEEP_INTERVAL)
+            for name in self.registry.expired():
+                info = ServiceInfo(self.service_type, name)
+                if info.load_from_cache(self.zeroconf):
+                    self.registry.touch(name)
+                else:
+                    self.remove_service(self.zeroconf, self.service_type, name)
 
     def unregister_service(self):
-        self.zeroconf.unregister_service(self.service_info)
+        self.zeroconf.unregister_service(self.info)
         self.zeroconf.close()
         print(f"[UNREGISTER] 本机服务已注销: {self.service_name}")
 
@@ -112,16 +451,11 @@ class DiscoveryService:
 
     def add_device(self, name: str, ip: str, port: int):
         """Add discovered device"""
-        self.discovered_devices[name] = {
-            "name": name,
-            "ip": ip,
-            "port": port
-        }
+        self.registry.upsert(name, ip, port)
         
     def remove_device(self, name: str):
         """Remove device when it leaves"""
-        if name in self.discovered_devices:
-            del self.discovered_devices[name]
+        self.registry.remove(name)
 
 def signal_handler(signal, frame, discovery):
     print("\n[EXIT] 正在退出程序...")
@@ -154,8 +488,124 @@ if __name__ == "__main__":
 
 # Add FastAPI router for device discovery
 @router.get("/devices")
-async def get_devices():
-    """Get all discovered devices"""
+async def get_devices(request: Request, capability: Optional[str] = None,
+                      since: Optional[str] = None):
+    """Get all discovered devices, optionally filtered by capability
+
+    返回的 ETag 对应注册表版本，If-None-Match 命中时返回 304；
+    ?since=<cursor> 返回该游标之后的增量变更，游标来自上次响应的 cursor 字段，
+    属于重启前的注册表时返回完整快照。
+    """
     if discovery_service is None:
         return {"error": "Discovery service not initialized"}
-    return discovery_service.devices
\ No newline at end of file
+    registry = discovery_service.registry
+    if capability:
+        return registry.with_capability(capability)
+
+    if since is not None:
+        last_version = registry.parse_cursor(since)
+        changes = registry.changes_since(last_version) if last_version is not None else None
+        version, devices = registry.versioned_snapshot()
+        if changes is None:
+            return {"version": version, "cursor": registry.cursor(version), "full": True, "devices": devices}
+        return {"version": version, "cursor": registry.cursor(version), "full": False,
+                "changes": [c for c in changes if c["version"] <= version]}
+
+    etag = registry.etag
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    version, devices = registry.versioned_snapshot()
+    return JSONResponse(devices, headers={"ETag": f'"{registry.epoch}-{version}"'})
+
+
+async def _device_events(since: Optional[str] = None):
+    """设备事件异步迭代器：先发送快照（或断线期间的增量），再持续推送变化
+
+    since 为上次收到的事件的 cursor，不属于当前纪元时发送快照。每个事件带
+    cursor 字段。注册表回调来自 zeroconf 线程，通过 call_soon_threadsafe 投递
+    到本事件循环。订阅者处理太慢导致队列溢出时发送 resync 事件并重新发送快照。
+    """
+    registry = discovery_service.registry
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+    overflowed = False
+
+    def enqueue(event):
+        nonlocal overflowed
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            overflowed = True
+
+    unsubscribe = registry.subscribe(lambda event: loop.call_soon_threadsafe(enqueue, event))
+    try:
+        last_version = registry.parse_cursor(since)
+        changes = registry.changes_since(last_version) if last_version is not None else None
+        version, devices = registry.versioned_snapshot()
+        if changes is None:
+            yield {"type": "snapshot", "version": version, "cursor": registry.cursor(version), "devices": devices}
+        else:
+            for event in changes:
+                if event["version"] <= version:
+                    yield dict(event, cursor=registry.cursor(event["version"]))
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield None  # 保活
+                continue
+            if overflowed:
+                overflowed = False
+                while not queue.empty():
+                    queue.get_nowait()
+                version, devices = registry.versioned_snapshot()
+                yield {"type": "resync", "version": version, "cursor": registry.cursor(version), "devices": devices}
+                continue
+            if event["version"] > version:
+                version = event["version"]
+                yield dict(event, cursor=registry.cursor(version))
+    finally:
+        unsubscribe()
+
+
+@router.get("/events")
+async def device_event_stream(request: Request, since: Optional[str] = None):
+    """Server-Sent Events 形式的设备变化流，断线重连时支持 Last-Event-ID（事件 id 即 cursor）"""
+    if discovery_service is None:
+        return {"error": "Discovery service not initialized"}
+    if since is None:
+        since = request.headers.get("last-event-id")
+
+    async def stream():
+        events = _device_events(since)
+        try:
+            async for event in events:
+                if await request.is_disconnected():
+                    break
+                if event is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"id: {event['cursor']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            await events.aclose()
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@router.websocket("/ws")
+async def device_event_websocket(websocket: WebSocket, since: Optional[str] = None):
+    """WebSocket 形式的设备变化流"""
+    await websocket.accept()
+    if discovery_service is None:
+        await websocket.close(code=1011)
+        return
+    events = _device_events(since)
+    try:
+        async for event in events:
+            await websocket.send_json(event if event is not None else {"type": "ping"})
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        # 立即取消订阅，不等垃圾回收关闭生成器
+        await events.aclose()
@@ -0,0 +1,66 @@
+import asyncio
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from profiler import tracer
+
+# 文件读写专用线程池大小，以及允许排队等待的磁盘操作数量
+DISK_IO_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+DISK_IO_QUEUE = DISK_IO_WORKERS * 2
+
+_executor = ThreadPoolExecutor(max_workers=DISK_IO_WORKERS, thread_name_prefix="disk-io")
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def _semaphore() -> asyncio.Semaphore:
+    """每个事件循环一个信号量（信号量不能跨事件循环使用）"""
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(DISK_IO_QUEUE)
+    return semaphore
+
+
+async def run_io(func, *args):
+    """在有界线程池中执行阻塞的磁盘操作
+
+    排队的操作达到上限时调用方会在此等待，上传请求因此暂停读取请求体，
+    由 TCP 流量控制把压力传回发送端，而不是在内存中无限堆积数据。
+    开启请求追踪时，排队与执行的时间计入当前请求 span 的 disk_io 阶段。
+    """
+    with tracer.span("disk_io"):
+        async with _semaphore():
+            return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+
+class AsyncFile:
+    """aiofiles 风格的异步文件对象，所有操作都在磁盘线程池中执行"""
+
+    def __init__(self, path: str, mode: str):
+        self.path = path
+        self.mode = mode
+        self._file = None
+
+    async def __aenter__(self):
+        self._file = await run_io(open, self.path, self.mode)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def read(self, size: int = -1) -> bytes:
+        return await run_io(self._file.read, size)
+
+    async def write(self, data: bytes) -> int:
+        return await run_io(self._file.write, data)
+
+    async def close(self):
+        if self._file is not None:
+            await run_io(self._file.close)
+            self._file = None
+
+
+def open_async(path: str, mode: str = "rb") -> AsyncFile:
+    """用法: async with open_async(path, "rb") as f: data = await f.read(n)"""
+    return AsyncFile(path, mode)
@@ -0,0 +1,288 @@
+import os
+import stat
+import uuid
+from email.utils import formatdate
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+
+from starlette.datastructures import Headers
+from starlette.responses import Response
+
+from compression import StreamCompressor, TransferStats, is_compressible
+from disk_io import run_io
+from metrics import registry
+
+# 每次从磁盘读取的块大小（无法零拷贝时使用）
+READ_CHUNK_SIZE = 256 * 1024
+# 单个请求允许的最大区间数量，超过则返回整个文件
+MAX_RANGES = 16
+# ASGI 零拷贝发送扩展名 (http.response.zerocopysend)
+ZEROCOPY_EXTENSION = "http.response.zerocopysend"
+
+DOWNLOAD_BYTES = registry.counter("lanchat_download_bytes_total", "下载发送的字节数（压缩后）")
+TRANSFERS_IN_FLIGHT = registry.gauge(
+    "lanchat_transfers_in_flight", "进行中的上传/下载请求数", ["direction"]
+)
+_DOWNLOADS_IN_FLIGHT = TRANSFERS_IN_FLIGHT.labels("download")
+
+
+def make_etag(stat_result: os.stat_result) -> str:
+    """由文件大小和修改时间生成强校验 ETag"""
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """判断 If-None-Match / If-Range 中是否包含当前 ETag（弱比较）"""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in header.split(",")]
+    return any(tag.replace("W/", "", 1) == etag for tag in candidates)
+
+
+def parse_range(header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """解析 Range 请求头，返回合并后的 [start, end) 区间列表
+
+    语法无效时返回 None（按规范忽略 Range），所有区间都无法满足时返回空列表。
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        start_str, sep, end_str = part.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if start_str:
+                start = int(start_str)
+                end = int(end_str) + 1 if end_str else size
+            else:
+                # 后缀区间: bytes=-500 表示最后 500 字节
+                start = max(0, size - int(end_str))
+                end = size
+        except ValueError:
+            return None
+        if start < 0 or end <= start and end_str and start_str:
+            return None
+        end = min(end, size)
+        if start < end:
+            ranges.append((start, end))
+
+    # 合并重叠或相邻的区间
+    ranges.sort()
+    merged: List[Tuple[int, int]] = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class FileRangeResponse(Response):
+    """支持 Range / 多区间 / ETag 条件请求的文件响应
+
+    服务器提供 ASGI 零拷贝扩展时通过 sendfile 直接从文件描述符发送，
+    否则在有界的磁盘线程池中分块读取，不阻塞事件循环。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        request_headers: Headers,
+        filename: Optional[str] = None,
+        stat_result: Optional[os.stat_result] = None,
+        media_type: str = "application/octet-stream",
+        etag: Optional[str] = None,
+    ):
+        self.path = path
+        self.filename = filename
+        self.media_type = media_type
+        self.background = None
+        self.stat_result = stat_result or os.stat(path)
+        if not stat.S_ISREG(self.stat_result.st_mode):
+            raise FileNotFoundError(path)
+
+        size = self.stat_result.st_size
+        # 内容寻址的文件可直接使用内容哈希作为 ETag
+        self.etag = etag or make_etag(self.stat_result)
+        self.ranges: List[Tuple[int, int]] = [(0, size)]
+        self.boundary: Optional[str] = None
+        self.status_code = 200
+        self.body = b""
+
+        headers = {
+            "accept-ranges": "bytes",
+            "etag": self.etag,
+            "last-modified": formatdate(self.stat_result.st_mtime, usegmt=True),
+        }
+        if filename:
+            quoted = quote(filename)
+            if quoted != filename:
+                headers["content-disposition"] = f"attachment; filename*=utf-8''{quoted}"
+            else:
+                headers["content-disposition"] = f'attachment; filename="{filename}"'
+
+        if etag_matches(request_headers.get("if-none-match"), self.etag):
+            self.status_code = 304
+            self.ranges = []
+        else:
+            self._apply_range(request_headers, headers, size)
+
+        if self.status_code != 304:
+            headers["content-type"] = self._content_type()
+            headers["content-length"] = str(self._content_length())
+        self.raw_headers = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]
+
+    def _apply_range(self, request_headers: Headers, headers: dict, size: int):
+        range_header = request_headers.get("range")
+        if_range = request_headers.get("if-range")
+        if not range_header or (if_range is not None and if_range.strip() != self.etag):
+            return
+        ranges = parse_range(range_header, size)
+        if ranges is None or len(ranges) > MAX_RANGES:
+            return
+        if not ranges:
+            self.status_code = 416
+            self.ranges = []
+            headers["content-range"] = f"bytes */{size}"
+            return
+        self.status_code = 206
+        self.ranges = ranges
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers["content-range"] = f"bytes {start}-{end - 1}/{size}"
+        else:
+            self.boundary = uuid.uuid4().hex
+
+    def _content_type(self) -> str:
+        if self.boundary:
+            return f"multipart/byteranges; boundary={self.boundary}"
+        return self.media_type
+
+    def _part_header(self, start: int, end: int) -> bytes:
+        return (
+            f"--{self.boundary}\r\n"
+            f"Content-Type: {self.media_type}\r\n"
+            f"Content-Range: bytes {start}-{end - 1}/{self.stat_result.st_size}\r\n\r\n"
+        ).encode("latin-1")
+
+    def _closing_boundary(self) -> bytes:
+        return f"--{self.boundary}--\r\n".encode("latin-1")
+
+    def _content_length(self) -> int:
+        if self.status_code == 416:
+            return 0
+        length = sum(end - start for start, end in self.ranges)
+        if self.boundary:
+            # 每个分段前有分段头，之后有 CRLF，最后一个结束边界
+            length += sum(len(self._part_header(s, e)) + 2 for s, e in self.ranges)
+            length += len(self._closing_boundary())
+        return length
+
+    async def __call__(self, scope, receive, send):
+        async def metered_send(message):
+            if message["type"] == "http.response.body":
+                DOWNLOAD_BYTES.inc(len(message.get("body", b"")))
+            elif message["type"] == ZEROCOPY_EXTENSION:
+                DOWNLOAD_BYTES.inc(message["count"])
+            await send(message)
+
+        _DOWNLOADS_IN_FLIGHT.inc()
+        try:
+            await self._respond(scope, receive, metered_send)
+        finally:
+            _DOWNLOADS_IN_FLIGHT.dec()
+
+    async def _respond(self, scope, receive, send):
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        if scope.get("method", "GET").upper() == "HEAD" or not self.ranges:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        zerocopy = ZEROCOPY_EXTENSION in scope.get("extensions", {})
+        file = await run_io(open, self.path, "rb")
+        try:
+            for start, end in self.ranges:
+                if self.boundary:
+                    await send({"type": "http.response.body",
+                                "body": self._part_header(start, end), "more_body": True})
+                if zerocopy:
+                    await send({"type": ZEROCOPY_EXTENSION, "file": file,
+                                "offset": start, "count": end - start, "more_body": True})
+                else:
+                    await self._send_range(file, start, end, send)
+                if self.boundary:
+                    await send({"type": "http.response.body", "body": b"\r\n", "more_body": True})
+            tail = self._closing_boundary() if self.boundary else b""
+            await send({"type": "http.response.body", "body": tail})
+        finally:
+            await run_io(file.close)
+
+    @staticmethod
+    async def _send_range(file, start: int, end: int, send):
+        await run_io(file.seek, start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = await run_io(file.read, min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+
+class CompressedFileResponse(FileRangeResponse):
+    """按协商的算法流式压缩整个文件
+
+    先读取第一块数据抽样，不可压缩（已压缩的文件）时退回原样发送。
+    压缩后长度未知，使用分块传输编码，并以弱 ETag 区分压缩表示。
+    """
+
+    def __init__(self, codec: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.codec = codec
+        self.stats = TransferStats(codec)
+
+    def _compress(self, compressor: StreamCompressor, chunk: Optional[bytes]) -> bytes:
+        with self.stats.measure():
+            out = compressor.compress(chunk) if chunk is not None else compressor.flush()
+        self.stats.add(len(chunk) if chunk else 0, len(out))
+        return out
+
+    async def _respond(self, scope, receive, send):
+        if self.status_code != 200 or scope.get("method", "GET").upper() == "HEAD":
+            return await super()._respond(scope, receive, send)
+
+        file = await run_io(open, self.path, "rb")
+        try:
+            chunk = await run_io(file.read, READ_CHUNK_SIZE)
+            if not await run_io(is_compressible, self.codec, chunk):
+                await run_io(file.close)
+                return await super()._respond(scope, receive, send)
+
+            headers = [(k, v) for k, v in self.raw_headers if k not in (b"content-length", b"etag")]
+            headers += [
+                (b"content-encoding", self.codec.encode("latin-1")),
+                (b"etag", f"W/{self.etag}".encode("latin-1")),
+                (b"vary", b"accept-encoding"),
+                (b"x-uncompressed-length", str(self.stat_result.st_size).encode("latin-1")),
+            ]
+            await send({"type": "http.response.start", "status": 200, "headers": headers})
+
+            compressor = StreamCompressor(self.codec)
+            while chunk:
+                out = await run_io(self._compress, compressor, chunk)
+                if out:
+                    await send({"type": "http.response.body", "body": out, "more_body": True})
+                chunk = await run_io(file.read, READ_CHUNK_SIZE)
+            tail = await run_io(self._compress, compressor, None)
+            await send({"type": "http.response.body", "body": tail})
+        finally:
+            await run_io(file.close)
@@ -1,29 +1,468 @@
-from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
+from disk_io import run_io, open_async
+from file_response import FileRangeResponse, CompressedFileResponse, TRANSFERS_IN_FLIGHT, make_etag
+from swarm import hash_pieces, root_hash, DEFAULT_PIECE_SIZE
+from blob_store import BlobStore, hash_file, is_valid_hash
+from compression import available_codecs, negotiate, parse_accept_encoding, StreamDecompressor, TransferStats
+from metrics import registry
+from pydantic import BaseModel
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import asyncio
+import hashlib
+import json
 import os
+import uuid
 
 app = FastAPI()
 UPLOAD_FOLDER = "uploads"
+# 分块上传的临时数据与清单目录
+PARTIAL_FOLDER = os.path.join(UPLOAD_FOLDER, ".partial")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(PARTIAL_FOLDER, exist_ok=True)
+# 按内容寻址的去重存储，uploads/ 下的旧文件仍可直接下载
+store = BlobStore(UPLOAD_FOLDER)
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024  # 4MB
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+# 请求体累积到该大小后交给磁盘线程处理一次
+WRITE_BATCH_SIZE = 256 * 1024
+
+# 已加载的上传清单缓存: upload_id -> manifest
+_manifests: Dict[str, dict] = {}
+# 清单写盘锁，同一上传的并发分块按顺序保存清单
+_manifest_locks: Dict[str, asyncio.Lock] = {}
+# 进行中的上传的压缩统计: upload_id -> TransferStats
+_upload_stats: Dict[str, TransferStats] = {}
+# 提交锁，同一上传的重复提交按顺序执行
+_commit_locks: Dict[str, list] = {}  # upload_id -> [锁, 等待数]
+# 最近成功提交的结果: upload_id -> 响应，客户端重试提交时直接返回
+_committed: "OrderedDict[str, dict]" = OrderedDict()
+COMMITTED_RESULTS = 256
+# 分片清单缓存（LRU）: (内容哈希或ETag, piece_size) -> manifest
+_piece_manifests: "OrderedDict[tuple, dict]" = OrderedDict()
+PIECE_MANIFEST_CACHE = 256
+
+UPLOAD_BYTES = registry.counter("lanchat_upload_bytes_total", "上传收到的字节数（压缩后）")
+_UPLOADS_IN_FLIGHT = TRANSFERS_IN_FLIGHT.labels("upload")
+
+
+class UploadInit(BaseModel):
+    filename: str
+    size: int
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+    chunk_hashes: List[str]
+    sha256: Optional[str] = None
+
+
+class LinkRequest(BaseModel):
+    filename: str
+    sha256: str
+
+
+def chunk_count(size: int, chunk_size: int) -> int:
+    """计算文件的分块数量（空文件也算一块）"""
+    return max(1, (size + chunk_size - 1) // chunk_size)
+
+
+def make_upload_id(filename: str, size: int, chunk_size: int, chunk_hashes: List[str]) -> str:
+    """由文件名、大小与分块校验和生成稳定的上传ID，同一文件重新初始化即可续传"""
+    digest = hashlib.sha256()
+    digest.update(f"{filename}\0{size}\0{chunk_size}\0".encode("utf-8"))
+    for chunk_hash in chunk_hashes:
+        digest.update(chunk_hash.encode("ascii"))
+    return digest.hexdigest()[:32]
+
+
+def _manifest_path(upload_id: str) -> str:
+    return os.path.join(PARTIAL_FOLDER, f"{upload_id}.json")
+
+
+def _part_path(upload_id: str) -> str:
+    return os.path.join(PARTIAL_FOLDER, f"{upload_id}.part")
+
+
+def _save_manifest(manifest: dict):
+    """原子地写入清单，避免中断时留下半个JSON"""
+    path = _manifest_path(manifest["upload_id"])
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def _read_manifest(upload_id: str) -> Optional[dict]:
+    try:
+        with open(_manifest_path(upload_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+async def _load_manifest(upload_id: str) -> Optional[dict]:
+    manifest = _manifests.get(upload_id)
+    if manifest is not None:
+        return manifest
+    if not upload_id.isalnum():
+        return None
+    manifest = await run_io(_read_manifest, upload_id)
+    if manifest is not None:
+        manifest = _manifests.setdefault(upload_id, manifest)
+    return manifest
+
+
+async def _persist_manifest(manifest: dict):
+    """在磁盘线程中保存清单快照"""
+    lock = _manifest_locks.setdefault(manifest["upload_id"], asyncio.Lock())
+    async with lock:
+        snapshot = dict(manifest, received=list(manifest["received"]))
+        await run_io(_save_manifest, snapshot)
+
+
+async def _discard_upload(upload_id: str):
+    """删除清单并清理缓存（.part 文件由调用方处理）"""
+    async with _manifest_locks.setdefault(upload_id, asyncio.Lock()):
+        await run_io(_remove_quietly, _manifest_path(upload_id))
+    _manifests.pop(upload_id, None)
+    _manifest_locks.pop(upload_id, None)
+    _upload_stats.pop(upload_id, None)
+
+
+def _preallocate(path: str, size: int):
+    with open(path, "wb") as f:
+        f.truncate(size)
+
+
+def _copy_range(src_path: str, dst_path: str, offset: int, length: int):
+    """把临时文件的内容写入目标文件的 offset 处"""
+    with open(src_path, "rb") as src, open(dst_path, "r+b") as dst:
+        dst.seek(offset)
+        while length > 0:
+            data = src.read(min(WRITE_BATCH_SIZE, length))
+            if not data:
+                break
+            dst.write(data)
+            length -= len(data)
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class _ChunkSink:
+    """在磁盘线程中对分块数据解压、计算哈希并写入该分块的临时文件
+
+    校验通过后才复制到 .part 文件，重传已确认的分块时坏数据不会覆盖好数据。
+    """
+
+    def __init__(self, file, expected_length: int,
+                 codec: Optional[str], stats: TransferStats):
+        self.file = file
+        self.expected_length = expected_length
+        self.stats = stats
+        self.decompressor = StreamDecompressor(codec, expected_length) if codec else None
+        self.hasher = hashlib.sha256()
+        self.received = 0
+        self.wire_bytes = 0
+
+    def absorb(self, data: bytes):
+        self.wire_bytes += len(data)
+        if self.decompressor:
+            try:
+                with self.stats.measure():
+                    data = self.decompressor.decompress(data)
+            except Exception as e:
+                raise ValueError("分块解压失败") from e
+        if self.received + len(data) > self.expected_length:
+            raise ValueError("分块长度不正确")
+        self.hasher.update(data)
+        self.file.write(data)
+        self.received += len(data)
+
+
+def _resolve_file(filename: str) -> tuple:
+    """文件名 -> (路径, 内容哈希)，旧版直接保存在 uploads/ 下的文件哈希为 None"""
+    filename = os.path.basename(filename)
+    entry = store.lookup(filename)
+    if entry:
+        return store.blob_path(entry["hash"]), entry["hash"]
+    path = os.path.join(UPLOAD_FOLDER, filename)
+    if filename and not filename.startswith(".") and os.path.isfile(path):
+        return path, None
+    raise HTTPException(status_code=404, detail="文件不存在")
+
+
+def _manifest_status(manifest: dict) -> dict:
+    return {
+        "upload_id": manifest["upload_id"],
+        "filename": manifest["filename"],
+        "size": manifest["size"],
+        "chunk_size": manifest["chunk_size"],
+        "received": sorted(manifest["received"]),
+        "codecs": available_codecs(),
+    }
+
 
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...)):
-    file_path = os.path.join(UPLOAD_FOLDER, file.filename)
-    
-    # 分块写入（避免内存溢出）
-    with open(file_path, "wb") as buffer:
-        while chunk := await file.read(1024 * 1024):  # 1MB chunks
-            buffer.write(chunk)
-    
-    return {"filename": file.filename, "size": os.path.getsize(file_path)}
-
-@app.get("/download/{filename}")
-async def download_file(filename: str):
-    return FileResponse(
-        path=os.path.join(UPLOAD_FOLDER, filename),
-        filename=filename
-    )
+    filename = os.path.basename(file.filename or "")
+    if not filename:
+        raise HTTPException(status_code=400, detail="无效的文件名")
+    tmp_path = os.path.join(PARTIAL_FOLDER, f"{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    size = 0
+
+    # 分块写入（避免内存溢出），边写边计算内容哈希，磁盘操作不占用事件循环
+    _UPLOADS_IN_FLIGHT.inc()
+    try:
+        async with open_async(tmp_path, "wb") as buffer:
+            while chunk := await file.read(1024 * 1024):  # 1MB chunks
+                await buffer.write(chunk)
+                await run_io(digest.update, chunk)
+                size += len(chunk)
+                UPLOAD_BYTES.inc(len(chunk))
+    except BaseException:
+        await run_io(_remove_quietly, tmp_path)
+        raise
+    finally:
+        _UPLOADS_IN_FLIGHT.dec()
+
+    filename = await run_io(store.add_file, tmp_path, filename, digest.hexdigest())
+    return {"filename": filename, "size": size, "sha256": digest.hexdigest()}
+
+@app.post("/upload/init")
+async def init_upload(req: UploadInit):
+    """初始化（或恢复）分块上传，返回已接收的分块序号"""
+    filename = os.path.basename(req.filename)
+    if not filename or req.size < 0:
+        raise HTTPException(status_code=400, detail="无效的文件名或大小")
+    if not 0 < req.chunk_size <= MAX_CHUNK_SIZE:
+        raise HTTPException(status_code=400, detail="无效的分块大小")
+    if len(req.chunk_hashes) != chunk_count(req.size, req.chunk_size):
+        raise HTTPException(status_code=400, detail="分块校验和数量与文件大小不符")
+    if not all(is_valid_hash(h) for h in req.chunk_hashes) or (req.sha256 and not is_valid_hash(req.sha256)):
+        raise HTTPException(status_code=400, detail="无效的哈希")
+
+    upload_id = make_upload_id(filename, req.size, req.chunk_size, req.chunk_hashes)
+    manifest = await _load_manifest(upload_id)
+    if manifest is None:
+        manifest = {
+            "upload_id": upload_id,
+            "filename": filename,
+            "size": req.size,
+            "chunk_size": req.chunk_size,
+            "chunk_hashes": req.chunk_hashes,
+            "sha256": req.sha256,
+            "received": [],
+        }
+        # 预分配目标文件，分块可按偏移乱序写入
+        _manifests[upload_id] = manifest
+        await run_io(_preallocate, _part_path(upload_id), req.size)
+        await _persist_manifest(manifest)
+    return _manifest_status(manifest)
+
+@app.get("/upload/{upload_id}")
+async def upload_status(upload_id: str):
+    """查询分块上传进度"""
+    manifest = await _load_manifest(upload_id)
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="上传任务不存在")
+    return _manifest_status(manifest)
+
+@app.put("/upload/{upload_id}/chunks/{index}")
+async def upload_chunk(upload_id: str, index: int, request: Request):
+    """接收单个分块，校验 SHA-256 后按字节偏移写入"""
+    manifest = await _load_manifest(upload_id)
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="上传任务不存在")
+    if not 0 <= index < len(manifest["chunk_hashes"]):
+        raise HTTPException(status_code=400, detail="分块序号超出范围")
+
+    offset = index * manifest["chunk_size"]
+    expected_length = min(manifest["chunk_size"], manifest["size"] - offset)
+    codec = request.headers.get("content-encoding", "identity").lower()
+    stats = _upload_stats.setdefault(upload_id, TransferStats())
+    if codec != "identity":
+        if codec not in available_codecs():
+            raise HTTPException(status_code=415, detail="不支持的压缩算法")
+        stats.codec = codec
+
+    # 边接收边写入：请求体攒够一批后交给有界磁盘线程池，
+    # 线程池繁忙时暂停读取请求体，形成背压
+    tmp_path = os.path.join(PARTIAL_FOLDER, f"{upload_id}.{index}.{uuid.uuid4().hex}.tmp")
+    file = await run_io(open, tmp_path, "wb")
+    sink = _ChunkSink(file, expected_length, codec if codec != "identity" else None, stats)
+    buffer = bytearray()
+    _UPLOADS_IN_FLIGHT.inc()
+    try:
+        try:
+            async for data in request.stream():
+                UPLOAD_BYTES.inc(len(data))
+                buffer += data
+                if len(buffer) >= WRITE_BATCH_SIZE:
+                    await run_io(sink.absorb, bytes(buffer))
+                    buffer.clear()
+            if buffer:
+                await run_io(sink.absorb, bytes(buffer))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            _UPLOADS_IN_FLIGHT.dec()
+            await run_io(file.close)
+
+        if sink.received != expected_length:
+            raise HTTPException(status_code=400, detail="分块长度不正确")
+        if sink.hasher.hexdigest() != manifest["chunk_hashes"][index]:
+            raise HTTPException(status_code=422, detail="分块校验失败")
+        try:
+            await run_io(_copy_range, tmp_path, _part_path(upload_id), offset, expected_length)
+        except FileNotFoundError:
+            raise HTTPException(status_code=409, detail="上传已提交或已取消")
+    finally:
+        await run_io(_remove_quietly, tmp_path)
+
+    if index not in manifest["received"]:
+        manifest["received"].append(index)
+        await _persist_manifest(manifest)
+        stats.add(sink.received, sink.wire_bytes)
+    return {"index": index, "offset": offset, "size": sink.received}
+
+@app.post("/upload/{upload_id}/commit")
+async def commit_upload(upload_id: str):
+    """所有分块到齐后将临时文件移动到上传目录（重复提交返回第一次的结果）"""
+    if upload_id in _committed:
+        return _committed[upload_id]
+    entry = _commit_locks.setdefault(upload_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            return await _commit(upload_id)
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _commit_locks[upload_id]
+
+
+async def _commit(upload_id: str) -> dict:
+    if upload_id in _committed:
+        return _committed[upload_id]
+    manifest = await _load_manifest(upload_id)
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="上传任务不存在")
+    missing = set(range(len(manifest["chunk_hashes"]))) - set(manifest["received"])
+    if missing:
+        raise HTTPException(
+            status_code=409,
+            detail={"message": "仍有分块未上传", "missing": sorted(missing)}
+        )
+
+    part_path = _part_path(upload_id)
+    digest = await run_io(hash_file, part_path)
+    if manifest.get("sha256") and manifest["sha256"] != digest:
+        # 分块都校验通过但整体不符，说明声明的哈希有误：丢弃该上传，重新初始化即可从头开始
+        await _discard_upload(upload_id)
+        await run_io(_remove_quietly, part_path)
+        raise HTTPException(status_code=422, detail="文件校验失败")
+    filename = await run_io(store.add_file, part_path, manifest["filename"], digest)
+    stats = _upload_stats.get(upload_id) or TransferStats()
+    result = {"filename": filename, "size": manifest["size"], "sha256": digest,
+              "compression": stats.to_dict()}
+    _committed[upload_id] = result
+    while len(_committed) > COMMITTED_RESULTS:
+        _committed.popitem(last=False)
+    await _discard_upload(upload_id)
+    return result
+
+@app.api_route("/blobs/{digest}", methods=["GET", "HEAD"])
+async def blob_info(digest: str):
+    """查询是否已保存某个内容哈希，客户端据此跳过重复传输"""
+    if not store.has(digest):
+        raise HTTPException(status_code=404, detail="内容不存在")
+    return {"sha256": digest, "size": store.blob_size(digest)}
+
+@app.post("/link")
+async def link_file(req: LinkRequest):
+    """为已存在的内容添加文件名（秒传）"""
+    if not is_valid_hash(req.sha256):
+        raise HTTPException(status_code=400, detail="无效的哈希")
+    filename = await run_io(store.link, os.path.basename(req.filename), req.sha256)
+    if filename is None:
+        raise HTTPException(status_code=404, detail="内容不存在")
+    return {"filename": filename, "size": store.blob_size(req.sha256), "sha256": req.sha256}
+
+@app.get("/files")
+async def list_files():
+    """列出存储中的文件"""
+    return store.list_files()
+
+@app.delete("/files/{filename}")
+async def delete_file(filename: str):
+    """删除文件名引用，内容在 gc 时回收"""
+    if not await run_io(store.remove, os.path.basename(filename)):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    return {"filename": filename}
+
+@app.post("/gc")
+async def collect_garbage():
+    """回收没有引用的内容"""
+    return await run_io(store.gc)
+
+@app.api_route("/download/{filename}", methods=["GET", "HEAD"])
+async def download_file(filename: str, request: Request):
+    """下载文件，支持 Range/多区间、ETag 与 If-None-Match/If-Range"""
+    filename = os.path.basename(filename)
+    path, digest = _resolve_file(filename)
+    etag = f'"{digest}"' if digest else None
+    # 完整下载时按 Accept-Encoding 协商流式压缩，区间请求始终不压缩
+    codec = negotiate(parse_accept_encoding(request.headers.get("accept-encoding")))
+    try:
+        if codec and "range" not in request.headers:
+            return CompressedFileResponse(
+                codec,
+                path=path,
+                request_headers=request.headers,
+                filename=filename,
+                etag=etag
+            )
+        return FileRangeResponse(
+            path=path,
+            request_headers=request.headers,
+            filename=filename,
+            etag=etag
+        )
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="文件不存在")
+
+@app.get("/pieces/{filename}")
+async def get_pieces(filename: str, piece_size: int = DEFAULT_PIECE_SIZE):
+    """返回文件的分片哈希清单，供多源（swarm）下载校验"""
+    filename = os.path.basename(filename)
+    if not 0 < piece_size <= MAX_CHUNK_SIZE:
+        raise HTTPException(status_code=400, detail="无效的分片大小")
+    path, digest = _resolve_file(filename)
+    # 旧版文件没有内容哈希，以 大小+修改时间 作为缓存键
+    cache_key = (digest or make_etag(os.stat(path)), piece_size)
+
+    manifest = _piece_manifests.get(cache_key)
+    if manifest is not None:
+        _piece_manifests.move_to_end(cache_key)
+    else:
+        pieces = await run_io(hash_pieces, path, piece_size)
+        manifest = {
+            "size": os.path.getsize(path),
+            "piece_size": piece_size,
+            "sha256": digest,
+            "pieces": pieces,
+            "root": root_hash(pieces),
+        }
+        _piece_manifests[cache_key] = manifest
+        while len(_piece_manifests) > PIECE_MANIFEST_CACHE:
+            _piece_manifests.popitem(last=False)
+    return {"filename": filename, **manifest}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,20 +1,48 @@
+import asyncio
 import threading
 import argparse
+from contextlib import asynccontextmanager
 from discovery import DiscoveryService, router as discovery_router, initialize_discovery
-from msg_server import app as message_app
+from msg_server import app as message_app, close_history, open_history
 from file_tsf import app as file_app
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from metrics import CONTENT_TYPE, registry
+from profiler import TraceMiddleware, router as profile_router, tracer, watchdog
 import uvicorn
 import socket
 import re
 from voice_chat import app as voice_app, voice_service
+import voice_workers
+from rich.prompt import Prompt
+
+# 聊天记录数据库路径（--history 参数），None 时使用 chat_history.HISTORY_PATH
+history_path = None
+
+@asynccontextmanager
+async def lifespan(app):
+    # 在 uvicorn 的事件循环上启动卡顿检测
+    watchdog.start(asyncio.get_running_loop())
+    open_history(history_path)
+    if voice_workers.pool is not None:
+        await voice_workers.pool.attach()
+    yield
+    watchdog.stop()
+    close_history()
 
 # 合并多个FastAPI实例
-main_app = FastAPI()
+main_app = FastAPI(lifespan=lifespan)
+main_app.add_middleware(TraceMiddleware)
 main_app.mount("/message", message_app)
 main_app.mount("/file", file_app)
 main_app.mount("/voice", voice_app)
 main_app.include_router(discovery_router, prefix="/discovery")
+main_app.include_router(profile_router, prefix="/profile")
+main_app.include_router(voice_workers.router, prefix="/workers")
+
+@main_app.get("/metrics")
+def metrics():
+    """Prometheus 文本格式的运行指标（语音、聊天、文件传输与设备发现）"""
+    return Response(registry.render(), media_type=CONTENT_TYPE)
 
 class ServiceController:
     def __init__(self):
@@ -43,9 +71,6 @@ class ServiceController:
         self.discovery.start_advertising()
         self.discovery.start_discovery()
         print(f"✅ 服务已启动在 {self.local_ip}:{self.service_port}")
-        
-        # 启动语音服务
-        self.voice_service.start_streaming()
 
     @staticmethod
     def get_local_ip():
@@ -75,11 +100,6 @@ class ServiceController:
                 self.discovery.stop()
         except Exception as e:
             print(f"⚠️ 停止发现服务时出错: {e}")
-        
-        try:
-            self.voice_service.stop_streaming()
-        except Exception as e:
-            print(f"⚠️ 停止语音服务时出错: {e}")
     
 
 if __name__ == "__main__":
@@ -109,11 +129,23 @@ if __name__ == "__main__":
 使用方法:
 - 按Ctrl+C可退出程序
 - 使用--port参数可指定端口号
+- 使用--audio参数可指定语音的音频后端（如没有声卡时使用 synthetic 或 null）
+- 使用--trace参数记录每个请求的耗时，/profile 命令采样分析各线程的耗时
+- 使用--workers参数启动多个语音工作进程，语音房间按房间分配到各进程（多核机器可承载更多房间）
 """)
     # 解析命令行参数
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, help="指定服务端口（可选）")
+    parser.add_argument("--audio", default=None,
+                        help="语音通话的音频后端: auto/pyaudio/null/synthetic[:频率]/wav:<输入>[:<输出>]")
+    parser.add_argument("--history", default=None, help="聊天记录数据库路径（默认 chat_history.db）")
+    parser.add_argument("--trace", action="store_true", help="记录每个请求的耗时（GET /profile/trace 查看）")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="语音工作进程数（0 为单进程；多核机器上可设为 CPU 核数，按房间分配到各进程）")
     args = parser.parse_args()
+    if args.trace:
+        tracer.enabled = True
+    history_path = args.history
 
     # 初始化控制器
     controller = ServiceController()
@@ -133,9 +165,12 @@ if __name__ == "__main__":
     # 启动主服务
     print(f"🌐 主服务监听端口: {controller.service_port}")
     
+    if args.workers > 0:
+        voice_workers.start_pool(args.workers, controller.service_port)
+
     # 创建命令处理器
     from commands import CommandHandler
-    cmd_handler = CommandHandler(controller.local_ip, controller.service_port)
+    cmd_handler = CommandHandler(controller.local_ip, controller.service_port, audio=args.audio)
     
     # 启动服务器
     server_thread = threading.Thread(
@@ -165,10 +200,16 @@ if __name__ == "__main__":
                 cmd_handler.show_help()
             elif cmd == "chat":  # 新增聊天命令
                 cmd_handler.boardcast_start_chat()
+            elif cmd.startswith("chat "):
+                parts = cmd.split()
+                transport = parts[2] if len(parts) > 2 else "auto"
+                cmd_handler.boardcast_start_chat(parts[1], transport)
             elif cmd == "devices":
                 cmd_handler.show_online_devices()
             elif cmd == "voice":
                 cmd_handler.create_voice_room()
+            elif cmd == "voice mix":
+                cmd_handler.create_voice_room(mix=True)
             elif cmd.startswith("join "):
                 room_id = cmd.split(" ", 1)[1]
                 cmd_handler.join_voice_room(room_id)
@@ -187,10 +228,22 @@ if __name__ == "__main__":
                 file_name = cmd.split(" ", 1)[1]
                 source = Prompt.ask("请输入源设备的IP:端口")
                 cmd_handler.download_file(file_name, source)
+            elif cmd.startswith("swarm "):
+                file_name = cmd.split(" ", 1)[1]
+                cmd_handler.swarm_download(file_name)
+            elif cmd == "profile" or cmd.startswith("profile "):
+                parts = cmd.split()
+                try:
+                    seconds = float(parts[1]) if len(parts) > 1 else 10.0
+                except ValueError:
+                    print("用法: /profile [秒数]")
+                    continue
+                cmd_handler.profile(seconds)
             else:
                 print("未知命令，输入 /help 查看帮助")
     
     except KeyboardInterrupt:
         print("\n正在退出...")
     finally:
+        voice_workers.stop_pool()
         controller.cleanup()
\ No newline at end of file
@@ -0,0 +1,274 @@
+import bisect
+import math
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# 默认的延迟分桶（秒）：0.1ms ~ 10s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Shards:
+    """按线程分片的计数单元
+
+    每个线程只写自己的单元（列表），热路径上没有锁，也不会因为 += 不是原子
+    操作而丢失更新；只有线程第一次写入时加锁登记，读取时把所有单元相加。
+    """
+
+    def __init__(self, size: int):
+        self._size = size
+        self._local = threading.local()
+        self._cells: List[list] = []
+        self._lock = threading.Lock()
+
+    def cell(self) -> list:
+        cell = getattr(self._local, "cell", None)
+        if cell is None:
+            cell = self._local.cell = [0] * self._size
+            with self._lock:
+                self._cells.append(cell)
+        return cell
+
+    def totals(self) -> list:
+        totals = [0] * self._size
+        with self._lock:
+            cells = list(self._cells)
+        for cell in cells:
+            for i, value in enumerate(cell):
+                totals[i] += value
+        return totals
+
+
+class _CounterChild:
+    def __init__(self):
+        self._shards = _Shards(1)
+
+    def inc(self, amount: float = 1):
+        self._shards.cell()[0] += amount
+
+    def value(self) -> float:
+        return self._shards.totals()[0]
+
+
+class _GaugeChild(_CounterChild):
+    def dec(self, amount: float = 1):
+        self._shards.cell()[0] -= amount
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Sequence[float]):
+        self._buckets = buckets
+        # 各分桶计数 + 总和 + 总数
+        self._shards = _Shards(len(buckets) + 3)
+
+    def observe(self, value: float):
+        cell = self._shards.cell()
+        cell[bisect.bisect_left(self._buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        totals = self._shards.totals()
+        return totals[:-2], totals[-2], totals[-1]
+
+
+class _Timer:
+    def __init__(self, histogram: _HistogramChild):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._started)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values, **kwargs):
+        """取得（必要时创建）某组标签值的子指标，调用方可保存返回值避免重复查找"""
+        if kwargs:
+            values = tuple(str(kwargs[name]) for name in self.labelnames)
+        else:
+            values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def remove(self, *values, **kwargs):
+        """删除一组标签（如房间关闭时），避免标签无限增长"""
+        if kwargs:
+            values = tuple(str(kwargs[name]) for name in self.labelnames)
+        with self._lock:
+            self._children.pop(tuple(str(value) for value in values), None)
+
+    def _samples(self):
+        with self._lock:
+            return list(self._children.items())
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self._samples():
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values, child) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value())}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self._default.inc(amount)
+
+
+class Gauge(_Metric):
+    """可增减的量（如进行中的传输数）；fn 不为空时在采集时调用 fn() 取值，热路径零开销"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 fn: Optional[Callable[[], object]] = None):
+        self._fn = fn
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount: float = 1):
+        self._default.inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._default.dec(amount)
+
+    def render(self) -> List[str]:
+        if self._fn is None:
+            return super().render()
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        value = self._fn()
+        # 带标签的回调返回 {标签值元组: 数值}
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for values, number in items:
+            values = values if isinstance(values, tuple) else (values,)
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(number)}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+    def _render_child(self, values, child) -> List[str]:
+        counts, total, count = child.snapshot()
+        lines = []
+        cumulative = 0
+        for bound, bucket in zip(self.buckets + (math.inf,), counts):
+            cumulative += bucket
+            labels = _format_labels(self.labelnames, values, f'le="{_format_value(bound)}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """指标注册表，render() 输出 Prometheus 文本格式（0.0.4）"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing  # 模块被重复导入时复用已注册的指标
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+              fn: Optional[Callable[[], object]] = None) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, fn))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# 采集 {metric.name} 失败: {e}")
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 全局注册表，各服务模块在导入时注册自己的指标
+registry = Registry()
@@ -1,10 +1,28 @@
-from fastapi import FastAPI, WebSocket
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
+import queue
+import selectors
 import socket
+import struct
+import sys
 import json
 import threading
-from typing import Callable, Optional
+import time
+import zlib
+from collections import deque
+from typing import Callable, Dict, Optional
 from rich import print as rprint
+from chat_history import HISTORY_PATH, ChatHistory
+from chat_wire import (
+    HEADER, WIRE_FORMAT, ChatDecoder, ChatEncoder, UsernameTable, decode_any, is_binary, pack_chat, parse_formats
+)
+from disk_io import run_io
+from metrics import registry
+from reliable_channel import (
+    HEARTBEAT, HEARTBEAT_INTERVAL, NACK, NACK_INTERVAL,
+    ReliableReceiver, ReliableSender, channel_id, new_sender_id, pack_nack, parse_packet
+)
 
 app = FastAPI()
 
@@ -16,13 +34,139 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+DEFAULT_CHANNEL = "lobby"
+
+# WebSocket 聊天室：每个连接最多积压的消息数，以及合并成一帧的消息数/字节数上限
+CHAT_QUEUE_SIZE = 1024
+BATCH_MAX_MESSAGES = 64
+BATCH_MAX_BYTES = 64 * 1024
+# WebSocket 聊天室在聊天记录中的频道名；新连接补发最近的消息条数，断线重连最多补发的条数
+WEB_CHANNEL = "web"
+REPLAY_RECENT = 50
+CATCHUP_LIMIT = 500
+# 频道接收：内核接收缓冲区大小、每次唤醒最多读取的数据报数、待显示消息队列长度
+RECEIVE_BUFFER = 4 * 1024 * 1024
+RECEIVE_BATCH = 64
+DISPATCH_QUEUE_SIZE = 1024
+# Linux 的 SO_RXQ_OVFL：随数据报返回该套接字因缓冲区满被内核丢弃的累计包数
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40 if sys.platform.startswith("linux") else None)
+_DROP_COUNT = struct.Struct("I")
+# 超过该时间没有收到某个发送者的任何报文，不再在选择编码格式时考虑它（秒）
+PEER_TIMEOUT = 5.0
+# 可靠通道心跳中的能力位：支持 bin1 二进制格式
+CAP_BINARY = 0x1
+
+CHAT_DATAGRAMS_RECEIVED = registry.counter(
+    "lanchat_chat_datagrams_received_total", "频道收到的数据报数", ["channel"]
+)
+CHAT_DATAGRAMS_SENT = registry.counter("lanchat_chat_datagrams_sent_total", "频道发送的数据报数", ["channel"])
+CHAT_DROPPED = registry.counter(
+    "lanchat_chat_dropped_total", "频道丢弃的消息数（kernel: 接收缓冲区满，dispatch: 显示不及）",
+    ["channel", "reason"]
+)
+CHAT_CALLBACK = registry.histogram("lanchat_chat_callback_seconds", "频道消息回调耗时（秒）", ["channel"])
+WS_MESSAGES = registry.counter(
+    "lanchat_chat_ws_messages_total", "WebSocket 聊天室收到(in)/发出(out)的消息数", ["direction"]
+)
+WS_FRAMES = registry.counter("lanchat_chat_ws_frames_total", "WebSocket 聊天室发出的帧数")
+WS_DROPPED = registry.counter("lanchat_chat_ws_dropped_total", "WebSocket 聊天室因连接积压丢弃的消息数")
+
+
+def multicast_group(channel: str) -> str:
+    """频道名 -> 组播地址（239.255.0.0/16 本地管理范围，避开 SSDP 等常用的 239.255.255.x）"""
+    h = zlib.crc32(channel.encode("utf-8"))
+    return f"239.255.{100 + h % 100}.{1 + (h >> 8) % 254}"
+
+
 class MessageBroadcaster:
+    """局域网频道聊天
+
+    每个频道使用独立的组播组（IGMP 加入/退出），只有加入该频道的主机才会
+    收到并处理聊天报文；无法加入组播（如网卡或网络不支持）或指定
+    transport="broadcast" 时回退到子网广播，并按频道 ID 过滤。
+
+    在 UDP 之上实现可靠层（见 reliable_channel）：每个发送者的分片带有
+    序列号，接收端发现缺口后发送 NACK，由发送者从发送窗口中重传；大消息
+    自动分片并重组，按发送顺序交付，按消息 ID 去重。重传失败的消息会提示丢失。
+
+    消息编码按频道中的对端协商：只有最近活跃的对端都支持二进制格式（见
+    chat_wire）时才发送二进制，否则发送 JSON 并在其中声明本机支持的格式。
+
+    接收线程只负责读套接字和可靠层处理：非阻塞套接字配合 selectors，每次
+    唤醒读空内核缓冲区（最多 RECEIVE_BATCH 个）；解出的消息放入有界队列，
+    由单独的分发线程按顺序调用回调，终端输出变慢不会阻塞读取。
+    """
+
     BROADCAST_PORT = 25896  # 固定的广播接收端口
+    MULTICAST_PORT = 25897
+    MULTICAST_TTL = 1       # 组播只在本网段内传播
+    MAX_DATAGRAM = 65535
 
-    def __init__(self):
+    def __init__(self, channel: str = DEFAULT_CHANNEL, transport: str = "auto",
+                 interface_ip: Optional[str] = None):
         self.running = False
         self.receive_callback: Optional[Callable] = None
-        
+        self.channel = channel
+        self.channel_id = channel_id(channel)
+        self.interface_ip = interface_ip or "0.0.0.0"
+        self.sender_id = new_sender_id()
+        self.sender = ReliableSender(self.sender_id, self.channel_id, CAP_BINARY)
+        self.receiver = ReliableReceiver()
+        self._last_heartbeat = 0.0
+        self._last_tick = 0.0
+        self._reported_lost = 0
+        # 接收方可能随时加入频道，每条消息都带上用户名定义
+        self._encoder = ChatEncoder(always_define=True)
+        self._decoders: Dict[int, ChatDecoder] = {}
+        self._peers: Dict[object, list] = {}  # 发送者 -> [是否支持二进制格式, 最后活动时间]
+        self.group = multicast_group(channel)
+        self.transport = None
+
+        if transport in ("auto", "multicast"):
+            try:
+                self._open_multicast()
+            except OSError as e:
+                if transport == "multicast":
+                    raise
+                rprint(f"[yellow]无法加入组播组 {self.group}，改用广播: {e}[/yellow]")
+        if self.transport is None:
+            self._open_broadcast()
+        self._tune_receive_socket()
+
+        self._dispatch_queue: "queue.Queue" = queue.Queue(DISPATCH_QUEUE_SIZE)
+        self.datagrams = 0
+        self.wakeups = 0
+        self.dispatch_dropped = 0
+        self._reported_dropped = 0
+        self.queue_depth_max = 0
+        self.callback_avg = 0.0
+        self.callback_max = 0.0
+        # 热路径上直接使用子指标，避免每次按标签查找
+        self._received_metric = CHAT_DATAGRAMS_RECEIVED.labels(channel)
+        self._sent_metric = CHAT_DATAGRAMS_SENT.labels(channel)
+        self._kernel_drop_metric = CHAT_DROPPED.labels(channel, "kernel")
+        self._dispatch_drop_metric = CHAT_DROPPED.labels(channel, "dispatch")
+        self._callback_metric = CHAT_CALLBACK.labels(channel)
+
+    def _tune_receive_socket(self):
+        """增大接收缓冲区，开启内核丢包计数，并设为非阻塞（由 selectors 等待可读）"""
+        try:
+            self.receive_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        except OSError:
+            pass
+        # Linux 实际分配的是请求值的两倍，且受 net.core.rmem_max 限制
+        self.receive_buffer = self.receive_sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self.kernel_drops: Optional[int] = None
+        if SO_RXQ_OVFL is not None and hasattr(self.receive_sock, "recvmsg"):
+            try:
+                self.receive_sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+                self.kernel_drops = 0
+                self._ancillary_size = socket.CMSG_SPACE(_DROP_COUNT.size)
+            except OSError:
+                pass
+        self.receive_sock.setblocking(False)
+
+    def _open_broadcast(self):
         # 创建UDP socket用于接收广播
         self.receive_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.receive_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -31,59 +175,495 @@ class MessageBroadcaster:
         # 创建UDP socket用于发送广播
         self.send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.send_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.transport = "broadcast"
+        self.destination = ('<broadcast>', self.BROADCAST_PORT)
         
-        rprint(f"[green]✓[/green] 消息广播服务启动在端口 {self.BROADCAST_PORT}")
+        rprint(f"[green]✓[/green] 频道 {self.channel} 使用广播，端口 {self.BROADCAST_PORT}")
+
+    def _open_multicast(self):
+        self._membership = struct.pack("4s4s", socket.inet_aton(self.group),
+                                       socket.inet_aton(self.interface_ip))
+        receive_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            receive_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Linux 上绑定组播地址只接收本组的报文；Windows 只能绑定任意地址
+            receive_sock.bind(('' if sys.platform == "win32" else self.group, self.MULTICAST_PORT))
+            # 加入组播组（内核发送 IGMP Membership Report）
+            receive_sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, self._membership)
+
+            send_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.MULTICAST_TTL)
+            # 同一台机器上的其他实例也要能收到（自己的报文按发送者 ID 忽略）
+            send_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            if self.interface_ip != "0.0.0.0":
+                send_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                     socket.inet_aton(self.interface_ip))
+        except OSError:
+            receive_sock.close()
+            send_sock.close()
+            raise
+        self.receive_sock = receive_sock
+        self.send_sock = send_sock
+        self.transport = "multicast"
+        self.destination = (self.group, self.MULTICAST_PORT)
+        rprint(f"[green]✓[/green] 频道 {self.channel} 使用组播 {self.group}:{self.MULTICAST_PORT}")
 
     def start(self, callback: Callable):
         """启动广播服务"""
         self.running = True
         self.receive_callback = callback
         
-        # 启动接收线程
+        # 启动接收线程与分发线程
         self.receive_thread = threading.Thread(target=self._receive_loop)
         self.receive_thread.daemon = True
         self.receive_thread.start()
+        self.dispatch_thread = threading.Thread(target=self._dispatch_loop)
+        self.dispatch_thread.daemon = True
+        self.dispatch_thread.start()
         
     def stop(self):
-        """停止广播服务"""
+        """停止广播服务（组播时先退出组播组，内核发送 IGMP Leave）"""
         self.running = False
+        if self.transport == "multicast":
+            try:
+                self.receive_sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, self._membership)
+            except OSError:
+                pass
         self.receive_sock.close()
         self.send_sock.close()
         
+    def _send(self, packet: bytes):
+        self.send_sock.sendto(packet, self.destination)
+        self._sent_metric.inc()
+
+    def _note_peer(self, peer, binary: Optional[bool] = None):
+        entry = self._peers.get(peer)
+        if entry is None:
+            entry = self._peers[peer] = [False, 0.0]
+        entry[1] = time.monotonic()
+        if binary is not None:
+            entry[0] = binary
+
+    def _expire_peers(self, now: float):
+        """丢弃超过 PEER_TIMEOUT 没有报文的对端及其用户名解码表"""
+        for peer, (_, last_seen) in list(self._peers.items()):
+            if now - last_seen > PEER_TIMEOUT:
+                self._peers.pop(peer, None)
+                self._decoders.pop(peer, None)
+
+    @property
+    def wire_format(self) -> str:
+        """频道中最近活跃的对端都支持二进制格式时使用二进制，否则使用 JSON
+
+        每个成员（包括只收不发的）每秒发送带能力位的心跳；旧版成员的心跳
+        能力位为 0，发过言的旧版成员因此会让频道保持 JSON。
+        """
+        self._expire_peers(time.monotonic())
+        peers = list(self._peers.values())
+        if peers and all(binary for binary, _ in peers):
+            return WIRE_FORMAT
+        return "json"
+
     def broadcast(self, message: dict):
-        """广播消息"""
+        """广播消息（超过单个数据报长度时自动分片）"""
         try:
-            data = json.dumps(message).encode('utf-8')
-            self.send_sock.sendto(data, ('<broadcast>', self.BROADCAST_PORT))
+            if self.wire_format == WIRE_FORMAT:
+                data = self._encoder.encode([message])
+            else:
+                data = json.dumps({**message, "formats": [WIRE_FORMAT]}).encode('utf-8')
+            for packet in self.sender.packets(data):
+                self._send(packet)
         except Exception as e:
             rprint(f"[red]广播消息失败: {e}[/red]")
-            
+
+    def _deliver(self, sender, payload: bytes, addr):
+        decoder = self._decoders.get(sender)
+        if decoder is None:
+            decoder = self._decoders[sender] = ChatDecoder()
+        messages, binary = decode_any(payload, decoder)
+        for message in messages:
+            self._note_peer(sender, binary or WIRE_FORMAT in message.get("formats", ()))
+            try:
+                self._dispatch_queue.put_nowait((message, addr))
+            except queue.Full:
+                self.dispatch_dropped += 1  # 回调处理不过来时丢弃新消息，不阻塞接收
+                self._dispatch_drop_metric.inc()
+        self.queue_depth_max = max(self.queue_depth_max, self._dispatch_queue.qsize())
+
+    def _handle_datagram(self, data: bytes, addr):
+        packet = parse_packet(data)
+        if packet is None:
+            # 旧版客户端直接发送的 JSON（只属于默认频道）
+            if self.channel == DEFAULT_CHANNEL and not is_binary(data):
+                self._deliver(("legacy", addr), data, addr)
+            return
+        if packet.channel != self.channel_id:
+            return  # 广播模式下同一端口上其他频道的报文
+        if packet.type == NACK:
+            if packet.target == self.sender_id:
+                for retransmit in self.sender.retransmit(packet.seqs):
+                    self._send(retransmit)
+            return
+        if packet.sender == self.sender_id:
+            return  # 自己发出的广播
+        if packet.type == HEARTBEAT:
+            self._note_peer(packet.sender, bool(packet.target & CAP_BINARY))
+        else:
+            self._note_peer(packet.sender)
+        for payload in self.receiver.on_packet(packet, time.monotonic()):
+            self._deliver(packet.sender, payload, addr)
+
+    def _tick(self):
+        """发送到期的 NACK 与心跳，并提示无法恢复的丢失消息"""
+        now = time.monotonic()
+        if now - self._last_tick < NACK_INTERVAL / 2:
+            return
+        self._last_tick = now
+        self._expire_peers(now)
+        nacks, messages = self.receiver.poll(now)
+        for sender, seqs in nacks:
+            self._send(pack_nack(self.channel_id, self.sender_id, sender, seqs))
+        for sender, payload in messages:
+            self._deliver(sender, payload, None)
+        if now - self._last_heartbeat >= HEARTBEAT_INTERVAL:
+            self._last_heartbeat = now
+            self._send(self.sender.heartbeat())
+        if self.receiver.lost > self._reported_lost:
+            rprint(f"[yellow]有 {self.receiver.lost - self._reported_lost} 个消息分片重传失败，部分消息已丢失[/yellow]")
+            self._reported_lost = self.receiver.lost
+        if self.dispatch_dropped > self._reported_dropped:
+            rprint(f"[yellow]消息显示不及，已跳过 {self.dispatch_dropped - self._reported_dropped} 条消息[/yellow]")
+            self._reported_dropped = self.dispatch_dropped
+
+    def stats(self) -> dict:
+        return {
+            "channel": self.channel,
+            "transport": self.transport,
+            "wire_format": self.wire_format,
+            "retransmitted": self.sender.retransmitted,
+            **self.receiver.stats(),
+            "receive_buffer": self.receive_buffer,
+            "kernel_drops": self.kernel_drops,
+            "datagrams": self.datagrams,
+            "datagrams_per_wakeup": round(self.datagrams / self.wakeups, 2) if self.wakeups else 0.0,
+            "queue_depth": self._dispatch_queue.qsize(),
+            "queue_depth_max": self.queue_depth_max,
+            "dispatch_dropped": self.dispatch_dropped,
+            "callback_avg_ms": round(self.callback_avg * 1000, 3),
+            "callback_max_ms": round(self.callback_max * 1000, 3),
+        }
+
+    def _recv(self):
+        if self.kernel_drops is None:
+            return self.receive_sock.recvfrom(self.MAX_DATAGRAM)
+        data, ancdata, _, addr = self.receive_sock.recvmsg(self.MAX_DATAGRAM, self._ancillary_size)
+        for level, kind, value in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(value) >= _DROP_COUNT.size:
+                drops = _DROP_COUNT.unpack_from(value)[0]
+                if drops > self.kernel_drops:
+                    self._kernel_drop_metric.inc(drops - self.kernel_drops)
+                self.kernel_drops = drops
+        return data, addr
+
+    def _read_batch(self):
+        """一次唤醒读取多个数据报，直到内核缓冲区读空或达到 RECEIVE_BATCH"""
+        for _ in range(RECEIVE_BATCH):
+            try:
+                data, addr = self._recv()
+            except (BlockingIOError, InterruptedError):
+                return
+            self.datagrams += 1
+            self._received_metric.inc()
+            try:
+                self._handle_datagram(data, addr)
+            except Exception as e:
+                rprint(f"[red]接收消息错误: {e}[/red]")
+
     def _receive_loop(self):
-        """接收消息循环"""
+        """接收消息循环（等待超时用于定期发送 NACK 与心跳）"""
+        selector = selectors.DefaultSelector()
+        selector.register(self.receive_sock, selectors.EVENT_READ)
+        try:
+            while self.running:
+                try:
+                    if selector.select(NACK_INTERVAL / 2):
+                        self.wakeups += 1
+                        self._read_batch()
+                except (OSError, ValueError) as e:
+                    if self.running:
+                        rprint(f"[red]接收消息错误: {e}[/red]")
+                    break
+                if self.running:
+                    try:
+                        self._tick()
+                    except Exception as e:
+                        rprint(f"[red]发送重传请求失败: {e}[/red]")
+        finally:
+            selector.close()
+
+    def _dispatch_loop(self):
+        """按接收顺序调用回调（单线程，保证同一发送者的消息按序显示）"""
         while self.running:
             try:
-                data, addr = self.receive_sock.recvfrom(4096)
-                message = json.loads(data.decode('utf-8'))
+                message, addr = self._dispatch_queue.get(timeout=NACK_INTERVAL)
+            except queue.Empty:
+                continue
+            started = time.perf_counter()
+            try:
                 if self.receive_callback:
                     self.receive_callback(message, addr)
             except Exception as e:
-                if self.running:
-                    rprint(f"[red]接收消息错误: {e}[/red]")
+                rprint(f"[red]处理消息错误: {e}[/red]")
+            elapsed = time.perf_counter() - started
+            self.callback_avg += (elapsed - self.callback_avg) * 0.05
+            self.callback_max = max(self.callback_max, elapsed)
+            self._callback_metric.observe(elapsed)
+
+class ChatConnection:
+    """聊天室中的一个 WebSocket 连接
+
+    每个连接有一个有界发送队列和独立的写任务。写任务每次把队列中积压的
+    消息合并成一个 JSON 数组帧发送（单条消息仍按对象发送），接收端越慢，
+    每帧合并的消息越多；队列满时丢弃最旧的消息，并在下一帧中提示丢弃数量。
+    协商使用二进制格式的连接合并成一个二进制帧，用户名在该连接上第一次
+    出现（或编号被重新分配给其他用户名）时才发送定义。
+    """
+
+    def __init__(self, websocket: WebSocket, hub: "ChatHub", binary: bool = False):
+        self.websocket = websocket
+        self.hub = hub
+        self.binary = binary
+        self._defined: Dict[int, bytes] = {}  # 用户编号 -> 已向该连接发送的定义
+        self.queue = deque(maxlen=CHAT_QUEUE_SIZE)
+        self.dropped = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        """补发完历史消息后再开始发送，保证历史消息排在实时消息之前"""
+        self._task = asyncio.create_task(self._writer())
+        self._wakeup.set()
+
+    def prepend(self, texts):
+        self.queue.extendleft(reversed(texts))
+
+    def enqueue(self, item):
+        """item 为预先序列化的 JSON 文本，二进制连接为 ((用户编号, 用户定义), 消息记录)"""
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+            self.hub.dropped += 1
+            WS_DROPPED.inc()
+        self.queue.append(item)
+        self._wakeup.set()
+
+    def _next_frame(self):
+        batch = []
+        size = 0
+        if self.dropped:
+            batch.append(self.hub.encode(self, {"username": "system",
+                                                "message": f"网络较慢，已跳过 {self.dropped} 条消息"}))
+            self.dropped = 0
+        while self.queue and len(batch) < BATCH_MAX_MESSAGES and size < BATCH_MAX_BYTES:
+            item = self.queue.popleft()
+            batch.append(item)
+            size += len(item[1] if self.binary else item)
+        self.hub.frames_out += 1
+        self.hub.messages_out += len(batch)
+        WS_FRAMES.inc()
+        self.hub.messages_out_metric.inc(len(batch))
+        if self.binary:
+            parts = [HEADER]
+            for (user, define), record in batch:
+                if self._defined.get(user) != define:
+                    self._defined[user] = define
+                    parts.append(define)
+                parts.append(record)
+            return b"".join(parts)
+        if len(batch) == 1:
+            return batch[0]
+        # 消息已预先序列化，合并时只做字符串拼接
+        return "[" + ",".join(batch) + "]"
+
+    async def _writer(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self.queue:
+                    frame = self._next_frame()
+                    if self.binary:
+                        await self.websocket.send_bytes(frame)
+                    else:
+                        await self.websocket.send_text(frame)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self.hub.disconnect(self.websocket)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        self.queue.clear()
+
+
+class ChatHub:
+    """WebSocket 聊天室的消息分发中心
 
-broadcaster = MessageBroadcaster()
+    每条消息按每种格式（JSON/二进制）只序列化一次，分发时只向各连接的队列
+    追加同一个对象，由各连接的写任务并发发送，慢连接不会拖慢其他人。
+    二进制格式的用户名表由所有连接共用，编号用完时换一张新表，各连接
+    按消息携带的定义重新发送被重新分配的编号。
+    """
+
+    def __init__(self, history: Optional[ChatHistory] = None):
+        self.history = history
+        self.users = UsernameTable()
+        self._connections: Dict[WebSocket, ChatConnection] = {}
+        self.messages_in = 0
+        self.messages_out = 0
+        self.frames_out = 0
+        self.dropped = 0
+        self.messages_in_metric = WS_MESSAGES.labels("in")
+        self.messages_out_metric = WS_MESSAGES.labels("out")
+
+    def encode(self, connection: ChatConnection, data: dict):
+        if connection.binary:
+            name = str(data.get("username", "Unknown"))
+            try:
+                user = self.users.index(name)
+            except ValueError:
+                self.users = UsernameTable()
+                user = self.users.index(name)
+            record = pack_chat(user, str(data.get("message", "")), data.get("id", 0), data.get("ts", 0.0))
+            return (user, self.users.define(user)), record
+        return json.dumps(data, ensure_ascii=False)
+
+    async def connect(self, websocket: WebSocket, last_id: Optional[int] = None, binary: bool = False):
+        """接入新连接并补发历史消息
+
+        带 last_id 的重连只补发该 ID 之后的消息（索引范围查询），否则补发最近
+        REPLAY_RECENT 条。补发完成前到达的实时消息先留在队列中，排在历史消息之后。
+        二进制连接先收到一个空的二进制帧，表示服务端接受该格式。
+        """
+        await websocket.accept()
+        if binary:
+            await websocket.send_bytes(HEADER)
+        connection = self._connections[websocket] = ChatConnection(websocket, self, binary)
+        if self.history is not None:
+            upto = self.history.next_id
+            if last_id is None:
+                records = await run_io(self.history.page, WEB_CHANNEL, upto, REPLAY_RECENT)
+            else:
+                records = await run_io(self.history.since, WEB_CHANNEL, last_id, upto, CATCHUP_LIMIT)
+            if last_id is not None and len(records) == CATCHUP_LIMIT:
+                records.insert(0, {"username": "system",
+                                   "message": "离线期间消息较多，更早的消息请通过 /message/history 查看"})
+            connection.prepend([self.encode(connection, record) for record in records])
+        connection.start()
+
+    def disconnect(self, websocket: WebSocket):
+        connection = self._connections.pop(websocket, None)
+        if connection is not None:
+            connection.close()
+
+    async def broadcast(self, data: dict, sender: Optional[WebSocket] = None):
+        """把消息分发给除发送者外的所有连接（只入队，不等待发送）"""
+        self.messages_in += 1
+        self.messages_in_metric.inc()
+        if self.history is not None:
+            data = self.history.append(WEB_CHANNEL, data)
+        encoded = {}
+        for websocket, connection in self._connections.items():
+            if websocket is not sender:
+                item = encoded.get(connection.binary)
+                if item is None:
+                    item = encoded[connection.binary] = self.encode(connection, data)
+                connection.enqueue(item)
+
+    def stats(self) -> dict:
+        depths = [len(c.queue) for c in self._connections.values()]
+        return {
+            "connections": len(depths),
+            "binary_connections": sum(1 for c in self._connections.values() if c.binary),
+            "messages_in": self.messages_in,
+            "messages_out": self.messages_out,
+            "frames_out": self.frames_out,
+            "messages_per_frame": round(self.messages_out / self.frames_out, 2) if self.frames_out else 0.0,
+            "dropped": self.dropped,
+            "queue_depth_max": max(depths, default=0),
+        }
+
+
+# 聊天记录在服务启动时（或聊天客户端第一次使用时）由 open_history() 打开，
+# 导入本模块不会创建数据库文件
+history: Optional[ChatHistory] = None
+_history_lock = threading.Lock()
+chat_hub = ChatHub()
+
+
+def open_history(path: Optional[str] = None) -> ChatHistory:
+    """打开聊天记录数据库，已打开时直接返回（path 只在第一次调用时生效）"""
+    global history
+    with _history_lock:
+        if history is None:
+            history = ChatHistory(path or HISTORY_PATH)
+            chat_hub.history = history
+        return history
+
+
+def close_history():
+    global history
+    with _history_lock:
+        if history is not None:
+            chat_hub.history = None
+            history.close()
+            history = None
+
+
+registry.gauge("lanchat_chat_ws_connections", "WebSocket 聊天室连接数",
+               fn=lambda: len(chat_hub._connections))
+
+@app.get("/stats")
+async def chat_stats():
+    """聊天室连接数、合并发送与丢弃统计"""
+    return {**chat_hub.stats(), "history": open_history().stats()}
+
+@app.get("/history")
+def get_history(before: Optional[int] = None, limit: int = 50, channel: str = WEB_CHANNEL):
+    """向前翻页：返回 ID 小于 before 的最近 limit 条消息，next_before 用于请求上一页"""
+    messages = open_history().page(channel, before, limit)
+    return {"messages": messages, "next_before": messages[0]["id"] if messages else None}
+
+@app.get("/history/search")
+def search_history(q: str, limit: int = 50, channel: str = WEB_CHANNEL):
+    """全文搜索聊天记录（从新到旧）"""
+    return {"messages": open_history().search(channel, q, limit)}
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await broadcaster.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, last_id: Optional[int] = None, format: Optional[str] = None):
+    """format=bin1 时使用二进制格式收发，否则使用 JSON"""
+    await chat_hub.connect(websocket, last_id, WIRE_FORMAT in parse_formats(format))
+    decoder = ChatDecoder()
     try:
         while True:
-            data = await websocket.receive_json()
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            payload = message.get("bytes")
+            try:
+                records, _ = decode_any(payload if payload is not None else message.get("text"), decoder)
+            except ValueError:
+                continue
             # 广播接收到的消息
-            await broadcaster.broadcast(data, websocket)
+            for data in records:
+                if isinstance(data, dict):
+                    await chat_hub.broadcast(data, websocket)
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
         print(f"WebSocket连接错误: {e}")
     finally:
-        broadcaster.disconnect(websocket)
+        chat_hub.disconnect(websocket)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000)
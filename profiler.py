@@ -0,0 +1,284 @@
+import asyncio
+import contextvars
+import os
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import PlainTextResponse
+
+from metrics import registry
+
+router = APIRouter()
+
+# 采样间隔（秒）与单次采样的最长时长、最大栈深度
+SAMPLE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 120
+MAX_STACK_DEPTH = 128
+# 事件循环被单个回调占用超过该时间（秒）即记录调用栈，可用环境变量 LANCHAT_SLOW_CALLBACK 调整
+SLOW_CALLBACK_THRESHOLD = float(os.environ.get("LANCHAT_SLOW_CALLBACK", "0.1"))
+SLOW_EVENTS = 100
+SLOW_STACK_FRAMES = 12
+# 请求追踪默认关闭，LANCHAT_TRACE=1 或 main.py 的 --trace 参数开启；保留最近的 span 数量
+TRACE_ENABLED = os.environ.get("LANCHAT_TRACE", "") not in ("", "0")
+TRACE_SPANS = 1000
+
+LOOP_LAG = registry.histogram("lanchat_loop_lag_seconds", "事件循环心跳比预定时间晚到的时长（秒）")
+SLOW_CALLBACKS = registry.counter("lanchat_slow_callbacks_total", "事件循环被单个回调占用超过阈值的次数")
+
+
+class SamplingProfiler:
+    """采样分析器：后台线程按固定间隔读取所有线程的调用栈（sys._current_frames）
+
+    被分析的代码不需要插桩，开销只与采样频率和栈深度有关。统计的是墙钟时间，
+    阻塞在 select/recv 上的空闲线程也会出现在结果中。结果为折叠栈格式
+    （每行 "线程;外层函数;...;内层函数 次数"），可直接交给 flamegraph.pl 或 speedscope。
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._labels: Dict[object, str] = {}
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            name = getattr(code, "co_qualname", code.co_name)
+            label = f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            label = self._labels[code] = label.replace(";", ":")
+        return label
+
+    def _sample(self, own_ident: int, thread_names: Dict[int, str]):
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(thread_names.get(ident, f"thread-{ident}").replace(";", ":"))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self, seconds: float) -> "SamplingProfiler":
+        own_ident = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        next_sample = time.monotonic()
+        thread_names: Dict[int, str] = {}
+        while time.monotonic() < deadline:
+            if self.samples % 100 == 0:
+                thread_names = {t.ident: t.name for t in threading.enumerate()}
+            self._sample(own_ident, thread_names)
+            next_sample += self.interval
+            delay = next_sample - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_sample = time.monotonic()  # 采样本身跟不上时不补采
+        return self
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+_profile_lock = threading.Lock()
+
+
+def profile(seconds: float, interval: float = SAMPLE_INTERVAL) -> SamplingProfiler:
+    """阻塞采样 seconds 秒（同一时间只允许一次采样），返回分析器"""
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("已有采样正在进行")
+    try:
+        return SamplingProfiler(interval).run(min(seconds, MAX_PROFILE_SECONDS))
+    finally:
+        _profile_lock.release()
+
+
+class LoopWatchdog:
+    """事件循环卡顿检测
+
+    事件循环每隔 threshold/2 更新一次心跳；监视线程发现心跳超过 threshold 没有
+    更新时，说明某个回调正占着事件循环，立即抓取事件循环线程的调用栈，即可看到
+    是哪个处理函数在阻塞。心跳恢复后补记实际阻塞时长。asyncio 的 debug 模式
+    也能报告慢回调，但开销大，且只在回调结束后给出回调对象。
+    """
+
+    def __init__(self, threshold: float = SLOW_CALLBACK_THRESHOLD):
+        self.threshold = threshold
+        self.events: deque = deque(maxlen=SLOW_EVENTS)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._beat = 0.0
+        self._pending: Optional[dict] = None
+        self._running = False
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        if self._running:
+            return
+        self._loop = loop
+        self._running = True
+        loop.call_soon_threadsafe(self._heartbeat, None)
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._running = False
+
+    def _heartbeat(self, expected: Optional[float]):
+        now = time.monotonic()
+        if expected is not None:
+            lag = max(0.0, now - expected)
+            LOOP_LAG.observe(lag)
+            event = self._pending
+            if event is not None:
+                self._pending = None
+                event["blocked_ms"] = round(lag * 1000, 1)
+                print(f"[SLOW] 事件循环恢复，共阻塞 {event['blocked_ms']} ms")
+        self._loop_thread = threading.get_ident()
+        self._beat = now
+        if self._running:
+            interval = self.threshold / 2
+            self._loop.call_later(interval, self._heartbeat, now + interval)
+
+    def _watch(self):
+        reported = None
+        while self._running:
+            time.sleep(self.threshold / 4)
+            beat = self._beat
+            stalled = time.monotonic() - beat - self.threshold / 2
+            if stalled < self.threshold or beat == reported or self._loop_thread is None:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = [line.rstrip() for line in traceback.format_stack(frame)] if frame else []
+            event = {"ts": time.time(), "blocked_ms": round(stalled * 1000, 1),
+                     "stack": stack[-SLOW_STACK_FRAMES:]}
+            self.events.append(event)
+            self._pending = event
+            SLOW_CALLBACKS.inc()
+            print(f"[SLOW] 事件循环已被占用 {event['blocked_ms']} ms，当前调用栈:\n" + "\n".join(event["stack"]))
+
+
+class Tracer:
+    """请求追踪：每个 HTTP 请求 / WebSocket 会话一个 span
+
+    span 按子应用（路径第一段：message/file/voice/discovery）分类，记录状态码、
+    首字节时间与总耗时；请求内用 span(name) 包住的阶段（如磁盘 I/O）累计到
+    phases 中。关闭时中间件和 span() 都只多一次判断。
+    """
+
+    def __init__(self, enabled: bool = TRACE_ENABLED):
+        self.enabled = enabled
+        self.spans: deque = deque(maxlen=TRACE_SPANS)
+        self._current: contextvars.ContextVar = contextvars.ContextVar("lanchat_span", default=None)
+
+    def begin(self, scope):
+        """创建 span 并设为当前请求的 span，返回 (span, 用于 end() 恢复的令牌)"""
+        path = scope.get("path", "")
+        span = {
+            "id": uuid.uuid4().hex[:16],
+            "app": path.strip("/").split("/", 1)[0] or "main",
+            "type": scope["type"],
+            "method": scope.get("method", "WS"),
+            "path": path,
+            "start": time.time(),
+            "status": None,
+            "phases": {},
+        }
+        return span, self._current.set(span)
+
+    def end(self, span: dict, token, duration: float):
+        self._current.reset(token)
+        span["duration_ms"] = round(duration * 1000, 3)
+        self.spans.append(span)
+
+    @contextmanager
+    def span(self, name: str):
+        """把一段代码的耗时累计到当前请求的 span（没有开启追踪或不在请求中时不记录）"""
+        current = self._current.get() if self.enabled else None
+        if current is None:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            phase = current["phases"].setdefault(name, {"count": 0, "ms": 0.0})
+            phase["count"] += 1
+            phase["ms"] = round(phase["ms"] + (time.perf_counter() - started) * 1000, 3)
+
+    def recent(self, limit: int = 100, app: Optional[str] = None) -> List[dict]:
+        spans = [span for span in list(self.spans) if app is None or span["app"] == app]
+        return spans[-limit:][::-1]
+
+
+class TraceMiddleware:
+    """ASGI 中间件，加在 main_app 上即可覆盖所有挂载的子应用"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not tracer.enabled or scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        span, token = tracer.begin(scope)
+        started = time.perf_counter()
+
+        async def traced_send(message):
+            if message["type"] == "http.response.start":
+                span["status"] = message["status"]
+                span["first_byte_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            elif message["type"] == "websocket.accept":
+                span["status"] = 101
+            elif message["type"] == "websocket.close" and span["status"] is None:
+                span["status"] = 403
+            await send(message)
+
+        try:
+            await self.app(scope, receive, traced_send)
+        except Exception as e:
+            span["error"] = repr(e)
+            raise
+        finally:
+            tracer.end(span, token, time.perf_counter() - started)
+
+
+watchdog = LoopWatchdog()
+tracer = Tracer()
+
+
+@router.get("")
+async def run_profile(seconds: float = 10.0, interval: float = SAMPLE_INTERVAL):
+    """对所有线程采样 seconds 秒，返回折叠栈（flamegraph.pl / speedscope 可直接读取）"""
+    if not 0 < seconds <= MAX_PROFILE_SECONDS or interval < 0.001:
+        raise HTTPException(status_code=400, detail=f"seconds 须在 0~{MAX_PROFILE_SECONDS} 之间，interval 不小于 0.001")
+    try:
+        profiler = await asyncio.to_thread(profile, seconds, interval)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(profiler.collapsed(), headers={"x-profile-samples": str(profiler.samples)})
+
+
+@router.get("/slow")
+async def slow_callbacks():
+    """最近占用事件循环超过阈值的回调及其调用栈"""
+    return {"threshold_ms": round(watchdog.threshold * 1000, 1), "events": list(watchdog.events)[::-1]}
+
+
+@router.get("/trace")
+async def get_trace(limit: int = 100, app: Optional[str] = None):
+    """最近的请求 span（从新到旧），app 可按子应用过滤"""
+    return {"enabled": tracer.enabled, "spans": tracer.recent(limit, app)}
+
+
+@router.post("/trace")
+async def set_trace(enabled: bool):
+    """运行时开启或关闭请求追踪"""
+    tracer.enabled = enabled
+    return {"enabled": tracer.enabled}
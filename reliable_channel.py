@@ -0,0 +1,280 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# 可靠广播通道的报文格式（频道ID 用于在共享端口上区分不同频道）：
+#   DATA      魔数 | 版本 | 类型 | 频道ID | 发送者ID | 序列号 | 消息ID | 分片序号 | 分片总数 | 数据
+#   NACK      魔数 | 版本 | 类型 | 频道ID | 请求者ID | 目标发送者ID | 个数 | 序列号列表
+#   HEARTBEAT 魔数 | 版本 | 类型 | 频道ID | 发送者ID | 能力位 | 最新序列号
+# 序列号从 1 开始，还没有发送过数据的成员心跳中的序列号为 0；旧版发送者的能力位为 0。
+MAGIC = b"LC"
+VERSION = 1
+DATA = 1
+NACK = 2
+HEARTBEAT = 3
+
+_DATA = struct.Struct("!2sBBIQIIHH")
+_CONTROL = struct.Struct("!2sBBIQQI")
+_SEQ = struct.Struct("!I")
+
+# 单个分片的数据长度（低于以太网 MTU，避免 IP 分片）
+MAX_FRAGMENT = 1200
+MAX_MESSAGE_SIZE = 256 * 1024
+# 发送窗口：保留最近发送的分片用于重传
+SEND_WINDOW = 1024
+# 缺失的分片每隔 NACK_INTERVAL 秒请求一次，最多 MAX_NACKS 次后放弃
+NACK_INTERVAL = 0.2
+MAX_NACKS = 5
+MAX_NACK_SEQS = 128
+# 发现缺口后等待 REORDER_DELAY 秒再发出首个 NACK，给乱序到达的分片留出时间
+REORDER_DELAY = 0.02
+# 同一分片重传的最小间隔（多个接收者同时请求时只重传一次）
+RETRANSMIT_HOLDOFF = 0.05
+# 每隔 HEARTBEAT_INTERVAL 秒广播最新序列号与能力位，接收者据此发现末尾丢包，
+# 只收不发的成员也能被其他成员看到
+HEARTBEAT_INTERVAL = 1.0
+# 去重记录的消息数
+DEDUP_SIZE = 4096
+# 超过该时间没有收到某个发送者的任何报文（在线的发送者每秒都有心跳）即丢弃其接收状态
+SENDER_TIMEOUT = 5.0
+
+
+class Packet(NamedTuple):
+    type: int
+    channel: int
+    sender: int
+    seq: int = 0
+    msg_id: int = 0
+    frag_index: int = 0
+    frag_count: int = 1
+    payload: bytes = b""
+    target: int = 0
+    seqs: Tuple[int, ...] = ()
+
+
+def new_sender_id() -> int:
+    return int.from_bytes(os.urandom(8), "big")
+
+
+def channel_id(name: str) -> int:
+    return zlib.crc32(name.encode("utf-8"))
+
+
+def parse_packet(data: bytes) -> Optional[Packet]:
+    """解析报文，不是本协议的数据（如旧版客户端的 JSON）时返回 None"""
+    if len(data) < 4 or data[:2] != MAGIC or data[2] != VERSION:
+        return None
+    try:
+        if data[3] == DATA:
+            _, _, _, channel, sender, seq, msg_id, index, count = _DATA.unpack_from(data)
+            return Packet(DATA, channel, sender, seq, msg_id, index, count, bytes(data[_DATA.size:]))
+        _, _, kind, channel, sender, target, value = _CONTROL.unpack_from(data)
+        if kind == HEARTBEAT:
+            return Packet(HEARTBEAT, channel, sender, seq=value, target=target)
+        if kind == NACK:
+            seqs = tuple(_SEQ.unpack_from(data, _CONTROL.size + i * 4)[0] for i in range(value))
+            return Packet(NACK, channel, sender, target=target, seqs=seqs)
+    except struct.error:
+        return None
+    return None
+
+
+def pack_nack(channel: int, sender: int, target: int, seqs: List[int]) -> bytes:
+    seqs = seqs[:MAX_NACK_SEQS]
+    return (_CONTROL.pack(MAGIC, VERSION, NACK, channel, sender, target, len(seqs))
+            + b"".join(_SEQ.pack(s) for s in seqs))
+
+
+class ReliableSender:
+    """发送端：分配序列号、切分大消息，并在有界窗口中保留分片以便重传
+
+    capabilities 为心跳中携带的能力位（含义由上层协议定义）。
+    """
+
+    def __init__(self, sender_id: int, channel: int = 0, capabilities: int = 0):
+        self.sender_id = sender_id
+        self.channel = channel
+        self.capabilities = capabilities
+        self.next_seq = 1
+        self.next_msg_id = 0
+        self.last_send = 0.0
+        self.retransmitted = 0
+        self._window: "OrderedDict[int, bytes]" = OrderedDict()
+        self._last_retransmit: Dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    def packets(self, payload: bytes) -> List[bytes]:
+        """把一条消息切成若干 DATA 分片"""
+        if len(payload) > MAX_MESSAGE_SIZE:
+            raise ValueError(f"消息过大: {len(payload)} 字节（上限 {MAX_MESSAGE_SIZE}）")
+        pieces = [payload[i:i + MAX_FRAGMENT] for i in range(0, len(payload), MAX_FRAGMENT)] or [b""]
+        with self._lock:
+            msg_id = self.next_msg_id
+            self.next_msg_id = (self.next_msg_id + 1) & 0xFFFFFFFF
+            packets = []
+            for index, piece in enumerate(pieces):
+                packet = _DATA.pack(MAGIC, VERSION, DATA, self.channel, self.sender_id,
+                                    self.next_seq, msg_id, index, len(pieces)) + piece
+                self._window[self.next_seq] = packet
+                self.next_seq += 1
+                packets.append(packet)
+            while len(self._window) > SEND_WINDOW:
+                seq, _ = self._window.popitem(last=False)
+                self._last_retransmit.pop(seq, None)
+            self.last_send = time.monotonic()
+        return packets
+
+    def retransmit(self, seqs) -> List[bytes]:
+        """响应 NACK：返回仍在窗口中、且最近没有重传过的分片"""
+        now = time.monotonic()
+        packets = []
+        with self._lock:
+            for seq in seqs:
+                packet = self._window.get(seq)
+                if packet is None or now - self._last_retransmit.get(seq, 0.0) < RETRANSMIT_HOLDOFF:
+                    continue
+                self._last_retransmit[seq] = now
+                packets.append(packet)
+        self.retransmitted += len(packets)
+        return packets
+
+    def heartbeat(self) -> bytes:
+        """心跳报文：最新序列号（未发送过数据时为 0）与能力位"""
+        with self._lock:
+            return _CONTROL.pack(MAGIC, VERSION, HEARTBEAT, self.channel, self.sender_id,
+                                 self.capabilities, self.next_seq - 1)
+
+
+class _SenderState:
+    def __init__(self):
+        self.next_seq: Optional[int] = None
+        self.buffer: Dict[int, Packet] = {}
+        self.missing: Dict[int, list] = {}  # 序列号 -> [上次请求时间, 请求次数]
+        self.partial: List[bytes] = []
+        self.partial_msg_id: Optional[int] = None
+        self.last_seen = 0.0
+
+
+class ReliableReceiver:
+    """接收端：按发送者维护序列号，检测缺口并生成 NACK，按序交付、重组分片并去重"""
+
+    def __init__(self):
+        self._senders: Dict[int, _SenderState] = {}
+        self._delivered: "OrderedDict[Tuple[int, int], None]" = OrderedDict()
+        self.delivered = 0
+        self.duplicates = 0
+        self.nacks_sent = 0
+        self.lost = 0  # 重传失败而跳过的分片数
+        self.reassembled = 0
+
+    def on_packet(self, packet: Packet, now: float) -> List[bytes]:
+        """处理 DATA/HEARTBEAT，返回可以交付的完整消息"""
+        state = self._senders.get(packet.sender)
+        if state is None:
+            state = self._senders[packet.sender] = _SenderState()
+        state.last_seen = now
+
+        if packet.type == HEARTBEAT:
+            if state.next_seq is None:
+                state.next_seq = packet.seq + 1  # 新加入的接收者不补收历史消息
+            else:
+                self._note_missing(state, packet.seq + 1, now)
+            return self._drain(packet.sender, state, now)
+
+        if state.next_seq is None:
+            state.next_seq = packet.seq
+        if packet.seq < state.next_seq or packet.seq in state.buffer:
+            self.duplicates += 1
+            return []
+        self._note_missing(state, packet.seq, now)
+        state.missing.pop(packet.seq, None)
+        state.buffer[packet.seq] = packet
+        return self._drain(packet.sender, state, now)
+
+    def _note_missing(self, state: _SenderState, upto: int, now: float):
+        """[next_seq, upto) 中尚未收到的分片记为缺失"""
+        start = max(state.next_seq, max(state.missing, default=state.next_seq - 1) + 1)
+        for seq in range(start, min(upto, start + SEND_WINDOW)):
+            if seq not in state.buffer:
+                state.missing[seq] = [now - NACK_INTERVAL + REORDER_DELAY, 0]
+
+    def _drain(self, sender: int, state: _SenderState, now: float) -> List[bytes]:
+        messages = []
+        while True:
+            packet = state.buffer.pop(state.next_seq, None)
+            if packet is None:
+                entry = state.missing.get(state.next_seq)
+                if entry is None or entry[1] < MAX_NACKS or now - entry[0] < NACK_INTERVAL:
+                    break
+                # 多次请求仍未收到（已滑出发送窗口或发送者离线），跳过该分片
+                del state.missing[state.next_seq]
+                self.lost += 1
+                state.partial, state.partial_msg_id = [], None
+                state.next_seq += 1
+                continue
+            state.next_seq += 1
+            message = self._reassemble(state, packet)
+            if message is None:
+                continue
+            key = (sender, packet.msg_id)
+            if key in self._delivered:
+                self.duplicates += 1
+                continue
+            self._delivered[key] = None
+            if len(self._delivered) > DEDUP_SIZE:
+                self._delivered.popitem(last=False)
+            self.delivered += 1
+            messages.append(message)
+        return messages
+
+    def _reassemble(self, state: _SenderState, packet: Packet) -> Optional[bytes]:
+        if packet.frag_count == 1:
+            return packet.payload
+        if packet.frag_index == 0:
+            state.partial, state.partial_msg_id = [], packet.msg_id
+        elif packet.msg_id != state.partial_msg_id or len(state.partial) != packet.frag_index:
+            return None  # 前面的分片已丢失
+        state.partial.append(packet.payload)
+        if packet.frag_index + 1 < packet.frag_count:
+            return None
+        message = b"".join(state.partial)
+        state.partial, state.partial_msg_id = [], None
+        self.reassembled += 1
+        return message
+
+    def poll(self, now: float) -> Tuple[List[Tuple[int, List[int]]], List[Tuple[int, bytes]]]:
+        """定期调用：返回需要发送的 NACK [(发送者, 序列号列表)] 以及因放弃缺口而可以交付的消息 [(发送者, 消息)]
+
+        超过 SENDER_TIMEOUT 没有报文的发送者（已离开频道）同时被丢弃。
+        """
+        nacks, messages = [], []
+        for sender, state in list(self._senders.items()):
+            if now - state.last_seen > SENDER_TIMEOUT:
+                del self._senders[sender]
+                continue
+            due = []
+            for seq, entry in state.missing.items():
+                if entry[1] < MAX_NACKS and now - entry[0] >= NACK_INTERVAL:
+                    entry[0] = now
+                    entry[1] += 1
+                    due.append(seq)
+            if due:
+                self.nacks_sent += 1
+                nacks.append((sender, due))
+            messages.extend((sender, message) for message in self._drain(sender, state, now))
+        return nacks, messages
+
+    def stats(self) -> dict:
+        return {
+            "senders": len(self._senders),
+            "delivered": self.delivered,
+            "duplicates": self.duplicates,
+            "reassembled": self.reassembled,
+            "nacks_sent": self.nacks_sent,
+            "lost": self.lost,
+            "pending": sum(len(s.missing) for s in self._senders.values()),
+        }
@@ -0,0 +1,325 @@
+import asyncio
+import hmac
+import json
+import struct
+import time
+from typing import Callable, Dict, List, Optional
+
+from metrics import registry
+
+# 本机进程间的房间总线（127.0.0.1 上的 UDP 数据报）
+#   报文     类型 u8 | 节点号 u8 | 内容
+#   HELLO    工作进程 -> 主进程，JSON {"port": 服务端口, "token": 启动令牌}，兼作心跳
+#   PEERS    主进程 -> 所有节点，JSON {节点号: [总线地址, 总线端口, 服务端口]}
+#   MEMBERS  节点 -> 其他节点，JSON {房间: [本节点成员数, [各成员的编解码器列表]]}，0 人表示离开
+#   FRAME    节点 -> 房间成员所在的其他节点，房间名长度 u8 | 房间名 | 发送者 u32 | 音频帧
+# 节点 0 为主进程。数据报在本机几乎不会丢失，成员表仍定期全量同步，丢包或
+# 节点重启后自动恢复一致。
+# 主进程启动每个工作进程时生成一个随机令牌（经环境变量传给子进程），HELLO
+# 只接受主进程启动的节点号且令牌匹配的报文；在线节点的地址不能被改绑，除非
+# 已超过 NODE_TIMEOUT 或令牌已更换（工作进程被重启）。MEMBERS 与 FRAME 只接受
+# 节点表中的地址发来的报文，PEERS 只接受主进程发来的报文。总线只防止本机其他
+# 进程冒充节点，不加密也不防重放：能读取工作进程环境变量的同一用户进程仍可加入。
+BUS_HOST = "127.0.0.1"
+MSG_HELLO = 1
+MSG_PEERS = 2
+MSG_MEMBERS = 3
+MSG_FRAME = 4
+
+_HEAD = struct.Struct("!BB")
+_SENDER = struct.Struct("!I")
+
+HELLO_INTERVAL = 1.0
+SYNC_INTERVAL = 2.0
+MEMBER_TTL = SYNC_INTERVAL * 3
+NODE_TIMEOUT = 5.0       # 主进程超过该时间没收到工作进程的 HELLO 即视为下线
+ORPHAN_TIMEOUT = 10.0    # 工作进程超过该时间没收到主进程的 PEERS 即视为主进程已退出
+MAX_PAYLOAD = 60000      # 全量同步时每个报文内容的上限（UDP 数据报最大 65507 字节）
+
+BUS_FRAMES = registry.counter("lanchat_bus_frames_total", "经进程间总线转发的音频帧数", ["direction"])
+_FRAMES_OUT = BUS_FRAMES.labels("out")
+_FRAMES_IN = BUS_FRAMES.labels("in")
+
+
+class RoomBus(asyncio.DatagramProtocol):
+    """进程间房间总线：同步各节点的房间成员，并把音频帧转发给同一房间的其他节点
+
+    supervisor 为主进程的总线地址，主进程自己传 None。on_frame(房间, 节点, 发送者, 帧)
+    在收到其他节点转发的帧时调用，on_members(房间) 在其他节点的成员变化时调用，
+    on_orphaned() 在工作进程与主进程失联时调用。所有回调都在事件循环中执行。
+    工作进程的 token 为主进程分配的启动令牌；主进程在 tokens 中登记每个节点号的令牌。
+    """
+
+    def __init__(self, node: int, supervisor: Optional[tuple] = None, service_port: Optional[int] = None,
+                 token: str = ""):
+        self.node = node
+        self.supervisor = supervisor
+        self.service_port = service_port
+        self.token = token
+        self.tokens: Dict[int, str] = {}      # 主进程：节点号 -> 当前令牌
+        self._bound_tokens: Dict[int, str] = {}
+        self.on_frame: Optional[Callable] = None
+        self.on_members: Optional[Callable[[str], None]] = None
+        self.on_orphaned: Optional[Callable[[], None]] = None
+        self.transport = None
+        self.peers: Dict[int, tuple] = {}     # 节点号 -> 总线地址
+        self.ports: Dict[int, int] = {}       # 节点号 -> 服务端口
+        self._last_hello: Dict[int, float] = {}
+        self._last_peers = time.monotonic()
+        self._local: Dict[str, list] = {}                # 房间 -> [成员数, 编解码器列表]
+        self._remote: Dict[str, Dict[int, list]] = {}    # 房间 -> 节点号 -> [成员数, 编解码器列表, 更新时间]
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_supervisor(self) -> bool:
+        return self.supervisor is None
+
+    async def start(self, sock=None):
+        loop = asyncio.get_running_loop()
+        if sock is not None:
+            await loop.create_datagram_endpoint(lambda: self, sock=sock)
+        else:
+            await loop.create_datagram_endpoint(lambda: self, local_addr=(BUS_HOST, 0))
+        if self.is_supervisor:
+            self.peers[self.node] = self.address
+            self.ports[self.node] = self.service_port
+        else:
+            self._hello()
+        self._task = asyncio.create_task(self._maintain())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self.transport is not None:
+            self.transport.close()
+
+    @property
+    def address(self) -> tuple:
+        return self.transport.get_extra_info("sockname")[:2]
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def _send(self, kind: int, body, addr):
+        payload = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        try:
+            self.transport.sendto(_HEAD.pack(kind, self.node) + payload, addr)
+        except OSError:
+            pass
+
+    def _hello(self):
+        self._send(MSG_HELLO, {"port": self.service_port, "token": self.token}, self.supervisor)
+
+    def _others(self):
+        return [(node, addr) for node, addr in list(self.peers.items()) if node != self.node]
+
+    # ---- 成员表 ----
+
+    def set_members(self, room_id: str, count: int, offers: List[List[str]]):
+        """更新本节点某房间的成员数与编解码器，并通知其他节点"""
+        if count:
+            self._local[room_id] = [count, offers]
+        else:
+            self._local.pop(room_id, None)
+        for _, addr in self._others():
+            self._send(MSG_MEMBERS, {room_id: [count, offers]}, addr)
+
+    def _sync_to(self, addr):
+        """按编码后的长度分批发送本节点的全部房间，每个报文不超过 MAX_PAYLOAD"""
+        batch, size = [], 1
+        for room_id, entry in list(self._local.items()):
+            item = (json.dumps(room_id) + ":" + json.dumps(entry)).encode("utf-8")
+            if len(item) + 2 > MAX_PAYLOAD:
+                print(f"[BUS] 房间 {room_id} 的成员信息过大，无法同步")
+                continue
+            if batch and size + len(item) + 1 > MAX_PAYLOAD:
+                self._send(MSG_MEMBERS, b"{" + b",".join(batch) + b"}", addr)
+                batch, size = [], 1
+            batch.append(item)
+            size += len(item) + 1  # 加上逗号或右括号
+        if batch:
+            self._send(MSG_MEMBERS, b"{" + b",".join(batch) + b"}", addr)
+
+    def _update_members(self, node: int, rooms: dict):
+        now = time.monotonic()
+        for room_id, (count, offers) in rooms.items():
+            entries = self._remote.get(room_id)
+            previous = entries.get(node) if entries else None
+            if count:
+                if entries is None:
+                    entries = self._remote[room_id] = {}
+                entries[node] = [count, offers, now]
+            elif previous is not None:
+                del entries[node]
+                if not entries:
+                    del self._remote[room_id]
+            before = (previous[0], previous[1]) if previous else (0, None)
+            after = (count, offers) if count else (0, None)
+            if before != after and self.on_members is not None:
+                self.on_members(room_id)
+
+    def _forget_node(self, node: int):
+        for room_id in [room_id for room_id, entries in self._remote.items() if node in entries]:
+            self._update_members(node, {room_id: [0, []]})
+
+    def remote_offers(self, room_id: str) -> List[List[str]]:
+        """其他节点上该房间各成员的编解码器列表（用于全房间统一协商）"""
+        offers = []
+        for entry in self._remote.get(room_id, {}).values():
+            offers.extend(entry[1])
+        return offers
+
+    def room_members(self, room_id: str) -> Dict[int, int]:
+        """该房间在各节点上的成员数"""
+        members = {node: entry[0] for node, entry in self._remote.get(room_id, {}).items()}
+        if room_id in self._local:
+            members[self.node] = self._local[room_id][0]
+        return members
+
+    def node_load(self) -> Dict[int, int]:
+        """各节点的语音成员总数"""
+        load = {node: 0 for node in self.peers}
+        for entries in self._remote.values():
+            for node, entry in entries.items():
+                load[node] = load.get(node, 0) + entry[0]
+        load[self.node] = sum(entry[0] for entry in self._local.values())
+        return load
+
+    # ---- 音频帧 ----
+
+    def forward(self, room_id: str, sender: int, frame: bytes):
+        """把本节点成员发出的帧转发给该房间有成员的其他节点（房间只在本节点时无开销）"""
+        entries = self._remote.get(room_id)
+        if not entries:
+            return
+        room = room_id.encode("utf-8")
+        if len(room) > 255:
+            return
+        packet = None
+        for node in entries:
+            addr = self.peers.get(node)
+            if addr is None:
+                continue
+            if packet is None:
+                packet = b"".join((_HEAD.pack(MSG_FRAME, self.node), bytes((len(room),)), room,
+                                   _SENDER.pack(sender & 0xFFFFFFFF), frame))
+            self.transport.sendto(packet, addr)
+            _FRAMES_OUT.inc()
+
+    def _handle_frame(self, node: int, data: bytes):
+        length = data[2]
+        offset = 3 + length
+        if len(data) < offset + _SENDER.size:
+            return
+        room_id = data[3:offset].decode("utf-8", "replace")
+        sender = _SENDER.unpack_from(data, offset)[0]
+        _FRAMES_IN.inc()
+        if self.on_frame is not None:
+            self.on_frame(room_id, node, sender, data[offset + _SENDER.size:])
+
+    # ---- 节点表 ----
+
+    def datagram_received(self, data: bytes, addr):
+        if len(data) < _HEAD.size:
+            return
+        kind, node = _HEAD.unpack_from(data)
+        if node == self.node:
+            return
+        if kind in (MSG_FRAME, MSG_MEMBERS) and self.peers.get(node) != addr[:2]:
+            return  # 不在节点表中的地址（包括本机其他进程伪造的报文）
+        if kind == MSG_PEERS and addr[:2] != self.supervisor:
+            return
+        if kind == MSG_FRAME:
+            if len(data) > 3:
+                self._handle_frame(node, data)
+            return
+        try:
+            body = json.loads(data[_HEAD.size:])
+        except ValueError:
+            return
+        if kind == MSG_MEMBERS:
+            self._update_members(node, body)
+        elif kind == MSG_HELLO and self.is_supervisor:
+            self._handle_hello(node, body, addr)
+        elif kind == MSG_PEERS and not self.is_supervisor:
+            self._last_peers = time.monotonic()
+            peers = {int(key): (value[0], value[1]) for key, value in body.items()}
+            for old in set(self.peers) - set(peers):
+                self._forget_node(old)
+            for new, new_addr in peers.items():
+                if new != self.node and self.peers.get(new) != new_addr:
+                    self._forget_node(new)
+                    self._sync_to(new_addr)
+            self.peers = peers
+            self.ports = {int(key): value[2] for key, value in body.items()}
+
+    def _handle_hello(self, node: int, body, addr):
+        token = self.tokens.get(node)
+        if token is None or not isinstance(body, dict) or \
+                not hmac.compare_digest(str(body.get("token", "")).encode(), token.encode()):
+            return  # 不是主进程启动的节点，或令牌不匹配
+        now = time.monotonic()
+        if self.peers.get(node, addr) != addr and self._bound_tokens.get(node) == token \
+                and now - self._last_hello.get(node, 0.0) <= NODE_TIMEOUT:
+            return  # 在线节点不能被改绑到其他地址
+        self._last_hello[node] = now
+        if self.peers.get(node) != addr or self.ports.get(node) != body.get("port"):
+            # 新节点或重启后的节点：清掉旧的成员记录，通知所有节点
+            self._forget_node(node)
+            self.peers[node] = addr
+            self.ports[node] = body.get("port")
+            self._bound_tokens[node] = token
+            self._publish_peers()
+            self._sync_to(addr)
+
+    def _publish_peers(self):
+        body = {node: [addr[0], addr[1], self.ports.get(node)] for node, addr in self.peers.items()}
+        for _, addr in self._others():
+            self._send(MSG_PEERS, body, addr)
+
+    async def _maintain(self):
+        last_sync = time.monotonic()
+        while True:
+            await asyncio.sleep(HELLO_INTERVAL)
+            try:
+                last_sync = self._tick(last_sync)
+            except Exception as e:
+                print(f"[BUS] 节点 {self.node} 维护失败: {e}")
+
+    def _tick(self, last_sync: float) -> float:
+        now = time.monotonic()
+        if self.is_supervisor:
+            for node, seen in list(self._last_hello.items()):
+                if now - seen > NODE_TIMEOUT:
+                    del self._last_hello[node]
+                    self._bound_tokens.pop(node, None)
+                    self.peers.pop(node, None)
+                    self.ports.pop(node, None)
+                    self._forget_node(node)
+            self._publish_peers()  # 兼作主进程的心跳
+        else:
+            self._hello()
+            if now - self._last_peers > ORPHAN_TIMEOUT and self.on_orphaned is not None:
+                self.on_orphaned()
+        if now - last_sync >= SYNC_INTERVAL:
+            last_sync = now
+            for _, addr in self._others():
+                self._sync_to(addr)
+            self._expire(now)
+        return last_sync
+
+    def _expire(self, now: float):
+        """丢弃超过 MEMBER_TTL 没有被全量同步刷新的成员记录（对应节点可能已退出）"""
+        for room_id, entries in list(self._remote.items()):
+            for node, entry in list(entries.items()):
+                if now - entry[2] > MEMBER_TTL:
+                    self._update_members(node, {room_id: [0, []]})
+
+    def stats(self) -> dict:
+        return {
+            "node": self.node,
+            "peers": sorted(self.peers),
+            "load": self.node_load(),
+            "rooms_local": len(self._local),
+            "rooms_shared": sum(1 for room_id in self._local if room_id in self._remote),
+        }
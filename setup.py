@@ -8,7 +8,7 @@ setup(
         "fastapi>=0.68.0",
         "uvicorn>=0.15.0",
         "python-multipart>=0.0.5",
-        "zeroconf>=0.38.0",
+        "zeroconf>=0.39.0",
         "aiofiles>=0.8.0",
         "websockets>=10.0",
         "requests>=2.31.0",  # Add this
@@ -0,0 +1,251 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_PIECE_SIZE = 4 * 1024 * 1024  # 4MB
+PEER_SLOTS = 2          # 每个对端同时进行的分片请求数
+MAX_PEER_FAILURES = 3   # 校验失败/请求失败达到该次数后不再使用该对端
+THROUGHPUT_ALPHA = 0.3  # 吞吐量指数滑动平均系数
+REQUEST_TIMEOUT = 30
+
+
+def hash_pieces(path: str, piece_size: int) -> List[str]:
+    """计算文件各分片的 SHA-256"""
+    pieces = []
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(piece_size)
+            if not data and pieces:
+                break
+            pieces.append(hashlib.sha256(data).hexdigest())
+            if len(data) < piece_size:
+                break
+    return pieces
+
+
+def root_hash(pieces: List[str]) -> str:
+    """分片哈希列表的根哈希，内容相同的文件根哈希相同"""
+    return hashlib.sha256("".join(pieces).encode("ascii")).hexdigest()
+
+
+class SwarmPeer:
+    """参与下载的对端及其测得的吞吐量"""
+
+    def __init__(self, ip: str, port: int):
+        self.ip = ip
+        self.port = port
+        self.base_url = f"http://{ip}:{port}/file"
+        self.throughput = 0.0  # bytes/s，0 表示尚未测量
+        self.failures = 0
+        self.bytes_received = 0
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=PEER_SLOTS))
+
+    @property
+    def alive(self) -> bool:
+        return self.failures < MAX_PEER_FAILURES
+
+    def record(self, nbytes: int, elapsed: float):
+        rate = nbytes / max(elapsed, 1e-6)
+        if self.throughput:
+            self.throughput = THROUGHPUT_ALPHA * rate + (1 - THROUGHPUT_ALPHA) * self.throughput
+        else:
+            self.throughput = rate
+        self.bytes_received += nbytes
+
+    def __repr__(self):
+        return f"{self.ip}:{self.port}"
+
+
+class SwarmDownloader:
+    """从多个对端并行下载同一文件
+
+    文件按分片内容寻址（SHA-256），只向分片清单根哈希一致的对端请求数据。
+    每个分片下载后校验哈希，失败则换对端重试；较慢的对端在剩余分片不多时
+    让出分片给较快的对端，最后阶段空闲的快速对端会重复请求仍在传输的分片。
+    """
+
+    def __init__(self, filename: str, peers: List[tuple], dest_path: str,
+                 piece_size: int = DEFAULT_PIECE_SIZE):
+        self.filename = filename
+        self.dest_path = dest_path
+        self.part_path = dest_path + ".part"
+        self.piece_size = piece_size
+        self.peers = [SwarmPeer(ip, port) for ip, port in peers]
+        self.size = 0
+        self.pieces: List[str] = []
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._pending: List[int] = []
+        self._inflight: Dict[int, int] = {}  # 分片序号 -> 正在请求的对端数量
+        self._done: set = set()
+        self._file = None
+        self._on_progress: Optional[Callable[[int], None]] = None
+
+    def fetch_manifests(self) -> bool:
+        """向所有对端请求分片清单，保留持有多数版本的对端"""
+        def fetch(peer):
+            try:
+                resp = peer.session.get(
+                    f"{peer.base_url}/pieces/{self.filename}",
+                    params={"piece_size": self.piece_size},
+                    timeout=REQUEST_TIMEOUT
+                )
+                if resp.status_code == 200:
+                    return peer, resp.json()
+            except requests.RequestException:
+                pass
+            return peer, None
+
+        groups: Dict[str, list] = {}
+        with ThreadPoolExecutor(max_workers=max(1, len(self.peers))) as pool:
+            for peer, manifest in pool.map(fetch, self.peers):
+                if manifest and root_hash(manifest["pieces"]) == manifest["root"]:
+                    groups.setdefault(manifest["root"], []).append((peer, manifest))
+        if not groups:
+            return False
+
+        members = max(groups.values(), key=len)
+        manifest = members[0][1]
+        self.peers = [peer for peer, _ in members]
+        self.size = manifest["size"]
+        self.pieces = manifest["pieces"]
+        return True
+
+    def _piece_range(self, index: int) -> tuple:
+        start = index * self.piece_size
+        return start, min(start + self.piece_size, self.size)
+
+    def _verify_existing(self):
+        """校验已存在的 .part 文件中的分片，实现断点续传"""
+        if not os.path.exists(self.part_path) or os.path.getsize(self.part_path) != self.size:
+            with open(self.part_path, "wb") as f:
+                f.truncate(self.size)
+            return
+        with open(self.part_path, "rb") as f:
+            for index, expected in enumerate(self.pieces):
+                start, end = self._piece_range(index)
+                f.seek(start)
+                if hashlib.sha256(f.read(end - start)).hexdigest() == expected:
+                    self._done.add(index)
+
+    def _should_yield(self, peer: SwarmPeer) -> bool:
+        """按吞吐量加权：剩余分片不足以让慢速对端按时完成时，留给快速对端"""
+        fastest = max((p.throughput for p in self.peers if p.alive), default=0.0)
+        if not peer.throughput or not fastest or peer.throughput >= fastest:
+            return False
+        slowdown = fastest / peer.throughput
+        return len(self._pending) < slowdown * PEER_SLOTS
+
+    def _next_piece(self, peer: SwarmPeer) -> Optional[int]:
+        with self._lock:
+            if self._pending and not self._should_yield(peer):
+                index = self._pending.pop(0)
+                self._inflight[index] = self._inflight.get(index, 0) + 1
+                return index
+            if not self._pending and peer.throughput:
+                # 收尾阶段：重复请求仍在传输的分片，先完成者生效
+                for index, count in self._inflight.items():
+                    if count < 2:
+                        self._inflight[index] = count + 1
+                        return index
+            return None
+
+    def _finish_piece(self, index: int, ok: bool) -> bool:
+        with self._lock:
+            count = self._inflight.get(index, 1) - 1
+            if count > 0:
+                self._inflight[index] = count
+            else:
+                self._inflight.pop(index, None)
+            if index in self._done:
+                return False
+            if ok:
+                self._done.add(index)
+                return True
+            if count <= 0 and index not in self._pending:
+                self._pending.append(index)
+            return False
+
+    def _fail_piece(self, peer: SwarmPeer, index: int) -> bool:
+        # 同一对端有多个下载线程，计数在锁内更新
+        with self._lock:
+            peer.failures += 1
+        return self._finish_piece(index, False)
+
+    def _download_piece(self, peer: SwarmPeer, index: int) -> bool:
+        start, end = self._piece_range(index)
+        begin = time.monotonic()
+        try:
+            resp = peer.session.get(
+                f"{peer.base_url}/download/{self.filename}",
+                headers={"Range": f"bytes={start}-{end - 1}"},
+                timeout=REQUEST_TIMEOUT
+            )
+        except requests.RequestException:
+            return self._fail_piece(peer, index)
+
+        data = resp.content
+        if resp.status_code == 200 and start == 0 and end == self.size:
+            pass  # 空文件或单分片文件可能返回完整内容
+        elif resp.status_code != 206:
+            return self._fail_piece(peer, index)
+        if hashlib.sha256(data).hexdigest() != self.pieces[index]:
+            return self._fail_piece(peer, index)
+
+        with self._lock:
+            peer.record(len(data), time.monotonic() - begin)
+            duplicate = index in self._done
+        if not duplicate:
+            with self._file_lock:
+                self._file.seek(start)
+                self._file.write(data)
+        if not self._finish_piece(index, True):
+            return False
+        if self._on_progress:
+            self._on_progress(len(data))
+        return True
+
+    def _peer_worker(self, peer: SwarmPeer):
+        while peer.alive:
+            with self._lock:
+                if len(self._done) == len(self.pieces):
+                    return
+            index = self._next_piece(peer)
+            if index is None:
+                with self._lock:
+                    finished = not self._pending and not self._inflight
+                if finished:
+                    return
+                time.sleep(0.05)
+                continue
+            self._download_piece(peer, index)
+
+    def run(self, on_progress: Optional[Callable[[int], None]] = None) -> bool:
+        """执行下载，全部分片校验通过后将 .part 文件重命名为目标文件"""
+        self._on_progress = on_progress
+        self._verify_existing()
+        self._pending = [i for i in range(len(self.pieces)) if i not in self._done]
+        if on_progress and self._done:
+            on_progress(sum(self._piece_range(i)[1] - self._piece_range(i)[0] for i in self._done))
+
+        with open(self.part_path, "r+b") as f:
+            self._file = f
+            workers = [(peer, slot) for peer in self.peers for slot in range(PEER_SLOTS)]
+            with ThreadPoolExecutor(max_workers=max(1, len(workers))) as pool:
+                for peer, _ in workers:
+                    pool.submit(self._peer_worker, peer)
+            self._file = None
+
+        for peer in self.peers:
+            peer.session.close()
+        if len(self._done) != len(self.pieces):
+            return False
+        os.replace(self.part_path, self.dest_path)
+        return True
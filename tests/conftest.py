@@ -0,0 +1,33 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+# 项目是平铺的模块结构，测试直接导入仓库根目录下的模块
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blob_store import BlobStore  # noqa: E402
+
+
+@pytest.fixture
+def file_tsf(tmp_path, monkeypatch):
+    """file_tsf 的上传目录指向临时目录（模块导入时会在当前目录创建 uploads/）"""
+    monkeypatch.chdir(tmp_path)
+    module = importlib.import_module("file_tsf")
+    upload_folder = str(tmp_path / "uploads")
+    partial_folder = os.path.join(upload_folder, ".partial")
+    os.makedirs(partial_folder, exist_ok=True)
+    monkeypatch.setattr(module, "UPLOAD_FOLDER", upload_folder)
+    monkeypatch.setattr(module, "PARTIAL_FOLDER", partial_folder)
+    monkeypatch.setattr(module, "store", BlobStore(upload_folder))
+    for cache in (module._manifests, module._manifest_locks, module._upload_stats, module._piece_manifests,
+                  module._commit_locks, module._committed):
+        cache.clear()
+    return module
+
+
+@pytest.fixture
+def file_client(file_tsf):
+    from fastapi.testclient import TestClient
+    return TestClient(file_tsf.app)
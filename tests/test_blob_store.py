@@ -0,0 +1,77 @@
+import hashlib
+import os
+import uuid
+
+import pytest
+
+from blob_store import BlobStore, is_valid_hash
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(str(tmp_path / "uploads"))
+
+
+def add(store, tmp_path, filename, data):
+    src = tmp_path / f"{uuid.uuid4().hex}.part"
+    src.write_bytes(data)
+    name = store.add_file(str(src), filename)
+    assert not src.exists()
+    return name
+
+
+def test_same_content_is_stored_once(store, tmp_path):
+    assert add(store, tmp_path, "a.txt", b"hello") == "a.txt"
+    assert add(store, tmp_path, "b.txt", b"hello") == "b.txt"
+    # 同名同内容不产生新引用
+    assert add(store, tmp_path, "a.txt", b"hello") == "a.txt"
+    digest = sha256(b"hello")
+    assert store._refs == {digest: 2}
+    assert os.listdir(os.path.dirname(store.blob_path(digest))) == [digest]
+    assert store.resolve("b.txt") == store.blob_path(digest)
+
+
+def test_name_conflict_is_renamed(store, tmp_path):
+    assert add(store, tmp_path, "a.txt", b"one") == "a.txt"
+    assert add(store, tmp_path, "a.txt", b"two") == "a (1).txt"
+    assert add(store, tmp_path, "a.txt", b"three") == "a (2).txt"
+    assert add(store, tmp_path, "a.txt", b"two") == "a (1).txt"
+    assert [f["filename"] for f in store.list_files()] == ["a (1).txt", "a (2).txt", "a.txt"]
+    assert store.lookup("a (1).txt") == {"hash": sha256(b"two"), "size": 3}
+
+
+def test_remove_and_gc(store, tmp_path):
+    add(store, tmp_path, "a.txt", b"shared")
+    add(store, tmp_path, "b.txt", b"shared")
+    add(store, tmp_path, "c.txt", b"single")
+
+    assert store.remove("a.txt")
+    assert not store.remove("a.txt")
+    # 仍有引用的 blob 不回收
+    assert store.gc() == {"removed": 0, "freed": 0}
+    assert store.remove("c.txt")
+    assert store.gc() == {"removed": 1, "freed": 6}
+    assert not store.has(sha256(b"single"))
+    assert store.has(sha256(b"shared"))
+
+
+def test_link_and_index_persistence(store, tmp_path):
+    digest = sha256(b"data")
+    assert store.link("x.bin", digest) is None
+    add(store, tmp_path, "x.bin", b"data")
+    assert store.link("y.bin", digest) == "y.bin"
+
+    reopened = BlobStore(store.root)
+    assert reopened.lookup("y.bin") == {"hash": digest, "size": 4}
+    assert reopened._refs == {digest: 2}
+
+
+def test_is_valid_hash():
+    assert is_valid_hash(sha256(b""))
+    assert not is_valid_hash("A" * 64)
+    assert not is_valid_hash("../" + "0" * 61)
+    assert not is_valid_hash("0" * 63)
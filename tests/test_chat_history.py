@@ -0,0 +1,88 @@
+import asyncio
+import json
+
+import pytest
+
+from chat_history import ChatHistory
+from msg_server import WEB_CHANNEL, ChatHub
+
+
+@pytest.fixture
+def history(tmp_path):
+    history = ChatHistory(str(tmp_path / "history.db"))
+    yield history
+    history.close()
+
+
+def fill(history, count, channel=WEB_CHANNEL):
+    return [history.append(channel, {"username": "alice", "message": f"msg {i}"})["id"] for i in range(count)]
+
+
+def test_page_backwards(history):
+    ids = fill(history, 10)
+    fill(history, 3, "other")
+    page = history.page(WEB_CHANNEL, limit=4)
+    assert [r["id"] for r in page] == ids[-4:]
+    older = history.page(WEB_CHANNEL, before=page[0]["id"], limit=4)
+    assert [r["id"] for r in older] == ids[2:6]
+    assert history.page(WEB_CHANNEL, before=ids[0]) == []
+
+
+def test_since_returns_newest_within_limit(history):
+    ids = fill(history, 10)
+    assert [r["id"] for r in history.since(WEB_CHANNEL, ids[6])] == ids[7:]
+    assert [r["id"] for r in history.since(WEB_CHANNEL, ids[0], upto=ids[5])] == ids[1:5]
+    assert [r["id"] for r in history.since(WEB_CHANNEL, 0, limit=3)] == ids[-3:]
+
+
+def test_search(history):
+    history.append(WEB_CHANNEL, {"username": "alice", "message": "明天下午开会"})
+    history.append(WEB_CHANNEL, {"username": "bob", "message": "收到 50% 的进度"})
+    history.append("other", {"username": "carol", "message": "明天下午开会"})
+    assert [r["username"] for r in history.search(WEB_CHANNEL, "下午开会")] == ["alice"]
+    # 过短的查询与特殊字符走 LIKE
+    assert [r["username"] for r in history.search(WEB_CHANNEL, "%")] == ["bob"]
+    assert [r["username"] for r in history.search(WEB_CHANNEL, "bo")] == ["bob"]
+    assert history.search(WEB_CHANNEL, '"') == []
+    assert history.search(WEB_CHANNEL, "  ") == []
+
+
+def test_ids_survive_reopen(tmp_path):
+    path = str(tmp_path / "history.db")
+    history = ChatHistory(path)
+    ids = fill(history, 3)
+    history.close()
+    reopened = ChatHistory(path)
+    try:
+        assert reopened.append(WEB_CHANNEL, {"message": "x"})["id"] == ids[-1] + 1
+        assert len(reopened.page(WEB_CHANNEL)) == 4
+    finally:
+        reopened.close()
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.frames = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        loaded = json.loads(text)
+        self.frames.extend(loaded if isinstance(loaded, list) else [loaded])
+
+
+def test_reconnect_catches_up_after_last_id(history):
+    ids = fill(history, 5)
+
+    async def scenario():
+        hub = ChatHub(history)
+        websocket = FakeWebSocket()
+        await hub.connect(websocket, last_id=ids[2])
+        for _ in range(5):
+            await asyncio.sleep(0)
+        hub.disconnect(websocket)
+        return websocket
+
+    websocket = asyncio.run(scenario())
+    assert [m["id"] for m in websocket.frames] == ids[3:]
@@ -0,0 +1,132 @@
+import asyncio
+import json
+
+import chat_wire
+from chat_wire import HEADER, ChatDecoder
+from msg_server import BATCH_MAX_MESSAGES, CHAT_QUEUE_SIZE, ChatHub
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.frames = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        self.frames.append(json.loads(text))
+
+    async def send_bytes(self, data):
+        self.frames.append(bytes(data))
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def messages(frame):
+    return frame if isinstance(frame, list) else [frame]
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_backlog_is_batched_into_one_frame():
+    async def scenario():
+        hub = ChatHub()
+        sender, receiver = FakeWebSocket(), FakeWebSocket()
+        await hub.connect(sender)
+        await hub.connect(receiver)
+        await settle()
+        for i in range(3):
+            await hub.broadcast({"username": "alice", "message": str(i)}, sender)
+        await settle()
+        await hub.broadcast({"username": "alice", "message": "3"}, sender)
+        await settle()
+        return hub, sender, receiver
+
+    hub, sender, receiver = run(scenario())
+    assert sender.frames == []
+    # 积压的三条合并为一个数组帧，单条消息仍按对象发送
+    assert receiver.frames == [[{"username": "alice", "message": str(i)} for i in range(3)],
+                               {"username": "alice", "message": "3"}]
+    stats = hub.stats()
+    assert (stats["messages_in"], stats["messages_out"], stats["frames_out"]) == (4, 4, 2)
+
+
+def test_frames_are_capped_at_batch_size():
+    async def scenario():
+        hub = ChatHub()
+        receiver = FakeWebSocket()
+        await hub.connect(receiver)
+        await settle()
+        for i in range(BATCH_MAX_MESSAGES + 1):
+            await hub.broadcast({"username": "bob", "message": str(i)})
+        await settle()
+        return receiver
+
+    receiver = run(scenario())
+    assert [len(messages(frame)) for frame in receiver.frames] == [BATCH_MAX_MESSAGES, 1]
+
+
+def test_full_queue_drops_oldest_and_reports():
+    async def scenario():
+        hub = ChatHub()
+        receiver = FakeWebSocket()
+        await hub.connect(receiver)
+        await settle()
+        # 写任务来不及运行，队列溢出
+        for i in range(CHAT_QUEUE_SIZE + 5):
+            hub._connections[receiver].enqueue(json.dumps({"username": "bob", "message": str(i)}))
+        await settle()
+        return hub, receiver
+
+    hub, receiver = run(scenario())
+    received = [m for frame in receiver.frames for m in messages(frame)]
+    assert received[0]["username"] == "system" and "5" in received[0]["message"]
+    assert received[1]["message"] == "5"
+    assert received[-1]["message"] == str(CHAT_QUEUE_SIZE + 4)
+    assert hub.stats()["dropped"] == 5
+
+
+def test_binary_connection_defines_users_once():
+    async def scenario():
+        hub = ChatHub()
+        receiver = FakeWebSocket()
+        await hub.connect(receiver, binary=True)
+        await settle()
+        await hub.broadcast({"username": "alice", "message": "a"})
+        await settle()
+        await hub.broadcast({"username": "alice", "message": "b"})
+        await settle()
+        return receiver
+
+    receiver = run(scenario())
+    handshake, first, second = receiver.frames
+    assert handshake == HEADER
+    assert len(second) < len(first)
+    decoder = ChatDecoder()
+    assert [m["message"] for m in decoder.decode(first) + decoder.decode(second)] == ["a", "b"]
+
+
+def test_username_table_overflow_redefines_reused_numbers(monkeypatch):
+    monkeypatch.setattr(chat_wire, "MAX_USERS", 2)
+
+    async def scenario():
+        hub = ChatHub()
+        receiver = FakeWebSocket()
+        await hub.connect(receiver, binary=True)
+        await settle()
+        for name in ["alice", "bob", "carol", "alice", "dave"]:
+            await hub.broadcast({"username": name, "message": name})
+        await settle()
+        return hub, receiver
+
+    hub, receiver = run(scenario())
+    decoder = ChatDecoder()
+    received = [m for frame in receiver.frames[1:] for m in decoder.decode(frame)]
+    names = ["alice", "bob", "carol", "alice", "dave"]
+    assert [m["username"] for m in received] == [m["message"] for m in received] == names
+    assert len(hub.users) == 1
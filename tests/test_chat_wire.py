@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from chat_wire import HEADER, ChatDecoder, ChatEncoder, decode_any, is_binary
+
+MESSAGES = [
+    {"username": "alice", "message": "hello"},
+    {"username": "小明", "message": "你好 👋", "id": 7, "ts": 1700000000.25},
+    {"username": "alice", "message": ""},
+]
+
+
+def test_round_trip():
+    data = ChatEncoder().encode(MESSAGES)
+    assert is_binary(data)
+    assert ChatDecoder().decode(data) == MESSAGES
+
+
+def test_usernames_defined_once_per_stream():
+    encoder, decoder = ChatEncoder(), ChatDecoder()
+    first = encoder.encode(MESSAGES[:1])
+    second = encoder.encode(MESSAGES[:1])
+    assert len(second) < len(first)
+    assert decoder.decode(first) == decoder.decode(second) == MESSAGES[:1]
+    # 没见过流开头的接收方不知道用户名
+    assert ChatDecoder().decode(second)[0]["username"] == "Unknown"
+
+
+def test_always_define_for_late_joiners():
+    encoder = ChatEncoder(always_define=True)
+    encoder.encode(MESSAGES)
+    assert ChatDecoder().decode(encoder.encode(MESSAGES)) == MESSAGES
+
+
+def test_long_username_truncated_on_character_boundary():
+    name = "名" * 100  # 300 字节，超出 255 字节上限
+    decoded = ChatDecoder().decode(ChatEncoder().encode([{"username": name, "message": "x"}]))
+    assert decoded[0]["username"] == "名" * 85
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"\x00\x01",
+    HEADER[:1] + b"\x09",
+    HEADER + b"\x07",
+    ChatEncoder().encode(MESSAGES)[:-3],
+])
+def test_malformed_frames(data):
+    with pytest.raises(ValueError):
+        ChatDecoder().decode(data)
+
+
+def test_decode_any_accepts_json():
+    decoder = ChatDecoder()
+    assert decode_any(json.dumps(MESSAGES[0]), decoder) == ([MESSAGES[0]], False)
+    assert decode_any(json.dumps(MESSAGES), decoder) == (MESSAGES, False)
+    assert decode_any(ChatEncoder().encode(MESSAGES), decoder) == (MESSAGES, True)
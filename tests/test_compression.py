@@ -0,0 +1,102 @@
+import os
+import zlib
+
+import pytest
+
+import commands
+from compression import (StreamCompressor, StreamDecompressor, available_codecs, compress_chunk,
+                         decompress_chunk, negotiate, parse_accept_encoding)
+
+DATA = b"LANChat " * 4096
+BOMB_SIZE = 16 * 1024 * 1024
+
+
+def compress(codec, data):
+    compressor = StreamCompressor(codec)
+    return compressor.compress(data) + compressor.flush()
+
+
+@pytest.mark.parametrize("codec", available_codecs())
+def test_stream_round_trip(codec):
+    compressed = compress(codec, DATA)
+    assert len(compressed) < len(DATA)
+    decompressor = StreamDecompressor(codec, len(DATA))
+    out = b"".join(decompressor.decompress(compressed[i:i + 100]) for i in range(0, len(compressed), 100))
+    assert out == DATA
+    decompressor.finish()
+
+
+@pytest.mark.parametrize("codec", available_codecs())
+def test_decompressed_size_is_bounded(codec):
+    # 很小的压缩数据展开后远超声明长度，解压过程中即被拒绝
+    bomb = compress_chunk(codec, b"\0" * BOMB_SIZE)
+    assert len(bomb) < BOMB_SIZE // 100
+    with pytest.raises(ValueError):
+        decompress_chunk(codec, bomb, 1024)
+    decompressor = StreamDecompressor(codec, 1024)
+    with pytest.raises(ValueError):
+        decompressor.decompress(bomb)
+
+
+@pytest.mark.parametrize("codec", [codec for codec in available_codecs() if codec != "zstd"])
+def test_truncated_stream_is_detected(codec):
+    compressed = compress(codec, DATA)
+    decompressor = StreamDecompressor(codec, len(DATA))
+    decompressor.decompress(compressed[:-8])
+    with pytest.raises(ValueError):
+        decompressor.finish()
+
+
+def test_negotiate():
+    assert parse_accept_encoding("ZSTD;q=1, deflate , ") == ["zstd", "deflate"]
+    assert negotiate(["gzip", "Deflate"]) == "deflate"
+    assert negotiate(["gzip"]) is None
+
+
+class FakeResponse:
+    def __init__(self, body, headers):
+        self.status_code = 200
+        self.headers = headers
+        self.raw = self
+        self._body = body
+
+    def stream(self, size, decode_content=False):
+        for i in range(0, len(self._body), size):
+            yield self._body[i:i + size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+@pytest.fixture
+def download(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def run(body, headers):
+        monkeypatch.setattr(commands.requests, "get", lambda *args, **kwargs: FakeResponse(body, headers))
+        commands.CommandHandler("127.0.0.1", 1).download_file("x.bin", "127.0.0.1:1")
+        return os.path.join(commands.DOWNLOAD_FOLDER, "x.bin")
+
+    return run
+
+
+def test_download_decompresses_file(download):
+    headers = {"Content-Encoding": "deflate", "X-Uncompressed-Length": str(len(DATA)), "ETag": 'W/"1"'}
+    path = download(zlib.compress(DATA), headers)
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+
+
+@pytest.mark.parametrize("body, headers", [
+    # 压缩流被截断
+    (zlib.compress(DATA)[:-20], {"Content-Encoding": "deflate", "X-Uncompressed-Length": str(len(DATA))}),
+    # 未压缩的响应短于声明长度
+    (DATA[:100], {"Content-Length": str(len(DATA))}),
+])
+def test_incomplete_download_keeps_part_file(download, body, headers):
+    path = download(body, {**headers, "ETag": '"1"'})
+    assert not os.path.exists(path)
+    assert os.path.exists(path + ".part")
@@ -0,0 +1,114 @@
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import discovery
+from discovery import CHANGE_LOG_SIZE, DeviceRegistry
+
+
+@pytest.fixture
+def registry():
+    return DeviceRegistry(ttl=60)
+
+
+def test_upsert_indexes_and_events(registry):
+    events = []
+    unsubscribe = registry.subscribe(events.append)
+    assert registry.upsert("a", "10.0.0.1", 8000, ["chat", "file"]) == "join"
+    assert registry.upsert("b", "10.0.0.1", 8001, ["voice"]) == "join"
+    # 内容不变只刷新在线时间
+    assert registry.upsert("a", "10.0.0.1", 8000, ["file", "chat"]) is None
+    assert registry.upsert("a", "10.0.0.2", 8000, ["chat"]) == "update"
+
+    assert [d["name"] for d in registry.by_ip("10.0.0.1")] == ["b"]
+    assert [d["name"] for d in registry.with_capability("chat")] == ["a"]
+    assert registry.with_capability("file") == []
+    assert registry.get("a")["capabilities"] == ["chat"]
+
+    assert registry.remove("a")
+    assert not registry.remove("a")
+    assert "a" not in registry and len(registry) == 1
+    assert registry.by_ip("10.0.0.2") == []
+    assert [e["type"] for e in events] == ["join", "join", "update", "leave"]
+
+    unsubscribe()
+    registry.remove("b")
+    assert len(events) == 4
+
+
+def test_failing_listener_does_not_break_registry(registry):
+    def broken(event):
+        raise RuntimeError("boom")
+
+    registry.subscribe(broken)
+    assert registry.upsert("a", "10.0.0.1", 8000) == "join"
+    assert "a" in registry
+
+
+def test_expired(registry):
+    registry.upsert("a", "10.0.0.1", 8000)
+    registry.upsert("b", "10.0.0.2", 8000)
+    last_seen = registry.get("a")["last_seen"]
+    registry._devices["b"]["last_seen"] = last_seen - 120
+    assert registry.expired(last_seen + 1) == ["b"]
+    assert registry.touch("b")
+    assert not registry.touch("missing")
+    assert registry.expired(last_seen + 1) == []
+
+
+def test_versions_and_changes_since(registry):
+    assert registry.etag == f'"{registry.epoch}-0"'
+    registry.upsert("a", "10.0.0.1", 8000)
+    registry.upsert("b", "10.0.0.2", 8000)
+    registry.remove("a")
+    assert registry.version == 3
+    assert registry.versioned_snapshot() == (3, registry.snapshot())
+    assert [(c["version"], c["type"]) for c in registry.changes_since(1)] == [(2, "join"), (3, "leave")]
+    assert registry.changes_since(3) == []
+    # 来自未来的版本号视为无效
+    assert registry.changes_since(4) is None
+
+
+def test_changes_since_evicted_history(registry):
+    for i in range(CHANGE_LOG_SIZE + 1):
+        registry.upsert("a", "10.0.0.1", 8000 + i)
+    assert registry.changes_since(0) is None
+    assert len(registry.changes_since(1)) == CHANGE_LOG_SIZE
+
+
+def test_cursor_is_bound_to_epoch(registry):
+    assert registry.parse_cursor(registry.cursor(5)) == 5
+    # 重启后的注册表不认旧纪元的游标
+    assert DeviceRegistry().parse_cursor(registry.cursor(5)) is None
+    for cursor in (None, "", "5", f"{registry.epoch}:x", f"{registry.epoch}:-1"):
+        assert registry.parse_cursor(cursor) is None
+
+
+@pytest.fixture
+def devices_client(registry, monkeypatch):
+    monkeypatch.setattr(discovery, "discovery_service", SimpleNamespace(registry=registry))
+    app = FastAPI()
+    app.include_router(discovery.router)
+    return TestClient(app)
+
+
+def test_devices_etag_and_since(devices_client, registry):
+    registry.upsert("a", "10.0.0.1", 8000)
+    resp = devices_client.get("/devices")
+    etag = resp.headers["etag"]
+    assert [d["name"] for d in resp.json()] == ["a"]
+    assert devices_client.get("/devices", headers={"If-None-Match": etag}).status_code == 304
+
+    registry.upsert("b", "10.0.0.2", 8000)
+    assert devices_client.get("/devices", headers={"If-None-Match": etag}).status_code == 200
+
+    body = devices_client.get("/devices", params={"since": registry.cursor(1)}).json()
+    assert body["full"] is False
+    assert [c["device"]["name"] for c in body["changes"]] == ["b"]
+    assert body["cursor"] == registry.cursor(2)
+
+    body = devices_client.get("/devices", params={"since": "stale:1"}).json()
+    assert body["full"] is True
+    assert [d["name"] for d in body["devices"]] == ["a", "b"]
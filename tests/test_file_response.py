@@ -0,0 +1,62 @@
+import pytest
+
+from file_response import etag_matches, parse_range
+
+SIZE = 1000
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", [(0, 100)]),
+    ("bytes=900-", [(900, 1000)]),
+    ("bytes=-500", [(500, 1000)]),
+    ("bytes=-5000", [(0, 1000)]),
+    ("bytes=990-2000", [(990, 1000)]),
+    ("BYTES = 0-0", [(0, 1)]),
+    # 重叠与相邻的区间合并，结果按起点排序
+    ("bytes=200-299,0-99,50-149", [(0, 150), (200, 300)]),
+    ("bytes=0-9,10-19", [(0, 20)]),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, SIZE) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-1100", "bytes=1000-", "bytes=-0"])
+def test_parse_range_unsatisfiable(header):
+    assert parse_range(header, SIZE) == []
+
+
+@pytest.mark.parametrize("header", ["items=0-1", "bytes=", "bytes=abc", "bytes=5-1", "bytes=0-1,x", "bytes=-a"])
+def test_parse_range_invalid(header):
+    assert parse_range(header, SIZE) is None
+
+
+def test_etag_matches():
+    etag = '"abc"'
+    assert etag_matches('"abc"', etag)
+    assert etag_matches('W/"abc"', etag)
+    assert etag_matches('"x", "abc"', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('"abd"', etag)
+    assert not etag_matches(None, etag)
+
+
+def test_download_range_and_if_range(file_client):
+    data = bytes(range(25))
+    assert file_client.post("/upload", files={"file": ("x.bin", data)}).status_code == 200
+
+    resp = file_client.get("/download/x.bin", headers={"Range": "bytes=5-14"})
+    assert resp.status_code == 206
+    assert resp.content == data[5:15]
+    assert resp.headers["content-range"] == f"bytes 5-14/{len(data)}"
+    etag = resp.headers["etag"]
+
+    resp = file_client.get("/download/x.bin", headers={"Range": "bytes=-5", "If-Range": etag})
+    assert resp.status_code == 206
+    assert resp.content == data[-5:]
+    # ETag 不匹配时忽略 Range，返回完整文件
+    resp = file_client.get("/download/x.bin", headers={"Range": "bytes=-5", "If-Range": '"stale"'})
+    assert resp.status_code == 200
+    assert resp.content == data
+
+    assert file_client.get("/download/x.bin", headers={"Range": "bytes=100-"}).status_code == 416
+    assert file_client.get("/download/x.bin", headers={"If-None-Match": etag}).status_code == 304
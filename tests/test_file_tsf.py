@@ -0,0 +1,124 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+DATA = b"a" * 10 + b"b" * 10 + b"c" * 5
+CHUNKS = [DATA[0:10], DATA[10:20], DATA[20:25]]
+
+
+def init(client, **overrides):
+    body = {"filename": "x.bin", "size": len(DATA), "chunk_size": 10,
+            "chunk_hashes": [sha256(chunk) for chunk in CHUNKS]}
+    body.update(overrides)
+    return client.post("/upload/init", json=body)
+
+
+def test_chunked_upload_resume_and_commit(file_client, file_tsf):
+    upload_id = init(file_client).json()["upload_id"]
+    assert file_client.put(f"/upload/{upload_id}/chunks/0", content=CHUNKS[0]).status_code == 200
+    assert file_client.put(f"/upload/{upload_id}/chunks/2", content=CHUNKS[2]).status_code == 200
+
+    # 重新初始化同一文件得到同一个上传，只需补传缺失的分块
+    status = init(file_client).json()
+    assert status["upload_id"] == upload_id
+    assert status["received"] == [0, 2]
+    resp = file_client.post(f"/upload/{upload_id}/commit")
+    assert resp.status_code == 409
+    assert resp.json()["detail"]["missing"] == [1]
+
+    assert file_client.put(f"/upload/{upload_id}/chunks/1", content=CHUNKS[1]).status_code == 200
+    resp = file_client.post(f"/upload/{upload_id}/commit")
+    assert resp.status_code == 200
+    assert resp.json()["sha256"] == sha256(DATA)
+    with open(file_tsf.store.blob_path(sha256(DATA)), "rb") as f:
+        assert f.read() == DATA
+
+    # 提交后清单已删除
+    assert file_client.get(f"/upload/{upload_id}").status_code == 404
+    assert file_client.put(f"/upload/{upload_id}/chunks/0", content=CHUNKS[0]).status_code == 404
+
+
+def test_bad_resend_does_not_overwrite_verified_chunk(file_client):
+    upload_id = init(file_client).json()["upload_id"]
+    for index, chunk in enumerate(CHUNKS):
+        assert file_client.put(f"/upload/{upload_id}/chunks/{index}", content=chunk).status_code == 200
+    assert file_client.put(f"/upload/{upload_id}/chunks/1", content=b"z" * 10).status_code == 422
+    assert file_client.put(f"/upload/{upload_id}/chunks/1", content=b"b" * 3).status_code == 400
+    resp = file_client.post(f"/upload/{upload_id}/commit")
+    assert resp.status_code == 200
+    assert resp.json()["sha256"] == sha256(DATA)
+
+
+def test_chunk_put_after_commit_is_rejected(file_client, file_tsf):
+    upload_id = init(file_client).json()["upload_id"]
+    manifest = file_tsf._manifests[upload_id]
+    for index, chunk in enumerate(CHUNKS):
+        file_client.put(f"/upload/{upload_id}/chunks/{index}", content=chunk)
+    assert file_client.post(f"/upload/{upload_id}/commit").status_code == 200
+    # 提交前已加载清单的请求：.part 文件已移走
+    file_tsf._manifests[upload_id] = manifest
+    assert file_client.put(f"/upload/{upload_id}/chunks/0", content=CHUNKS[0]).status_code == 409
+
+
+def test_commit_with_wrong_sha256_resets_upload(file_client):
+    upload_id = init(file_client, sha256="0" * 64).json()["upload_id"]
+    for index, chunk in enumerate(CHUNKS):
+        file_client.put(f"/upload/{upload_id}/chunks/{index}", content=chunk)
+    assert file_client.post(f"/upload/{upload_id}/commit").status_code == 422
+    # 上传已丢弃，重新初始化从头开始
+    status = init(file_client).json()
+    assert status["upload_id"] == upload_id
+    assert status["received"] == []
+
+
+@pytest.mark.parametrize("overrides", [
+    {"chunk_hashes": ["é" * 64] * 3},
+    {"chunk_hashes": ["0" * 63] * 3},
+    {"sha256": "xyz"},
+    {"chunk_hashes": [sha256(b"")]},
+    {"chunk_size": 0},
+])
+def test_init_rejects_invalid_requests(file_client, overrides):
+    assert init(file_client, **overrides).status_code == 400
+
+
+def test_repeated_commit_returns_first_result(file_client, file_tsf):
+    upload_id = init(file_client).json()["upload_id"]
+    for index, chunk in enumerate(CHUNKS):
+        file_client.put(f"/upload/{upload_id}/chunks/{index}", content=chunk)
+
+    async def commit_twice():
+        return await asyncio.gather(file_tsf.commit_upload(upload_id), file_tsf.commit_upload(upload_id))
+
+    first, second = asyncio.run(commit_twice())
+    assert first == second
+    assert first["sha256"] == sha256(DATA)
+    # 响应丢失后客户端重试提交
+    resp = file_client.post(f"/upload/{upload_id}/commit")
+    assert resp.status_code == 200
+    assert resp.json() == first
+    assert file_tsf._commit_locks == {}
+
+
+def test_simple_upload_rejects_empty_filename(file_client):
+    resp = file_client.post("/upload", files={"file": ("dir/", b"data")})
+    assert resp.status_code == 400
+
+
+def test_simple_upload_removes_part_file_on_failure(file_tsf):
+    class BrokenUpload:
+        filename = "x.bin"
+
+        async def read(self, size):
+            raise ConnectionResetError
+
+    with pytest.raises(ConnectionResetError):
+        asyncio.run(file_tsf.upload_file(BrokenUpload()))
+    assert os.listdir(file_tsf.PARTIAL_FOLDER) == []
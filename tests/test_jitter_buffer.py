@@ -0,0 +1,55 @@
+from array import array
+
+from voice_client import CONCEAL_GAIN, FRAME_DURATION, MAX_CONCEALED_FRAMES, JitterBuffer
+from voice_proto import CHUNK, PT_PCM16, VoiceFrame
+
+
+def pcm(value: int) -> bytes:
+    return array("h", [value] * CHUNK).tobytes()
+
+
+def push(buffer, seq, value, index):
+    frame = VoiceFrame(PT_PCM16, False, seq, index * CHUNK, 1, pcm(value))
+    buffer.push(frame, index * FRAME_DURATION)
+
+
+def test_plays_in_order_across_wraparound():
+    buffer = JitterBuffer()
+    # 每两帧乱序到达，播放顺序仍按序列号
+    push(buffer, 0xFFFF, 2, 1)
+    push(buffer, 0xFFFE, 1, 0)
+    played = [buffer.pop()]
+    push(buffer, 1, 4, 3)
+    push(buffer, 0, 3, 2)
+    played += [buffer.pop() for _ in range(3)]
+    assert played == [pcm(1), pcm(2), pcm(3), pcm(4)]
+    assert buffer.lost == 0
+
+
+def test_late_frame_is_dropped():
+    buffer = JitterBuffer()
+    push(buffer, 10, 1, 0)
+    assert buffer.pop() == pcm(1)
+    push(buffer, 9, 2, 1)
+    assert buffer.late == 1
+
+
+def test_loss_is_concealed_with_attenuated_repeat():
+    buffer = JitterBuffer()
+    push(buffer, 0xFFFF, 1000, 0)
+    push(buffer, 1, 3000, 2)
+    assert buffer.pop() == pcm(1000)
+    assert buffer.pop() == pcm(int(1000 * CONCEAL_GAIN))  # seq 0 丢失
+    assert buffer.pop() == pcm(3000)
+    assert buffer.lost == 1
+
+
+def test_silence_after_max_concealed_frames():
+    buffer = JitterBuffer()
+    push(buffer, 5, 1000, 0)
+    buffer.pop()
+    outputs = [buffer.pop() for _ in range(MAX_CONCEALED_FRAMES + 1)]
+    assert outputs[-1] == bytes(len(pcm(0)))
+    # 对端停发后回到缓冲状态，不计为丢包
+    assert buffer.next_seq is None
+    assert buffer.lost == 0
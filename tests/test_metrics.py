@@ -0,0 +1,73 @@
+import threading
+
+from metrics import Registry
+
+
+def test_counter_and_gauge_render():
+    registry = Registry()
+    requests = registry.counter("requests_total", "请求数", ["method"])
+    requests.labels("GET").inc()
+    requests.labels(method="GET").inc(2)
+    requests.labels("POST").inc()
+    in_flight = registry.gauge("in_flight", "进行中")
+    in_flight.inc(3)
+    in_flight.dec()
+    assert registry.render() == (
+        "# HELP requests_total 请求数\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{method="GET"} 3\n'
+        'requests_total{method="POST"} 1\n'
+        "# HELP in_flight 进行中\n"
+        "# TYPE in_flight gauge\n"
+        "in_flight 2\n"
+    )
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = registry.histogram("latency_seconds", "延迟", buckets=(1.0, 0.1))
+    for value in (0.05, 0.1, 0.5, 2):
+        latency.observe(value)
+    lines = registry.render().splitlines()
+    assert lines[2:] == [
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 2.65",
+        "latency_seconds_count 4",
+    ]
+
+
+def test_callback_gauge_labels_escaping_and_failures():
+    registry = Registry()
+    registry.gauge("rooms", "房间", ["room"], fn=lambda: {'a"b\n': 2, ("c",): 1.5})
+    registry.gauge("broken", "出错", fn=lambda: 1 / 0)
+    rendered = registry.render()
+    assert 'rooms{room="a\\"b\\n"} 2\n' in rendered
+    assert 'rooms{room="c"} 1.5\n' in rendered
+    assert "# 采集 broken 失败" in rendered
+
+
+def test_register_twice_returns_same_metric_and_remove_labels():
+    registry = Registry()
+    first = registry.counter("frames_total", "帧数", ["room"])
+    assert registry.counter("frames_total", "帧数", ["room"]) is first
+    first.labels("a").inc()
+    first.remove("a")
+    assert "frames_total{" not in registry.render()
+
+
+def test_counter_is_exact_across_threads():
+    registry = Registry()
+    counter = registry.counter("hits_total", "命中")
+
+    def work():
+        for _ in range(10000):
+            counter.inc()
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert "hits_total 40000\n" in registry.render()
@@ -0,0 +1,115 @@
+import time
+
+from chat_wire import WIRE_FORMAT
+from msg_server import CAP_BINARY, PEER_TIMEOUT, MessageBroadcaster
+from reliable_channel import (
+    MAX_FRAGMENT, MAX_NACKS, NACK_INTERVAL, SENDER_TIMEOUT, ReliableReceiver, ReliableSender, parse_packet
+)
+
+
+def deliver(receiver, datagrams, now=0.0):
+    messages = []
+    for data in datagrams:
+        messages.extend(receiver.on_packet(parse_packet(data), now))
+    return messages
+
+
+def test_in_order_delivery_and_fragmentation():
+    sender, receiver = ReliableSender(1), ReliableReceiver()
+    big = bytes(range(256)) * (MAX_FRAGMENT // 64)
+    datagrams = sender.packets(b"first") + sender.packets(big)
+    assert len(datagrams) > 2
+    assert deliver(receiver, datagrams) == [b"first", big]
+
+
+def test_reordered_packets_are_delivered_in_order():
+    sender, receiver = ReliableSender(1), ReliableReceiver()
+    datagrams = [sender.packets(m)[0] for m in (b"a", b"b", b"c")]
+    assert deliver(receiver, datagrams[:1]) == [b"a"]
+    assert deliver(receiver, [datagrams[2]]) == []
+    assert deliver(receiver, [datagrams[1]]) == [b"b", b"c"]
+
+
+def test_gap_is_nacked_and_filled_by_retransmission():
+    sender, receiver = ReliableSender(1), ReliableReceiver()
+    datagrams = [sender.packets(m)[0] for m in (b"a", b"b", b"c")]
+    deliver(receiver, [datagrams[0], datagrams[2]])
+    nacks, _ = receiver.poll(NACK_INTERVAL)
+    assert [(sender_id, seqs) for sender_id, seqs in nacks] == [(1, [parse_packet(datagrams[1]).seq])]
+    retransmitted = sender.retransmit(nacks[0][1])
+    assert deliver(receiver, retransmitted, NACK_INTERVAL) == [b"b", b"c"]
+
+
+def test_duplicates_are_dropped():
+    sender, receiver = ReliableSender(1), ReliableReceiver()
+    datagram = sender.packets(b"once")[0]
+    assert deliver(receiver, [datagram, datagram]) == [b"once"]
+    assert receiver.duplicates == 1
+
+
+def test_unrecoverable_gap_is_skipped_after_max_nacks():
+    sender, receiver = ReliableSender(1), ReliableReceiver()
+    datagrams = [sender.packets(m)[0] for m in (b"a", b"lost", b"c")]
+    deliver(receiver, [datagrams[0], datagrams[2]])
+    now, delivered = 0.0, []
+    for _ in range(MAX_NACKS + 1):
+        now += NACK_INTERVAL + 0.01
+        _, messages = receiver.poll(now)
+        delivered.extend(message for _, message in messages)
+    assert delivered == [b"c"]
+    assert receiver.lost == 1
+
+
+def test_silent_senders_are_dropped():
+    receiver = ReliableReceiver()
+    sender = ReliableSender(1)
+    deliver(receiver, sender.packets(b"hello"))
+    # 心跳刷新最后活动时间
+    receiver.on_packet(parse_packet(sender.heartbeat()), SENDER_TIMEOUT)
+    receiver.poll(SENDER_TIMEOUT * 2)
+    assert receiver.stats()["senders"] == 1
+    receiver.poll(SENDER_TIMEOUT * 2 + 0.1)
+    assert receiver.stats()["senders"] == 0
+
+
+def test_broadcaster_drops_idle_peer_decoders():
+    broadcaster = MessageBroadcaster("test-expire", transport="broadcast")
+    try:
+        sender = ReliableSender(1, broadcaster.channel_id)
+        for packet in sender.packets(b'{"type": "chat", "content": "hi"}'):
+            broadcaster._handle_datagram(packet, ("127.0.0.1", 1))
+        assert 1 in broadcaster._decoders
+        broadcaster._expire_peers(time.monotonic() + PEER_TIMEOUT + 1)
+        assert broadcaster._decoders == {} and broadcaster._peers == {}
+    finally:
+        broadcaster.stop()
+
+
+def test_listen_only_member_heartbeat_precedes_first_message():
+    receiver = ReliableReceiver()
+    sender = ReliableSender(1, capabilities=0x1)
+    heartbeat = parse_packet(sender.heartbeat())
+    assert (heartbeat.seq, heartbeat.target) == (0, 0x1)
+    assert receiver.on_packet(heartbeat, 0.0) == []
+    # 随后的第一条消息不被当成已收过的旧消息
+    assert deliver(receiver, sender.packets(b"hello")) == [b"hello"]
+    nacks, _ = receiver.poll(NACK_INTERVAL)
+    assert nacks == []
+
+
+def test_channel_uses_binary_only_when_every_member_supports_it():
+    broadcaster = MessageBroadcaster("test-formats", transport="broadcast")
+    try:
+        def heartbeat(sender_id, capabilities):
+            sender = ReliableSender(sender_id, broadcaster.channel_id, capabilities)
+            broadcaster._handle_datagram(sender.heartbeat(), ("127.0.0.1", 1))
+
+        assert broadcaster.wire_format == "json"
+        heartbeat(1, CAP_BINARY)  # 只收不发的新版成员
+        assert broadcaster.wire_format == WIRE_FORMAT
+        heartbeat(2, 0)  # 旧版成员
+        assert broadcaster.wire_format == "json"
+        broadcaster._peers[2][1] -= PEER_TIMEOUT + 1
+        assert broadcaster.wire_format == WIRE_FORMAT
+    finally:
+        broadcaster.stop()
@@ -0,0 +1,108 @@
+import asyncio
+import json
+
+from room_bus import _HEAD, MAX_PAYLOAD, MSG_MEMBERS, RoomBus
+
+
+async def deliver():
+    await asyncio.sleep(0.05)
+
+
+async def start_worker(supervisor, node, token, service_port=9001):
+    worker = RoomBus(node, supervisor.address, service_port, token)
+    await worker.start()
+    await deliver()
+    return worker
+
+
+def test_members_and_frames_are_shared_between_nodes():
+    async def scenario():
+        supervisor = RoomBus(0, service_port=9000)
+        await supervisor.start()
+        supervisor.tokens[1] = "secret"
+        worker = await start_worker(supervisor, 1, "secret")
+        frames = []
+        worker.on_frame = lambda *args: frames.append(args)
+        try:
+            assert supervisor.peers[1] == worker.address
+            assert worker.ports == {0: 9000, 1: 9001}
+
+            worker.set_members("room", 2, [["opus"], ["pcmu"]])
+            supervisor.set_members("room", 1, [["pcm16"]])
+            await deliver()
+            assert supervisor.room_members("room") == {0: 1, 1: 2}
+            assert supervisor.remote_offers("room") == [["opus"], ["pcmu"]]
+
+            supervisor.forward("room", 7, b"audio")
+            await deliver()
+            assert frames == [("room", 0, 7, b"audio")]
+
+            worker.set_members("room", 0, [])
+            await deliver()
+            assert supervisor.room_members("room") == {0: 1}
+        finally:
+            worker.close()
+            supervisor.close()
+
+    asyncio.run(scenario())
+
+
+def test_hello_requires_token_and_cannot_rebind_live_node():
+    async def scenario():
+        supervisor = RoomBus(0, service_port=9000)
+        await supervisor.start()
+        supervisor.tokens[1] = "secret"
+        worker = await start_worker(supervisor, 1, "secret")
+        intruders = [
+            await start_worker(supervisor, 1, "guess", 6666),   # 令牌错误
+            await start_worker(supervisor, 2, "secret", 6666),  # 主进程没有启动的节点号
+            await start_worker(supervisor, 1, "secret", 6666),  # 在线节点改绑到其他地址
+        ]
+        try:
+            assert sorted(supervisor.peers) == [0, 1]
+            assert supervisor.peers[1] == worker.address
+            assert supervisor.ports[1] == 9001
+            # 冒充节点 1 发送的成员表被丢弃
+            intruders[2]._send(MSG_MEMBERS, {"room": [3, []]}, supervisor.address)
+            await deliver()
+            assert supervisor.room_members("room") == {}
+
+            # 工作进程被重启：新令牌的进程立即接替
+            supervisor.tokens[1] = "restarted"
+            restarted = await start_worker(supervisor, 1, "restarted", 9003)
+            intruders.append(restarted)
+            assert supervisor.peers[1] == restarted.address
+            assert supervisor.ports[1] == 9003
+        finally:
+            for bus in [worker, supervisor] + intruders:
+                bus.close()
+
+    asyncio.run(scenario())
+
+
+class RecordingTransport:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append(data)
+
+
+def test_full_sync_is_split_by_encoded_size():
+    bus = RoomBus(1, ("127.0.0.1", 1))
+    bus.transport = RecordingTransport()
+    offers = [["opus", "pcmu", "pcm16"]] * 50
+    rooms = {f"room-{i}": [50, offers] for i in range(200)}
+    bus._local = {room_id: list(entry) for room_id, entry in rooms.items()}
+    bus._local["huge"] = [1, [["x" * MAX_PAYLOAD]]]
+
+    bus._sync_to(("127.0.0.1", 2))
+    assert len(bus.transport.sent) > 1
+    synced = {}
+    for packet in bus.transport.sent:
+        kind, node = _HEAD.unpack_from(packet)
+        assert (kind, node) == (MSG_MEMBERS, 1)
+        assert len(packet) - _HEAD.size <= MAX_PAYLOAD
+        synced.update(json.loads(packet[_HEAD.size:]))
+    # 单个超过上限的房间被跳过，其余全部同步
+    assert synced == rooms
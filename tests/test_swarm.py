@@ -0,0 +1,103 @@
+import hashlib
+import os
+import socket
+import threading
+import time
+
+import pytest
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import Response
+
+from swarm import SwarmDownloader, hash_pieces, root_hash
+
+PIECE_SIZE = 1024
+DATA = os.urandom(PIECE_SIZE * 5 + 100)
+
+
+def serve(app):
+    """在后台线程中启动 uvicorn，返回端口"""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(app, log_level="error"))
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, sock.getsockname()[1]
+
+
+def corrupt_app(manifest):
+    """分片清单正确但返回错误数据的对端"""
+    app = FastAPI()
+
+    @app.get("/file/pieces/{filename}")
+    def pieces(filename: str):
+        return manifest
+
+    @app.get("/file/download/{filename}")
+    def download(filename: str):
+        return Response(b"x" * PIECE_SIZE, status_code=206)
+
+    return app
+
+
+@pytest.fixture
+def peers(file_tsf, file_client):
+    assert file_client.post("/upload", files={"file": ("x.bin", DATA)}).status_code == 200
+    manifest = file_client.get("/pieces/x.bin", params={"piece_size": PIECE_SIZE}).json()
+    good = FastAPI()
+    good.mount("/file", file_tsf.app)
+    servers = [serve(good), serve(good), serve(corrupt_app(manifest))]
+    yield [("127.0.0.1", port) for _, port in servers]
+    for server, _ in servers:
+        server.should_exit = True
+
+
+def test_hash_pieces(tmp_path):
+    path = tmp_path / "x.bin"
+    path.write_bytes(DATA)
+    pieces = hash_pieces(str(path), PIECE_SIZE)
+    assert len(pieces) == 6
+    assert pieces[-1] == hashlib.sha256(DATA[-100:]).hexdigest()
+    assert root_hash(pieces) == root_hash(list(pieces))
+    empty = tmp_path / "empty"
+    empty.write_bytes(b"")
+    assert hash_pieces(str(empty), PIECE_SIZE) == [hashlib.sha256(b"").hexdigest()]
+
+
+def test_swarm_download_skips_corrupt_peer(peers, tmp_path):
+    dest = str(tmp_path / "out.bin")
+    downloader = SwarmDownloader("x.bin", peers, dest, piece_size=PIECE_SIZE)
+    assert downloader.fetch_manifests()
+    progress = []
+    assert downloader.run(progress.append)
+    with open(dest, "rb") as f:
+        assert f.read() == DATA
+    assert sum(progress) == len(DATA)
+    corrupt = downloader.peers[-1]
+    assert corrupt.bytes_received == 0
+    assert not os.path.exists(dest + ".part")
+
+
+def test_swarm_download_resumes_from_part_file(peers, tmp_path, monkeypatch):
+    dest = str(tmp_path / "out.bin")
+    # .part 中前两个分片已正确，其余为脏数据
+    with open(dest + ".part", "wb") as f:
+        f.write(DATA[:PIECE_SIZE * 2] + b"\0" * (len(DATA) - PIECE_SIZE * 2))
+    requested = []
+    original = SwarmDownloader._download_piece
+    monkeypatch.setattr(SwarmDownloader, "_download_piece",
+                        lambda self, peer, index: requested.append(index) or original(self, peer, index))
+
+    downloader = SwarmDownloader("x.bin", peers[:2], dest, piece_size=PIECE_SIZE)
+    assert downloader.fetch_manifests()
+    assert downloader.run()
+    with open(dest, "rb") as f:
+        assert f.read() == DATA
+    assert 0 not in requested and 1 not in requested
+
+
+def test_fetch_manifests_without_peers(tmp_path):
+    downloader = SwarmDownloader("x.bin", [("127.0.0.1", 1)], str(tmp_path / "out"))
+    assert not downloader.fetch_manifests()
@@ -0,0 +1,56 @@
+from array import array
+
+import pytest
+
+from voice_codec import (PcmuCodec, VoiceActivityDetector, comfort_noise, frame_level_db, negotiate,
+                         parse_codecs)
+from voice_proto import CHUNK, SAMPLE_WIDTH
+
+
+def tone(amplitude: int) -> bytes:
+    return array("h", [amplitude if (i // 8) % 2 else -amplitude for i in range(CHUNK)]).tobytes()
+
+
+def test_pcmu_is_8khz_narrowband():
+    codec = PcmuCodec()
+    pcm = tone(8000)
+    payload = codec.encode(pcm)
+    # 每 20ms 帧 160 字节，即 64 kbps
+    assert len(payload) == CHUNK // 2
+    decoded = array("h", codec.decode(payload))
+    assert len(decoded) == CHUNK
+    assert max(abs(a - b) for a, b in zip(decoded, array("h", pcm))) < 8000 * 0.05
+
+
+def test_pcmu_encodes_extremes():
+    codec = PcmuCodec()
+    pcm = array("h", [32767, -32768] * (CHUNK // 2)).tobytes()
+    assert len(codec.decode(codec.encode(pcm))) == CHUNK * SAMPLE_WIDTH
+
+
+def test_parse_codecs_is_case_insensitive():
+    assert parse_codecs("PCMU, Opus ,g729,") == ["pcmu", "opus"]
+    assert parse_codecs(None) == []
+
+
+@pytest.mark.parametrize("offers, expected", [
+    ([["opus", "pcmu"], ["pcmu", "pcm16"]], "pcmu"),
+    ([["opus"], []], "pcm16"),  # 旧版客户端只支持 pcm16
+    ([["opus"], ["opus", "pcm16"]], "opus"),
+])
+def test_negotiate(offers, expected):
+    assert negotiate(offers) == expected
+
+
+def test_vad_and_comfort_noise():
+    vad = VoiceActivityDetector()
+    silence = bytes(CHUNK * SAMPLE_WIDTH)
+    for _ in range(20):
+        assert not vad.is_speech(silence)
+    assert vad.is_speech(tone(8000))
+    assert frame_level_db(tone(32767)) > -1
+    level = vad.noise_level()[0]
+    noise = comfort_noise(40)
+    assert abs(frame_level_db(noise) + 40) < 3
+    assert comfort_noise(127) == silence
+    assert 0 <= level <= 127
@@ -0,0 +1,108 @@
+import asyncio
+from array import array
+
+import pytest
+
+import voice_mixer
+from voice_codec import PcmuCodec
+from voice_mixer import REMOTE_IDLE, RoomMixer, _mix_tick, mix_minus
+from voice_proto import CHUNK, PT_PCM16, pack_frame, seq_diff, unpack_frame
+
+
+def pcm(value: int) -> bytes:
+    return array("h", [value] * CHUNK).tobytes()
+
+
+class FakePeer:
+    def __init__(self):
+        self.frames = []
+
+    def enqueue(self, data):
+        self.frames.append(unpack_frame(data))
+
+
+class FakeStats:
+    def record_drop(self):
+        pass
+
+
+class CountingCodec(PcmuCodec):
+    calls = 0
+
+    def encode(self, pcm):
+        CountingCodec.calls += 1
+        return super().encode(pcm)
+
+
+@pytest.fixture
+def mixer():
+    loop = asyncio.new_event_loop()
+    room = {"a": FakePeer(), "b": FakePeer(), "c": FakePeer()}
+    mixer = loop.run_until_complete(_create(room))
+    yield mixer
+    loop.close()
+
+
+async def _create(room):
+    mixer = RoomMixer(room, FakeStats())
+    mixer.close()  # 测试中手动驱动混音周期
+    return mixer
+
+
+def tick(mixer):
+    speakers, inputs = mixer._take_frames()
+    recipients, outputs = mixer._plan_outputs(speakers)
+    mixer._send(recipients, outputs, _mix_tick(inputs, outputs))
+
+
+def talk(mixer, sender, value):
+    mixer.push(sender, pack_frame(PT_PCM16, 0, 0, 1, pcm(value)))
+
+
+def test_mix_minus_excludes_own_voice():
+    mixes = mix_minus([pcm(100), pcm(200), pcm(30000)])
+    assert [array("h", mix)[0] for mix in mixes] == [30200, 30100, 300, 30300]
+
+
+def test_lone_speaker_sequence_has_no_gaps(mixer):
+    room = mixer.room
+    for _ in range(3):
+        talk(mixer, "a", 100)
+        tick(mixer)
+    assert room["a"].frames == []
+    talk(mixer, "a", 100)
+    talk(mixer, "b", 200)
+    tick(mixer)
+    talk(mixer, "b", 200)
+    tick(mixer)
+
+    for name in ("a", "b", "c"):
+        seqs = [frame.seq for frame in room[name].frames]
+        assert all(seq_diff(later, earlier) == 1 for earlier, later in zip(seqs, seqs[1:]))
+    # 被跳过的成员重新收到混音时，首帧带 marker 位
+    assert room["a"].frames[0].marker
+    assert [array("h", f.payload)[0] for f in room["a"].frames] == [200, 200]
+    assert len(room["b"].frames) == 4 and len(room["c"].frames) == 5
+
+
+def test_shared_mix_is_encoded_once_for_stateless_codecs():
+    CountingCodec.calls = 0
+    inputs = [(PcmuCodec(), PcmuCodec().encode(pcm(1000)))]
+    outputs = [(CountingCodec(), None) for _ in range(5)] + [(CountingCodec(), 0)]
+    payloads = _mix_tick(inputs, outputs)
+    assert CountingCodec.calls == 2
+    assert len(set(payloads[:5])) == 1
+
+
+def test_prune_remote_members(mixer, monkeypatch):
+    talk(mixer, (1, 42), 100)
+    talk(mixer, (2, 7), 100)
+    talk(mixer, "a", 100)
+    mixer.prune_remote({0: 1, 2: 1})
+    assert set(mixer._inputs) == {(2, 7), "a"}
+    assert (1, 42) not in mixer._decoders
+
+    now = voice_mixer.time.monotonic() + REMOTE_IDLE + 1
+    mixer.prune_remote({0: 1, 2: 1}, now)
+    assert set(mixer._inputs) == {"a"}
+    assert mixer._remote_seen == {}
@@ -0,0 +1,55 @@
+from voice_proto import seq_diff
+from voice_rtp import RTCP_RTPFB, ReceiveStats, SendHistory, pack_nack, parse_rtcp
+
+
+def test_seq_diff_wraps():
+    assert seq_diff(1, 0xFFFF) == 2
+    assert seq_diff(0xFFFF, 1) == -2
+    assert seq_diff(0x7FFF, 0) == 0x7FFF
+    assert seq_diff(0x8000, 0) == -0x8000
+
+
+def test_receive_stats_across_wraparound():
+    stats = ReceiveStats(ssrc=1)
+    for i, seq in enumerate((0xFFFE, 0xFFFF, 0, 1)):
+        assert stats.update(seq, i * 320, i * 0.02) == []
+    assert stats.cycles == 1 << 16
+    assert stats.extended_max == (1 << 16) + 1
+    assert stats.expected == 4
+    assert stats.lost == 0
+
+
+def test_missing_sequence_numbers_across_wraparound():
+    stats = ReceiveStats(ssrc=1)
+    stats.update(0xFFFD, 0, 0.0)
+    assert stats.update(1, 4 * 320, 0.08) == [0xFFFE, 0xFFFF, 0]
+    assert stats.lost == 3
+    # 迟到的包不算新的缺失，也不会倒退最大序列号
+    assert stats.update(0xFFFF, 2 * 320, 0.09) == []
+    assert stats.extended_max == (1 << 16) + 1
+    assert stats.lost == 2
+
+
+def test_reordered_packet_does_not_count_a_cycle():
+    stats = ReceiveStats(ssrc=1)
+    stats.update(0, 0, 0.0)
+    stats.update(0xFFFF, 0, 0.0)
+    assert stats.cycles == 0
+    assert stats.extended_max == 0
+
+
+def test_nack_round_trip_across_wraparound():
+    seqs = [0xFFF0, 0xFFFF, 0, 5, 40]
+    packet = parse_rtcp(pack_nack(1, 2, seqs))
+    assert packet.packet_type == RTCP_RTPFB
+    assert packet.media_ssrc == 2
+    assert sorted(packet.nack) == sorted(seqs)
+
+
+def test_send_history_keeps_recent_packets():
+    history = SendHistory(size=2)
+    for seq in (0xFFFF, 0, 1):
+        history.put(9, seq, bytes([seq & 0xFF]))
+    assert history.get(9, 0xFFFF) is None
+    assert history.get(9, 0) == b"\x00"
+    assert history.get(9, 1) == b"\x01"
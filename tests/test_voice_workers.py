@@ -0,0 +1,51 @@
+import time
+
+import pytest
+
+from voice_workers import VoiceWorkerPool
+
+SERVICE_PORT = 9000
+
+
+@pytest.fixture
+def pool():
+    """不启动工作进程，直接填写总线的节点表与成员表"""
+    pool = VoiceWorkerPool(2, SERVICE_PORT)
+    pool.bus.peers = {0: ("127.0.0.1", 1), 1: ("127.0.0.1", 2), 2: ("127.0.0.1", 3)}
+    pool.bus.ports = {0: SERVICE_PORT, 1: 9001, 2: 9002}
+    yield pool
+    pool._sock.close()
+
+
+def set_members(pool, room_id, node, count):
+    pool.bus._remote.setdefault(room_id, {})[node] = [count, [], time.monotonic()]
+
+
+def test_main_process_serves_rooms_until_workers_are_ready(pool):
+    pool.bus.peers = {0: ("127.0.0.1", 1)}
+    assert pool.place("room") == {"node": 0, "port": SERVICE_PORT}
+
+
+def test_new_room_goes_to_least_loaded_worker(pool):
+    set_members(pool, "busy", 1, 5)
+    assert pool.place("new") == {"node": 2, "port": 9002}
+
+
+def test_placement_is_sticky_before_anyone_joins(pool):
+    first = pool.place("room")
+    assert all(pool.place("room") == first for _ in range(5))
+
+
+def test_pending_placements_count_as_load(pool):
+    nodes = {pool.place(f"room-{i}")["node"] for i in range(2)}
+    assert nodes == {1, 2}
+
+
+def test_room_follows_its_members(pool):
+    set_members(pool, "room", 1, 3)
+    set_members(pool, "room", 2, 1)
+    set_members(pool, "other", 1, 10)
+    assert pool.place("room")["node"] == 1
+    # 成员都直接连在主进程上的房间留在主进程
+    pool.bus._local["legacy"] = [2, []]
+    assert pool.place("legacy") == {"node": 0, "port": SERVICE_PORT}
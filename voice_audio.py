@@ -0,0 +1,225 @@
+import math
+import os
+import time
+import wave
+from array import array
+from typing import Optional
+
+from voice_proto import CHUNK, CHANNELS, RATE, SAMPLE_WIDTH
+
+FRAME_DURATION = CHUNK / RATE
+FRAME_BYTES = CHUNK * SAMPLE_WIDTH
+
+# 默认音频后端，可用环境变量 LANCHAT_AUDIO 或 main.py 的 --audio 参数指定
+DEFAULT_AUDIO = os.environ.get("LANCHAT_AUDIO", "auto")
+
+# 合成音频：每 TALK_PERIOD 秒中前 TALK_RATIO 的时间发声（模拟说话与停顿）
+TALK_PERIOD = 4.0
+TALK_RATIO = 0.5
+SYNTHETIC_LEVEL = 0.2
+
+
+class _Pacer:
+    """按帧周期节拍阻塞，让非声卡的后端与声卡一样按实时速度产出/消费音频"""
+
+    def __init__(self):
+        self._deadline: Optional[float] = None
+
+    def wait(self):
+        now = time.monotonic()
+        if self._deadline is None or now - self._deadline > FRAME_DURATION * 4:
+            self._deadline = now  # 首帧或落后太多时重新对齐，不补发积压的帧
+        self._deadline += FRAME_DURATION
+        delay = self._deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class AudioBackend:
+    """音频后端：read() 阻塞返回一帧采集的 PCM，write() 阻塞播放一帧 PCM
+
+    两个方法都在线程池中调用。open() 在客户端会话开始时才调用，
+    服务端（只转发/混音）不会创建任何音频后端。
+    """
+
+    name = "null"
+
+    def __init__(self):
+        self._input_pacer = _Pacer()
+        self._output_pacer = _Pacer()
+        self.frames_read = 0
+        self.frames_written = 0
+
+    def open(self):
+        pass
+
+    def read(self) -> bytes:
+        self._input_pacer.wait()
+        self.frames_read += 1
+        return self._capture()
+
+    def write(self, pcm: bytes):
+        self._output_pacer.wait()
+        self.frames_written += 1
+        self._play(pcm)
+
+    def _capture(self) -> bytes:
+        return bytes(FRAME_BYTES)
+
+    def _play(self, pcm: bytes):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullBackend(AudioBackend):
+    """静音输入、丢弃输出"""
+
+
+class SyntheticBackend(AudioBackend):
+    """合成的正弦波语音段（按 TALK_PERIOD 周期发声/停顿），丢弃输出"""
+
+    name = "synthetic"
+
+    def __init__(self, frequency: float = 440.0):
+        super().__init__()
+        self.frequency = frequency
+        self._phase = 0
+
+    def _capture(self) -> bytes:
+        start = self._phase
+        self._phase += CHUNK
+        if (start / RATE) % TALK_PERIOD >= TALK_PERIOD * TALK_RATIO:
+            return bytes(FRAME_BYTES)
+        step = 2 * math.pi * self.frequency / RATE
+        amplitude = 32767 * SYNTHETIC_LEVEL
+        return array("h", [int(amplitude * math.sin(step * (start + i))) for i in range(CHUNK)]).tobytes()
+
+
+class WavBackend(AudioBackend):
+    """从 WAV 文件循环读取输入，可选把播放的音频写入 WAV 文件
+
+    输入文件须为 16-bit 单声道且采样率与 RATE 一致。
+    """
+
+    name = "wav"
+
+    def __init__(self, input_path: Optional[str] = None, output_path: Optional[str] = None):
+        super().__init__()
+        self.input_path = input_path
+        self.output_path = output_path
+        self._input = None
+        self._output = None
+
+    def open(self):
+        if self.input_path:
+            self._input = wave.open(self.input_path, "rb")
+            if (self._input.getsampwidth(), self._input.getnchannels(), self._input.getframerate()) != \
+                    (SAMPLE_WIDTH, CHANNELS, RATE):
+                self._input.close()
+                raise ValueError(f"WAV 文件须为 {RATE}Hz、16-bit、单声道: {self.input_path}")
+        if self.output_path:
+            self._output = wave.open(self.output_path, "wb")
+            self._output.setsampwidth(SAMPLE_WIDTH)
+            self._output.setnchannels(CHANNELS)
+            self._output.setframerate(RATE)
+
+    def _capture(self) -> bytes:
+        if self._input is None:
+            return bytes(FRAME_BYTES)
+        pcm = self._input.readframes(CHUNK)
+        if len(pcm) < FRAME_BYTES:
+            self._input.rewind()
+            pcm += self._input.readframes(CHUNK - len(pcm) // SAMPLE_WIDTH)
+        return pcm.ljust(FRAME_BYTES, b"\0")
+
+    def _play(self, pcm: bytes):
+        if self._output is not None:
+            self._output.writeframes(pcm)
+
+    def close(self):
+        for f in (self._input, self._output):
+            if f is not None:
+                f.close()
+
+
+class PyAudioBackend(AudioBackend):
+    """声卡输入输出（PortAudio），读写本身随声卡时钟阻塞，不需要额外节拍"""
+
+    name = "pyaudio"
+
+    def __init__(self):
+        super().__init__()
+        self._audio = None
+        self._input_stream = None
+        self._output_stream = None
+
+    def open(self):
+        import pyaudio  # 只有真正使用声卡的会话才加载 PortAudio
+
+        self._audio = pyaudio.PyAudio()
+        try:
+            self._input_stream = self._audio.open(
+                format=pyaudio.paInt16, channels=CHANNELS, rate=RATE,
+                input=True, frames_per_buffer=CHUNK
+            )
+            self._output_stream = self._audio.open(
+                format=pyaudio.paInt16, channels=CHANNELS, rate=RATE,
+                output=True, frames_per_buffer=CHUNK
+            )
+        except Exception:
+            self.close()
+            raise
+
+    def read(self) -> bytes:
+        self.frames_read += 1
+        return self._input_stream.read(CHUNK, False)
+
+    def write(self, pcm: bytes):
+        self.frames_written += 1
+        self._output_stream.write(pcm)
+
+    def close(self):
+        for stream in (self._input_stream, self._output_stream):
+            if stream:
+                stream.stop_stream()
+                stream.close()
+        self._input_stream = self._output_stream = None
+        if self._audio:
+            self._audio.terminate()
+            self._audio = None
+
+
+def pyaudio_available() -> bool:
+    try:
+        import pyaudio  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def create_backend(spec: Optional[str] = None) -> AudioBackend:
+    """按描述创建音频后端
+
+    auto（有 PyAudio 时使用声卡，否则静音）、pyaudio、null、
+    synthetic[:频率]、wav:<输入文件>[:<输出文件>]
+    """
+    spec = spec or DEFAULT_AUDIO
+    kind, _, arg = spec.partition(":")
+    kind = kind.lower()
+    if kind == "auto":
+        if pyaudio_available():
+            return PyAudioBackend()
+        print("未安装 PyAudio，语音通话不采集也不播放声音")
+        return NullBackend()
+    if kind in ("pyaudio", "device"):
+        return PyAudioBackend()
+    if kind == "null":
+        return NullBackend()
+    if kind == "synthetic":
+        return SyntheticBackend(float(arg)) if arg else SyntheticBackend()
+    if kind == "wav":
+        input_path, _, output_path = arg.partition(":")
+        return WavBackend(input_path or None, output_path or None)
+    raise ValueError(f"未知的音频后端: {spec}")
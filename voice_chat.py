@@ -1,131 +1,498 @@
-import pyaudio
 import asyncio
-import websockets
+import json
+import os
+import random
+import time
 
+from collections import deque
 from fastapi import FastAPI, WebSocket
-from typing import Dict, Set, Optional
+from typing import Dict, List, Optional
+from metrics import registry
+from voice_codec import available_codecs, negotiate, parse_codecs
+from voice_proto import CHUNK, RATE, unpack_frame
+from voice_client import VoiceClient
+from voice_mixer import RoomMixer
+from voice_rtp import (
+    RTCP_APP, RTCP_RR, RTCP_RTPFB, RTCP_SR, UDP_TIMEOUT,
+    ReceiveStats, SendHistory, block_to_dict, is_rtcp, pack_hello, pack_nack, pack_sr,
+    parse_rtcp, round_trip_time
+)
 
 app = FastAPI()
 
-# 音频参数配置
-CHUNK = 256
-FORMAT = pyaudio.paInt16
-CHANNELS = 1
-RATE = 8000
+# 每个连接最多缓冲的待发送帧数（约 0.5 秒音频），满时丢弃最旧的帧
+SEND_QUEUE_FRAMES = 16
+
+VOICE_FRAMES = registry.counter("lanchat_voice_frames_total", "房间收到的音频帧数", ["room"])
+VOICE_BYTES = registry.counter("lanchat_voice_bytes_total", "房间收到的音频字节数", ["room"])
+VOICE_DROPPED = registry.counter("lanchat_voice_dropped_frames_total", "发送队列满时丢弃的帧数", ["room"])
+VOICE_FANOUT = registry.histogram(
+    "lanchat_voice_fanout_seconds", "音频帧从入队到发送完成的延迟（秒）", ["room"]
+)
+
+
+class RoomStats:
+    """房间级转发统计：帧数、丢帧数、队列深度与转发延迟
+
+    同时记录到带 room 标签的 Prometheus 指标，房间关闭时 close() 删除这些标签。
+    """
+
+    def __init__(self, room_id: str = ""):
+        self.room_id = room_id
+        self._frames = VOICE_FRAMES.labels(room_id)
+        self._bytes = VOICE_BYTES.labels(room_id)
+        self._dropped = VOICE_DROPPED.labels(room_id)
+        self._fanout = VOICE_FANOUT.labels(room_id)
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.frames_out = 0
+        self.dropped = 0
+        self.send_errors = 0
+        self.latency_avg = 0.0  # 入队到发送完成的平均延迟（秒，指数滑动平均）
+        self.latency_max = 0.0
+
+    def record_frame(self, size: int):
+        self.frames_in += 1
+        self.bytes_in += size
+        self._frames.inc()
+        self._bytes.inc(size)
+
+    def record_drop(self):
+        self.dropped += 1
+        self._dropped.inc()
+
+    def record_latency(self, latency: float):
+        self.frames_out += 1
+        self.latency_avg += (latency - self.latency_avg) * 0.05
+        self.latency_max = max(self.latency_max, latency)
+        self._fanout.observe(latency)
+
+    def close(self):
+        for metric in (VOICE_FRAMES, VOICE_BYTES, VOICE_DROPPED, VOICE_FANOUT):
+            metric.remove(self.room_id)
+
+    def to_dict(self, peers) -> dict:
+        depths = [len(peer.queue) for peer in peers]
+        return {
+            "members": len(depths),
+            "frames_in": self.frames_in,
+            "bytes_in": self.bytes_in,
+            "frames_out": self.frames_out,
+            "dropped": self.dropped,
+            "send_errors": self.send_errors,
+            "queue_depth": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "latency_avg_ms": round(self.latency_avg * 1000, 3),
+            "latency_max_ms": round(self.latency_max * 1000, 3),
+        }
+
+
+class VoicePeer:
+    """房间中的一个连接
+
+    每个连接拥有有界发送队列和独立的写任务，广播只负责入队，
+    某个接收端网络慢只会让它自己的队列丢弃最旧的帧，不会拖慢其他人。
+    """
+
+    def __init__(self, websocket: WebSocket, stats: RoomStats, on_failure,
+                 codecs: Optional[List[str]] = None):
+        self.websocket = websocket
+        self.stats = stats
+        self.codecs = codecs or []  # 客户端声明支持的编解码器
+        # UDP 媒体通道：握手成功后音频帧改走 UDP，WebSocket 只传控制消息
+        self.udp_token: Optional[bytes] = None
+        self.udp_addr = None
+        self.udp_confirmed = False  # 握手回应后收到对端的媒体或报告，说明双向可达
+        self.udp_last_seen = 0.0
+        self._udp_transport = None
+        self.history = SendHistory()
+        self.udp_packets = 0
+        self.udp_octets = 0
+        self.upstream: Optional[ReceiveStats] = None  # 该成员上行流的接收统计
+        self.downstream: Dict[int, dict] = {}          # 该成员报告的各路下行流接收情况
+        self.rtt: Optional[float] = None
+        self.queue = deque(maxlen=SEND_QUEUE_FRAMES)
+        self._control = deque()  # 控制消息不受队列长度限制，优先发送
+        self.dropped = 0
+        self._on_failure = on_failure
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._writer())
+
+    def enqueue(self, data: bytes):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+            self.stats.record_drop()
+        self.queue.append((data, time.perf_counter()))
+        self._wakeup.set()
+
+    def send_control(self, message: dict):
+        self._control.append(json.dumps(message))
+        self._wakeup.set()
+
+    def bind_udp(self, transport, addr):
+        self._udp_transport = transport
+        self.udp_addr = addr
+        self.udp_confirmed = False
+        self.udp_last_seen = time.monotonic()
+
+    @property
+    def transport(self) -> str:
+        if self.udp_confirmed and time.monotonic() - self.udp_last_seen < UDP_TIMEOUT:
+            return "udp"
+        return "websocket"
+
+    def send_udp(self, packet: bytes):
+        self._udp_transport.sendto(packet, self.udp_addr)
+
+    def _send_frame(self, data: bytes):
+        """UDP 可用时经 UDP 发送并记入重传缓存，返回是否已发送"""
+        if self.transport != "udp":
+            return False
+        self.send_udp(data)
+        self.udp_packets += 1
+        self.udp_octets += len(data)
+        frame = unpack_frame(data)
+        if frame is not None:
+            self.history.put(frame.ssrc, frame.seq, data)
+        return True
+
+    def transport_stats(self) -> dict:
+        return {
+            "transport": self.transport,
+            "rtt_ms": round(self.rtt * 1000, 3) if self.rtt is not None else None,
+            "upstream": self.upstream.to_dict() if self.upstream else None,
+            "downstream": self.downstream,
+            "retransmitted": self.history.retransmitted,
+        }
+
+    async def _writer(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._control:
+                    await self.websocket.send_text(self._control.popleft())
+                while self.queue:
+                    data, enqueued_at = self.queue.popleft()
+                    if not self._send_frame(data):
+                        await self.websocket.send_bytes(data)
+                    self.stats.record_latency(time.perf_counter() - enqueued_at)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self.stats.send_errors += 1
+            self._on_failure(self)
+
+    def close(self):
+        self._task.cancel()
+        self.queue.clear()
+
+
+class UdpMediaServer(asyncio.DatagramProtocol):
+    """语音 UDP 媒体通道（与 HTTP 服务使用相同的端口号）
+
+    客户端先通过 WebSocket 拿到令牌，再用 UDP 握手包声明自己的地址；
+    之后 RTP 帧经 UDP 收发，不再受 TCP 队头阻塞影响。RTCP 风格的 SR
+    报告双方的丢包、抖动与往返时延，NACK 从重传缓存中补发丢失的帧。
+    """
+
+    def __init__(self, service: "VoiceChatService"):
+        self.service = service
+        self.ssrc = random.getrandbits(32)
+        self.transport = None
+        self._tokens: Dict[bytes, tuple] = {}  # 令牌 -> (room_id, websocket)
+        self._addrs: Dict[tuple, tuple] = {}   # UDP 地址 -> (room_id, websocket)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def register(self, room_id: str, peer: VoicePeer) -> bytes:
+        token = os.urandom(8)
+        peer.udp_token = token
+        self._tokens[token] = (room_id, peer.websocket)
+        return token
+
+    def forget(self, peer: VoicePeer):
+        self._tokens.pop(peer.udp_token, None)
+        if peer.udp_addr is not None:
+            self._addrs.pop(peer.udp_addr, None)
+
+    def _lookup(self, key):
+        room_id, websocket = key
+        return room_id, self.service._active_connections.get(room_id, {}).get(websocket)
+
+    def datagram_received(self, data: bytes, addr):
+        if is_rtcp(data):
+            self._handle_rtcp(parse_rtcp(data), addr)
+            return
+        key = self._addrs.get(addr)
+        if key is None:
+            return
+        room_id, peer = self._lookup(key)
+        if peer is None:
+            return
+        now = time.monotonic()
+        peer.udp_last_seen = now
+        peer.udp_confirmed = True
+        frame = unpack_frame(data)
+        if frame is not None:
+            if peer.upstream is None or peer.upstream.ssrc != frame.ssrc:
+                peer.upstream = ReceiveStats(frame.ssrc)
+            missing = peer.upstream.update(frame.seq, frame.timestamp, now)
+            if missing:
+                peer.send_udp(pack_nack(self.ssrc, frame.ssrc, missing))
+        self.service.relay(data, room_id, peer.websocket)
+
+    def _handle_rtcp(self, packet, addr):
+        if packet is None:
+            return
+        if packet.packet_type == RTCP_APP:
+            # 握手：记录该成员的 UDP 地址并原样回应
+            key = self._tokens.get(packet.token)
+            if key is None:
+                return
+            _, peer = self._lookup(key)
+            if peer is None:
+                return
+            if peer.udp_addr is not None and peer.udp_addr != addr:
+                self._addrs.pop(peer.udp_addr, None)
+            self._addrs[addr] = key
+            peer.bind_udp(self.transport, addr)
+            peer.send_udp(pack_hello(self.ssrc, packet.token))
+            return
+
+        key = self._addrs.get(addr)
+        if key is None:
+            return
+        _, peer = self._lookup(key)
+        if peer is None:
+            return
+        now = time.monotonic()
+        peer.udp_last_seen = now
+        peer.udp_confirmed = True
+        if packet.packet_type in (RTCP_SR, RTCP_RR):
+            for block in packet.blocks:
+                if block.ssrc == self.ssrc:
+                    rtt = round_trip_time(block)
+                    if rtt is not None:
+                        peer.rtt = rtt
+                else:
+                    peer.downstream[block.ssrc] = block_to_dict(block)
+            if packet.packet_type == RTCP_SR:
+                if peer.upstream is None or peer.upstream.ssrc != packet.ssrc:
+                    peer.upstream = ReceiveStats(packet.ssrc)
+                peer.upstream.on_sender_report(packet.ntp, now)
+                # 回复 SR：报告该成员上行流的接收情况，对端据此计算往返时延
+                peer.send_udp(pack_sr(self.ssrc, 0, peer.udp_packets, peer.udp_octets,
+                                      [peer.upstream.report(now)]))
+        elif packet.packet_type == RTCP_RTPFB:
+            for seq in packet.nack:
+                frame = peer.history.get(packet.media_ssrc, seq)
+                if frame is not None:
+                    peer.send_udp(frame)
 
 class VoiceChatService:
     def __init__(self):
-        self._active_connections: Dict[str, Set[WebSocket]] = {}
-        self._audio = pyaudio.PyAudio()
-        self._input_stream: Optional[pyaudio.Stream] = None
-        self._output_stream: Optional[pyaudio.Stream] = None
-        self._is_streaming = False
-
-    def start_streaming(self):
-        """启动音频流"""
-        self._input_stream = self._audio.open(
-            format=FORMAT,
-            channels=CHANNELS,
-            rate=RATE,
-            input=True,
-            frames_per_buffer=CHUNK
-        )
-        
-        self._output_stream = self._audio.open(
-            format=FORMAT,
-            channels=CHANNELS,
-            rate=RATE,
-            output=True,
-            frames_per_buffer=CHUNK
-        )
-        self._is_streaming = True
-
-    def stop_streaming(self):
-        """停止音频流"""
-        self._is_streaming = False
-        if self._input_stream:
-            self._input_stream.stop_stream()
-            self._input_stream.close()
-        if self._output_stream:
-            self._output_stream.stop_stream()
-            self._output_stream.close()
-        self._audio.terminate()
-
-    async def connect(self, websocket: WebSocket, room_id: str):
-        """处理新的WebSocket连接"""
+        self._active_connections: Dict[str, Dict[WebSocket, VoicePeer]] = {}
+        self._room_stats: Dict[str, RoomStats] = {}
+        self._room_mixers: Dict[str, RoomMixer] = {}
+        self._room_codecs: Dict[str, str] = {}
+        self._udp: Optional[UdpMediaServer] = None
+        self._udp_failed = False
+        self.bus = None  # 多进程模式下的进程间房间总线（room_bus.RoomBus）
+
+    def attach_bus(self, bus):
+        """接入进程间总线：同一房间分布在多个进程时，帧经总线互相转发，编解码器按全房间协商"""
+        self.bus = bus
+        bus.on_frame = self.relay_remote
+        bus.on_members = self._on_remote_members
+        for room_id in self._active_connections:
+            self._publish_members(room_id)
+
+    def _publish_members(self, room_id: str):
+        if self.bus is not None:
+            room = self._active_connections.get(room_id, {})
+            self.bus.set_members(room_id, len(room), [peer.codecs for peer in room.values()])
+
+    def _on_remote_members(self, room_id: str):
+        if room_id in self._active_connections:
+            mixer = self._room_mixers.get(room_id)
+            if mixer is not None:
+                # 其他节点的成员离开后释放其输入缓冲与解码器
+                mixer.prune_remote(self.bus.room_members(room_id))
+            self._renegotiate(room_id)
+
+    async def _ensure_udp(self, port: int) -> Optional[UdpMediaServer]:
+        """首次有客户端请求 UDP 时在与 HTTP 相同的端口号上打开 UDP 媒体通道"""
+        if self._udp is None and not self._udp_failed:
+            try:
+                _, self._udp = await asyncio.get_running_loop().create_datagram_endpoint(
+                    lambda: UdpMediaServer(self), local_addr=("0.0.0.0", port)
+                )
+            except OSError as e:
+                print(f"⚠️ 无法打开语音 UDP 端口 {port}，仅使用 WebSocket: {e}")
+                self._udp_failed = True
+        return self._udp
+
+    async def connect(self, websocket: WebSocket, room_id: str, mode: Optional[str] = None,
+                      codecs: Optional[List[str]] = None, transport: Optional[str] = None):
+        """处理新的WebSocket连接
+
+        房间模式由创建房间的第一个连接决定：mode="mix" 时由服务端混音，
+        否则逐路转发。codecs 为客户端支持的编解码器；transport="udp" 时
+        下发 UDP 握手令牌，握手成功后音频改走 UDP。
+        """
         await websocket.accept()
         if room_id not in self._active_connections:
-            self._active_connections[room_id] = set()
-        self._active_connections[room_id].add(websocket)
+            self._active_connections[room_id] = {}
+            self._room_stats[room_id] = RoomStats(room_id)
+            if mode == "mix":
+                self._room_mixers[room_id] = RoomMixer(
+                    self._active_connections[room_id], self._room_stats[room_id]
+                )
+        stats = self._room_stats[room_id]
+        peer = VoicePeer(
+            websocket, stats, lambda peer: self.disconnect(peer.websocket, room_id), codecs
+        )
+        self._active_connections[room_id][websocket] = peer
+        self._publish_members(room_id)
+        if not self._renegotiate(room_id):
+            peer.send_control(self._codec_message(room_id))
+        if transport == "udp":
+            port = websocket.scope["server"][1]
+            udp = await self._ensure_udp(port)
+            if udp is not None:
+                token = udp.register(room_id, peer)
+                peer.send_control({"type": "udp", "port": port, "token": token.hex()})
+
+    def _codec_message(self, room_id: str) -> dict:
+        return {"type": "codec", "codec": self._room_codecs[room_id], "rate": RATE, "frame": CHUNK}
+
+    def _renegotiate(self, room_id: str) -> bool:
+        """选出房间内所有成员（混音房间还包括服务端）都支持的编解码器，
+        发生变化时通知所有成员，返回是否变化
+        """
+        room = self._active_connections[room_id]
+        mixer = self._room_mixers.get(room_id)
+        offers = [peer.codecs for peer in room.values()]
+        if mixer is not None:
+            offers.append(available_codecs())
+        if self.bus is not None:
+            offers.extend(self.bus.remote_offers(room_id))
+        codec = negotiate(offers)
+        if self._room_codecs.get(room_id) == codec:
+            return False
+        self._room_codecs[room_id] = codec
+        if mixer is not None:
+            mixer.set_codec(codec)
+        for peer in room.values():
+            peer.send_control(self._codec_message(room_id))
+        return True
 
     def disconnect(self, websocket: WebSocket, room_id: str):
-        """处理WebSocket断开连接"""
-        if room_id in self._active_connections:
-            self._active_connections[room_id].remove(websocket)
-            if not self._active_connections[room_id]:
-                del self._active_connections[room_id]
+        """处理WebSocket断开连接（发送失败的连接也会在这里移除）"""
+        room = self._active_connections.get(room_id)
+        if room is None:
+            return
+        peer = room.pop(websocket, None)
+        if peer is not None:
+            peer.close()
+            if self._udp is not None:
+                self._udp.forget(peer)
+        mixer = self._room_mixers.get(room_id)
+        if mixer is not None:
+            mixer.remove(websocket)
+        if peer is not None:
+            self._publish_members(room_id)
+        if not room:
+            del self._active_connections[room_id]
+            self._room_stats.pop(room_id).close()
+            self._room_codecs.pop(room_id, None)
+            if mixer is not None:
+                mixer.close()
+                del self._room_mixers[room_id]
+        elif peer is not None:
+            # 只支持低优先级编解码器的成员离开后，房间可以升级编解码器
+            self._renegotiate(room_id)
 
     async def broadcast(self, audio_data: bytes, room_id: str, sender: WebSocket):
         """广播音频数据到房间内其他用户"""
-        if room_id in self._active_connections:
-            for connection in self._active_connections[room_id]:
-                if connection != sender:
-                    try:
-                        await connection.send_bytes(audio_data)
-                    except Exception:
-                        continue
-    async def connect_voice_chat(server_ip, port, room_id):
-        # 创建 WebSocket 连接
-        uri = f"ws://{server_ip}:{port}/voice/ws/{room_id}"
-        
-        async with websockets.connect(uri) as websocket:
-            print(f"已连接到语音聊天室: {room_id}")
-            
-            # 初始化音频
-            audio = pyaudio.PyAudio()
-            input_stream = audio.open(
-                format=pyaudio.paInt16,
-                channels=1,
-                rate=8000,
-                input=True,
-                frames_per_buffer=256
-            )
-            output_stream = audio.open(
-                format=pyaudio.paInt16,
-                channels=1,
-                rate=8000,
-                output=True,
-                frames_per_buffer=256
-            )
-            
-            try:
-                while True:
-                    # 从麦克风读取音频数据
-                    audio_data = input_stream.read(256)
-                    # 发送到服务器
-                    await websocket.send(audio_data)
-                    
-                    # 接收其他用户的音频数据
-                    received_data = await websocket.recv()
-                    # 播放接收到的音频
-                    output_stream.write(received_data)
-                    
-            except KeyboardInterrupt:
-                print("正在断开连接...")
-            finally:
-                input_stream.stop_stream()
-                input_stream.close()
-                output_stream.stop_stream()
-                output_stream.close()
-                audio.terminate()
+        self.relay(audio_data, room_id, sender)
+
+    def relay(self, audio_data: bytes, room_id: str, sender: WebSocket):
+        """转发一帧音频（WebSocket 与 UDP 共用）：只入队，由各连接的写任务并发发送
+
+        混音房间交给 RoomMixer，每个成员只收到一路混音。
+        """
+        room = self._active_connections.get(room_id)
+        if room is None:
+            return
+        self._room_stats[room_id].record_frame(len(audio_data))
+        if self.bus is not None:
+            self.bus.forward(room_id, id(sender), audio_data)
+        mixer = self._room_mixers.get(room_id)
+        if mixer is not None:
+            mixer.push(sender, audio_data)
+            return
+        for websocket, peer in room.items():
+            if websocket is not sender:
+                peer.enqueue(audio_data)
+
+    def relay_remote(self, room_id: str, node: int, sender: int, audio_data: bytes):
+        """转发其他进程中同一房间成员的帧（不再转发回总线）"""
+        room = self._active_connections.get(room_id)
+        if room is None:
+            return
+        self._room_stats[room_id].record_frame(len(audio_data))
+        mixer = self._room_mixers.get(room_id)
+        if mixer is not None:
+            mixer.push((node, sender), audio_data)
+            return
+        for peer in room.values():
+            peer.enqueue(audio_data)
+
+    def stats(self) -> dict:
+        """各房间的转发统计"""
+        result = {}
+        for room_id, room in self._active_connections.items():
+            result[room_id] = self._room_stats[room_id].to_dict(room.values())
+            mixer = self._room_mixers.get(room_id)
+            result[room_id]["mode"] = "mix" if mixer else "forward"
+            result[room_id]["codec"] = self._room_codecs.get(room_id)
+            result[room_id]["peers"] = [peer.transport_stats() for peer in room.values()]
+            if self.bus is not None:
+                result[room_id]["nodes"] = self.bus.room_members(room_id)
+            if mixer:
+                result[room_id]["mixer"] = mixer.to_dict()
+        return result
+
+    @staticmethod
+    async def connect_voice_chat(server_ip, port, room_id, mode=None, audio=None):
+        """以全双工客户端连接语音房间（采集与播放互不阻塞），audio 为音频后端描述"""
+        await VoiceClient(server_ip, port, room_id, mode, audio=audio).run()
 
 # 创建全局语音服务实例
 voice_service = VoiceChatService()
 
+registry.gauge(
+    "lanchat_voice_room_members", "各语音房间的成员数", ["room"],
+    fn=lambda: {room_id: len(room) for room_id, room in list(voice_service._active_connections.items())}
+)
+
+@app.get("/stats")
+async def voice_stats():
+    """各语音房间的队列深度、丢帧与延迟统计"""
+    return voice_service.stats()
+
 @app.websocket("/ws/{room_id}")
-async def voice_chat_endpoint(websocket: WebSocket, room_id: str):
-    """WebSocket端点处理语音通信"""
-    await voice_service.connect(websocket, room_id)
+async def voice_chat_endpoint(websocket: WebSocket, room_id: str, mode: Optional[str] = None,
+                              codecs: Optional[str] = None, transport: Optional[str] = None):
+    """WebSocket端点处理语音通信
+
+    ?mode=mix 创建服务端混音房间，?codecs=opus,pcmu,pcm16 声明客户端支持的编解码器，
+    ?transport=udp 请求 UDP 媒体通道（不可用时继续使用 WebSocket）
+    """
+    await voice_service.connect(websocket, room_id, mode, parse_codecs(codecs), transport)
     try:
         while True:
             data = await websocket.receive_bytes()
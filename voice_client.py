@@ -0,0 +1,390 @@
+import asyncio
+import json
+import random
+import time
+from typing import Dict, Optional
+
+import websockets
+
+from voice_audio import AudioBackend, create_backend
+from voice_codec import (
+    CN_INTERVAL, VoiceActivityDetector, available_codecs, codec_for_payload_type,
+    comfort_noise, create_codec
+)
+from voice_proto import (
+    CHUNK, RATE, SAMPLE_WIDTH, PT_CN,
+    VoiceFrame, pack_frame, unpack_frame, seq_diff, mix_pcm16, attenuate_pcm16
+)
+from voice_rtp import (
+    RTCP_APP, RTCP_INTERVAL, RTCP_RTPFB, RTCP_SR, UDP_TIMEOUT,
+    ReceiveStats, ReportBlock, SendHistory, is_rtcp, pack_hello, pack_nack, pack_sr,
+    parse_rtcp, round_trip_time
+)
+
+FRAME_DURATION = CHUNK / RATE  # 每帧时长（秒）
+# 抖动缓冲目标延迟范围（秒），保证端到端延迟在 100ms 以内
+MIN_JITTER_DELAY = 0.02
+MAX_JITTER_DELAY = 0.08
+# 连续丢包时重复上一帧并逐帧衰减，超过该帧数后输出静音
+MAX_CONCEALED_FRAMES = 3
+CONCEAL_GAIN = 0.5
+# 超过该时间没有收到某路音频即移除其缓冲区（秒）
+STREAM_TIMEOUT = 2.0
+# UDP 握手：每隔 UDP_HELLO_INTERVAL 秒发送一次，最多尝试 UDP_HELLO_ATTEMPTS 次
+UDP_HELLO_INTERVAL = 0.2
+UDP_HELLO_ATTEMPTS = 5
+
+
+class JitterBuffer:
+    """单路音频的自适应抖动缓冲
+
+    按 RFC 3550 的方式估计到达间隔抖动，目标缓冲延迟 = 1 帧 + 3 倍抖动，
+    限制在 [MIN_JITTER_DELAY, MAX_JITTER_DELAY]。缓冲积压超过目标时丢弃
+    最旧的帧追赶延迟；丢失的帧用上一帧衰减重复（丢包隐藏）。
+    对端静音（VAD 停发）期间按其通告的噪声电平播放舒适噪声。
+    """
+
+    def __init__(self, rate: int = RATE):
+        self.rate = rate
+        self.jitter = 0.0
+        self.frames: Dict[int, bytes] = {}
+        self.next_seq: Optional[int] = None
+        self.last_arrival = 0.0
+        self._last_transit: Optional[float] = None
+        self._last_payload: Optional[bytes] = None
+        self._concealed = 0
+        self.comfort_level: Optional[int] = None
+        self.received = 0
+        self.lost = 0
+        self.late = 0
+
+    @property
+    def target_delay(self) -> float:
+        delay = FRAME_DURATION + 3 * self.jitter
+        return max(MIN_JITTER_DELAY, min(MAX_JITTER_DELAY, delay))
+
+    @property
+    def buffered(self) -> float:
+        return len(self.frames) * FRAME_DURATION
+
+    def push(self, frame: VoiceFrame, arrival: float):
+        self.received += 1
+        self.last_arrival = arrival
+        transit = arrival - frame.timestamp / self.rate
+        if self._last_transit is not None:
+            d = abs(transit - self._last_transit)
+            self.jitter += (d - self.jitter) / 16
+        self._last_transit = transit
+
+        if self.next_seq is not None and seq_diff(frame.seq, self.next_seq) < 0:
+            self.late += 1
+            return
+        self.frames[frame.seq] = frame.payload
+
+    def set_comfort_noise(self, level: int, arrival: float):
+        """收到舒适噪声帧：记录噪声电平（对端仍在线，只是没有说话）"""
+        self.comfort_level = level
+        self.last_arrival = arrival
+
+    def _silence(self) -> Optional[bytes]:
+        if self.comfort_level is None:
+            return None
+        return comfort_noise(self.comfort_level)
+
+    def pop(self) -> Optional[bytes]:
+        """每个播放周期调用一次，返回一帧 PCM；尚未开始播放时返回舒适噪声或 None"""
+        if self.next_seq is None:
+            if not self.frames or self.buffered < self.target_delay:
+                return self._silence()
+            self.next_seq = min(self.frames, key=lambda s: seq_diff(s, next(iter(self.frames))))
+
+        # 积压超过目标延迟两帧以上时丢弃最旧的帧以降低延迟
+        while self.buffered > self.target_delay + 2 * FRAME_DURATION and self.next_seq in self.frames:
+            del self.frames[self.next_seq]
+            self.next_seq = (self.next_seq + 1) & 0xFFFF
+
+        payload = self.frames.pop(self.next_seq, None)
+        self.next_seq = (self.next_seq + 1) & 0xFFFF
+        if payload is not None:
+            self._last_payload = payload
+            self._concealed = 0
+            return payload
+
+        self.lost += 1
+        self._concealed += 1
+        if self._last_payload is None or self._concealed > MAX_CONCEALED_FRAMES:
+            if not self.frames:
+                # 对端停止发送（如静音期间），回到缓冲状态，等下一段语音重新对齐序列号
+                self.next_seq = None
+                self.lost -= self._concealed
+                self._concealed = 0
+                self._last_payload = None
+            return self._silence() or bytes(CHUNK * SAMPLE_WIDTH)
+        self._last_payload = attenuate_pcm16(self._last_payload, CONCEAL_GAIN)
+        return self._last_payload
+
+
+class _UdpMediaProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client: "VoiceClient"):
+        self.client = client
+
+    def datagram_received(self, data: bytes, addr):
+        self.client._on_udp(data)
+
+    def error_received(self, exc):
+        # ICMP 端口不可达等错误：等待超时后自动回退到 WebSocket
+        pass
+
+
+class VoiceClient:
+    """全双工语音客户端
+
+    采集与播放是两个独立的任务：采集任务读取麦克风后立即发送，
+    接收任务把收到的帧按 SSRC 放入各自的抖动缓冲，播放任务按声卡节奏
+    从所有缓冲中取帧混音播放。没有人说话时麦克风照常采集，多人同时
+    说话时各路音频分别缓冲，不会互相拖慢。
+
+    连接时声明本机支持的编解码器，由服务端选定房间编解码器后下发；
+    VAD 判定为静音的帧不发送，只定期发送舒适噪声电平。
+
+    WebSocket 负责信令，use_udp=True 时尝试建立 UDP 媒体通道：握手成功后
+    音频帧经 UDP 收发，丢包通过 NACK 重传，并定期交换 RTCP 风格的报告；
+    UDP 被阻断或超时无响应时继续（或回退到）使用 WebSocket。
+
+    audio 为音频后端或其描述（见 voice_audio.create_backend），连接成功后才打开，
+    可用 synthetic/wav/null 在没有声卡的机器上运行。
+    """
+
+    def __init__(self, server_ip: str, port, room_id: str, mode: Optional[str] = None,
+                 use_udp: bool = True, audio=None):
+        self.uri = f"ws://{server_ip}:{port}/voice/ws/{room_id}?codecs={','.join(available_codecs())}"
+        if mode:
+            self.uri += f"&mode={mode}"
+        if use_udp:
+            self.uri += "&transport=udp"
+        self.server_ip = server_ip
+        self.room_id = room_id
+        self.ssrc = random.getrandbits(32)
+        self.seq = random.getrandbits(16)
+        self.timestamp = random.getrandbits(32)
+        self.buffers: Dict[int, JitterBuffer] = {}
+        # 协商完成前使用所有人都能解码的 pcm16
+        self.encoder = create_codec("pcm16")
+        self._decoders: Dict[int, object] = {}
+        self.vad = VoiceActivityDetector()
+        self._silent_frames = 0
+        self.frames_sent = 0
+        self.frames_suppressed = 0
+        self.bytes_sent = 0
+        # UDP 媒体通道状态
+        self._udp = None
+        self._udp_ready = asyncio.Event()
+        self._udp_last_seen = 0.0
+        self._udp_tasks = []
+        self.history = SendHistory()
+        self.receive_stats: Dict[int, ReceiveStats] = {}
+        self.rtt: Optional[float] = None
+        self.remote_report: Optional[ReportBlock] = None  # 服务端报告的上行流接收情况
+        self._server_ssrc: Optional[int] = None
+        self._server_sr = (0, 0.0)  # 最近一次收到的服务端 SR（NTP 中间 32 位, 到达时间）
+        self.audio: AudioBackend = audio if isinstance(audio, AudioBackend) else create_backend(audio)
+
+    async def _capture(self, websocket):
+        loop = asyncio.get_running_loop()
+        while True:
+            pcm = await loop.run_in_executor(None, self.audio.read)
+            frame = self._encode(pcm)
+            self.timestamp = (self.timestamp + CHUNK) & 0xFFFFFFFF
+            if frame is not None:
+                self.bytes_sent += len(frame)
+                if self.udp_active:
+                    self._udp.sendto(frame)
+                    self.history.put(self.ssrc, self.seq, frame)
+                else:
+                    await websocket.send(frame)
+                self.seq = (self.seq + 1) & 0xFFFF
+
+    @property
+    def udp_active(self) -> bool:
+        if not self._udp_ready.is_set():
+            return False
+        if time.monotonic() - self._udp_last_seen < UDP_TIMEOUT:
+            return True
+        # 长时间收不到服务端的任何 UDP 包，回退到 WebSocket
+        self._udp_ready.clear()
+        print("UDP 通道超时，回退到 WebSocket 传输")
+        return False
+
+    def _encode(self, pcm: bytes) -> Optional[bytes]:
+        """编码一帧；静音时返回舒适噪声帧或 None（不发送）"""
+        if self.vad.is_speech(pcm):
+            # 静音后的第一帧带 marker 位，标记新的语音段
+            marker = self._silent_frames > 0
+            self._silent_frames = 0
+            self.frames_sent += 1
+            return pack_frame(self.encoder.payload_type, self.seq, self.timestamp, self.ssrc,
+                              self.encoder.encode(pcm), marker=marker)
+        self._silent_frames += 1
+        self.frames_suppressed += 1
+        if (self._silent_frames - 1) % CN_INTERVAL == 0:
+            return pack_frame(PT_CN, self.seq, self.timestamp, self.ssrc, self.vad.noise_level())
+        return None
+
+    def _handle_control(self, message: str):
+        try:
+            control = json.loads(message)
+        except ValueError:
+            return
+        if control.get("type") == "codec" and control.get("codec") in available_codecs():
+            if control["codec"] != self.encoder.name:
+                self.encoder = create_codec(control["codec"])
+                print(f"语音编码: {control['codec']}")
+        elif control.get("type") == "udp" and self._udp is None:
+            self._udp_tasks.append(asyncio.create_task(
+                self._start_udp(int(control["port"]), bytes.fromhex(control["token"]))
+            ))
+
+    async def _start_udp(self, port: int, token: bytes):
+        """UDP 握手：发送令牌直到服务端回应，失败则继续使用 WebSocket"""
+        loop = asyncio.get_running_loop()
+        try:
+            self._udp, _ = await loop.create_datagram_endpoint(
+                lambda: _UdpMediaProtocol(self), remote_addr=(self.server_ip, port)
+            )
+        except OSError as e:
+            print(f"UDP 不可用，使用 WebSocket 传输: {e}")
+            return
+        for _ in range(UDP_HELLO_ATTEMPTS):
+            self._udp.sendto(pack_hello(self.ssrc, token))
+            try:
+                await asyncio.wait_for(self._udp_ready.wait(), UDP_HELLO_INTERVAL)
+                break
+            except asyncio.TimeoutError:
+                continue
+        if not self._udp_ready.is_set():
+            print("UDP 不可达，使用 WebSocket 传输")
+            return
+        print("语音媒体通过 UDP 传输")
+        while True:
+            await asyncio.sleep(RTCP_INTERVAL)
+            self._send_report()
+
+    def _send_report(self):
+        """发送 SR：附带各路接收流的报告，以及针对服务端 SR 的 LSR/DLSR"""
+        now = time.monotonic()
+        blocks = [stats.report(now) for stats in self.receive_stats.values()]
+        if self._server_ssrc is not None and self._server_sr[0]:
+            lsr, arrival = self._server_sr
+            blocks.append(ReportBlock(self._server_ssrc, 0, 0, 0, 0, lsr, int((now - arrival) * 65536)))
+        self._udp.sendto(pack_sr(self.ssrc, self.timestamp, self.frames_sent, self.bytes_sent, blocks))
+
+    def _on_udp(self, data: bytes):
+        self._udp_last_seen = time.monotonic()
+        if not is_rtcp(data):
+            if self._udp_ready.is_set():
+                self._on_media(data, via_udp=True)
+            return
+        packet = parse_rtcp(data)
+        if packet is None:
+            return
+        if packet.packet_type == RTCP_APP:
+            self._server_ssrc = packet.ssrc
+            self._udp_ready.set()
+        elif packet.packet_type == RTCP_SR:
+            self._server_sr = (packet.ntp, self._udp_last_seen)
+            for block in packet.blocks:
+                if block.ssrc == self.ssrc:
+                    self.remote_report = block
+                    rtt = round_trip_time(block)
+                    if rtt is not None:
+                        self.rtt = rtt
+        elif packet.packet_type == RTCP_RTPFB:
+            for seq in packet.nack:
+                frame = self.history.get(packet.media_ssrc, seq)
+                if frame is not None:
+                    self._udp.sendto(frame)
+
+    def _decode(self, frame: VoiceFrame) -> Optional[bytes]:
+        name = codec_for_payload_type(frame.payload_type)
+        if name is None or name not in available_codecs():
+            return None
+        decoder = self._decoders.get(frame.ssrc)
+        if decoder is None or decoder.name != name:
+            decoder = self._decoders[frame.ssrc] = create_codec(name)
+        return decoder.decode(frame.payload)
+
+    async def _receive(self, websocket):
+        async for message in websocket:
+            if isinstance(message, str):
+                self._handle_control(message)
+            else:
+                self._on_media(message)
+
+    def _on_media(self, message: bytes, via_udp: bool = False):
+        frame = unpack_frame(message)
+        if frame is None or frame.ssrc == self.ssrc:
+            return
+        now = time.monotonic()
+        stats = self.receive_stats.get(frame.ssrc)
+        if stats is None:
+            stats = self.receive_stats[frame.ssrc] = ReceiveStats(frame.ssrc)
+        missing = stats.update(frame.seq, frame.timestamp, now)
+        if missing and via_udp:
+            self._udp.sendto(pack_nack(self.ssrc, frame.ssrc, missing))
+        buffer = self.buffers.get(frame.ssrc)
+        if buffer is None:
+            buffer = self.buffers[frame.ssrc] = JitterBuffer()
+        if frame.payload_type == PT_CN:
+            if frame.payload:
+                buffer.set_comfort_noise(frame.payload[0], now)
+            return
+        pcm = self._decode(frame)
+        if pcm is not None:
+            buffer.push(frame._replace(payload=pcm), now)
+
+    def _next_output(self) -> bytes:
+        now = time.monotonic()
+        for ssrc in [s for s, b in self.buffers.items() if now - b.last_arrival > STREAM_TIMEOUT]:
+            del self.buffers[ssrc]
+            self._decoders.pop(ssrc, None)
+            self.receive_stats.pop(ssrc, None)
+        frames = [f for f in (b.pop() for b in list(self.buffers.values())) if f is not None]
+        return mix_pcm16(frames)
+
+    async def _playback(self):
+        # 声卡写入是阻塞的，播放节奏由声卡时钟（或后端的节拍）决定
+        loop = asyncio.get_running_loop()
+        while True:
+            await loop.run_in_executor(None, self.audio.write, self._next_output())
+
+    async def run(self):
+        async with websockets.connect(self.uri) as websocket:
+            print(f"已连接到语音聊天室: {self.room_id}")
+            self.audio.open()
+            tasks = [
+                asyncio.create_task(self._capture(websocket)),
+                asyncio.create_task(self._receive(websocket)),
+                asyncio.create_task(self._playback()),
+            ]
+            try:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+            finally:
+                tasks += self._udp_tasks
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                if self._udp is not None:
+                    self._udp.close()
+                self.audio.close()
+
+    def stats(self) -> dict:
+        """传输方式、往返时延以及各路接收流的丢包与抖动"""
+        return {
+            "transport": "udp" if self.udp_active else "websocket",
+            "audio": self.audio.name,
+            "rtt_ms": round(self.rtt * 1000, 3) if self.rtt is not None else None,
+            "streams": {ssrc: stats.to_dict() for ssrc, stats in self.receive_stats.items()},
+            "retransmitted": self.history.retransmitted,
+        }
@@ -0,0 +1,218 @@
+import math
+import random
+from array import array
+from typing import Iterable, List, Optional
+
+from voice_proto import CHUNK, CHANNELS, RATE, SAMPLE_WIDTH, PT_PCM16, PT_PCMU, PT_OPUS
+
+# 可选依赖：Opus 编解码（需要系统安装 libopus），未安装时回退到 G.711 μ-law
+try:
+    import opuslib
+except Exception:
+    opuslib = None
+
+OPUS_BITRATE = 24000
+
+# VAD 参数：电平高于噪声底噪 VAD_MARGIN_DB 且高于 VAD_MIN_DB 视为语音，
+# 语音结束后保持 VAD_HANGOVER 帧，避免切掉词尾
+VAD_MARGIN_DB = 9.0
+VAD_MIN_DB = -55.0
+VAD_HANGOVER = 10
+# 静音期间每隔多少帧发送一次舒适噪声电平
+CN_INTERVAL = 25
+
+
+# ---------- G.711 μ-law（标准库实现，查表编解码） ----------
+# μ-law 按标准的 8 kHz 窄带编码：16 kHz 采样两两平均降采样后编码，解码时
+# 每个采样重复一次还原为 16 kHz，码率 64 kbps（16-bit PCM 的 1/4）。
+# 带宽降到 1/5~1/10 需要 Opus（24 kbps），μ-law 只是没有 libopus 时的回退。
+
+def _ulaw_encode_sample(sample: int) -> int:
+    value = sample >> 2  # 按 14 位精度编码
+    if value < 0:
+        value, mask = -value, 0x7F
+    else:
+        mask = 0xFF
+    value = min(value, 8159) + 0x21
+    segment = 0
+    while segment < 8 and value >= (0x40 << segment):
+        segment += 1
+    if segment >= 8:
+        return 0x7F ^ mask
+    return ((segment << 4) | ((value >> (segment + 1)) & 0x0F)) ^ mask
+
+
+def _ulaw_decode_byte(byte: int) -> int:
+    byte = ~byte & 0xFF
+    magnitude = (((byte & 0x0F) << 3) + 0x84) << ((byte >> 4) & 0x07)
+    return (0x84 - magnitude) if byte & 0x80 else (magnitude - 0x84)
+
+
+# 256 项解码表；以无符号 16 位采样值为下标的编码表在首次编码时才生成（约 0.1 秒）
+_ULAW_DECODE = array("h", [_ulaw_decode_byte(b) for b in range(256)])
+_ulaw_encode_table: Optional[bytes] = None
+
+
+def _ulaw_encode_lookup():
+    global _ulaw_encode_table
+    if _ulaw_encode_table is None:
+        _ulaw_encode_table = bytes(_ulaw_encode_sample(v - 0x10000 if v >= 0x8000 else v)
+                                   for v in range(0x10000))
+    return _ulaw_encode_table.__getitem__
+
+
+def _downsample(pcm: bytes) -> array:
+    """16 kHz -> 8 kHz：相邻两个采样取平均（兼作简单的低通滤波）"""
+    samples = array("h", pcm[:len(pcm) & ~3])
+    return array("H", [((a + b) >> 1) & 0xFFFF for a, b in zip(samples[0::2], samples[1::2])])
+
+
+def _upsample(samples: array) -> array:
+    """8 kHz -> 16 kHz：每个采样重复一次"""
+    out = array("h", bytes(len(samples) * 4))
+    out[0::2] = samples
+    out[1::2] = samples
+    return out
+
+
+class Pcm16Codec:
+    name = "pcm16"
+    payload_type = PT_PCM16
+    stateless = True  # 无状态的编码器可以把同一路混音的编码结果共用给多个接收者
+
+    def encode(self, pcm: bytes) -> bytes:
+        return pcm
+
+    def decode(self, payload: bytes) -> bytes:
+        return payload
+
+
+class PcmuCodec:
+    """G.711 μ-law，8 kHz 窄带、每个采样 8 bit，码率为 16 kHz 16-bit PCM 的 1/4"""
+
+    name = "pcmu"
+    payload_type = PT_PCMU
+    stateless = True
+
+    def encode(self, pcm: bytes) -> bytes:
+        return bytes(map(_ulaw_encode_lookup(), _downsample(pcm)))
+
+    def decode(self, payload: bytes) -> bytes:
+        return _upsample(array("h", map(_ULAW_DECODE.__getitem__, payload))).tobytes()
+
+
+class OpusCodec:
+    """Opus 编解码器（有状态，每路音频各用一个实例）"""
+
+    name = "opus"
+    payload_type = PT_OPUS
+    stateless = False
+
+    def __init__(self):
+        self._encoder = None
+        self._decoder = None
+
+    def encode(self, pcm: bytes) -> bytes:
+        if self._encoder is None:
+            self._encoder = opuslib.Encoder(RATE, CHANNELS, opuslib.APPLICATION_VOIP)
+            self._encoder.bitrate = OPUS_BITRATE
+        return self._encoder.encode(pcm, CHUNK)
+
+    def decode(self, payload: bytes) -> bytes:
+        if self._decoder is None:
+            self._decoder = opuslib.Decoder(RATE, CHANNELS)
+        return self._decoder.decode(payload, CHUNK)
+
+
+_CODECS = {"opus": OpusCodec, "pcmu": PcmuCodec, "pcm16": Pcm16Codec}
+_BY_PAYLOAD_TYPE = {cls.payload_type: name for name, cls in _CODECS.items()}
+
+
+def available_codecs() -> List[str]:
+    """本机支持的编解码器，按优先级排序"""
+    codecs = ["pcmu", "pcm16"]
+    if opuslib is not None:
+        codecs.insert(0, "opus")
+    return codecs
+
+
+def negotiate(offers: Iterable[Iterable[str]]) -> str:
+    """从所有参与方都支持的编解码器中选出优先级最高的一个
+
+    旧版客户端不声明编解码器，视为只支持 pcm16。
+    """
+    common = set(_CODECS)
+    for offer in offers:
+        common &= set(offer) or {"pcm16"}
+    for codec in _CODECS:
+        if codec in common:
+            return codec
+    return "pcm16"
+
+
+def parse_codecs(value: Optional[str]) -> List[str]:
+    if not value:
+        return []
+    codecs = [codec.strip().lower() for codec in value.split(",")]
+    return [codec for codec in codecs if codec in _CODECS]
+
+
+def create_codec(name: str):
+    return _CODECS[name]()
+
+
+def codec_for_payload_type(payload_type: int) -> Optional[str]:
+    return _BY_PAYLOAD_TYPE.get(payload_type)
+
+
+# ---------- VAD 与舒适噪声 ----------
+
+def frame_level_db(pcm: bytes) -> float:
+    """帧的 RMS 电平（dBov，满幅为 0）"""
+    samples = array("h", pcm)
+    if not samples:
+        return -127.0
+    energy = sum(v * v for v in samples) / len(samples)
+    if energy <= 0:
+        return -127.0
+    return max(-127.0, 10 * math.log10(energy / (32768.0 * 32768.0)))
+
+
+class VoiceActivityDetector:
+    """基于能量的语音活动检测
+
+    噪声底噪在静音时快速跟随、在语音时缓慢上升；电平明显高于底噪时判为语音，
+    语音结束后保持若干帧（hangover）。
+    """
+
+    def __init__(self):
+        self.noise_floor = -60.0
+        self.level = -127.0
+        self._hangover = 0
+
+    def is_speech(self, pcm: bytes) -> bool:
+        self.level = level = frame_level_db(pcm)
+        if level < self.noise_floor:
+            self.noise_floor += (level - self.noise_floor) * 0.5
+        else:
+            self.noise_floor += (level - self.noise_floor) * 0.01
+        if level > max(self.noise_floor + VAD_MARGIN_DB, VAD_MIN_DB):
+            self._hangover = VAD_HANGOVER
+            return True
+        if self._hangover > 0:
+            self._hangover -= 1
+            return True
+        return False
+
+    def noise_level(self) -> bytes:
+        """舒适噪声负载：1 字节噪声电平（-dBov，0~127）"""
+        return bytes([min(127, max(0, int(round(-self.noise_floor))))])
+
+
+def comfort_noise(level: int, samples: int = CHUNK) -> bytes:
+    """按噪声电平（-dBov）生成一帧白噪声"""
+    amplitude = 32767 * 10 ** (-level / 20) * math.sqrt(3)
+    if amplitude < 1:
+        return bytes(samples * SAMPLE_WIDTH)
+    bound = min(32767, int(amplitude))
+    return array("h", [random.randint(-bound, bound) for _ in range(samples)]).tobytes()
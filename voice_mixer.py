@@ -0,0 +1,248 @@
+import asyncio
+import os
+import random
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from voice_codec import CN_INTERVAL, codec_for_payload_type, create_codec
+from voice_proto import CHUNK, RATE, SAMPLE_WIDTH, PT_CN, pack_frame, unpack_frame
+
+# 可选依赖：NumPy 向量化混音，未安装时回退到纯 Python 实现
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FRAME_DURATION = CHUNK / RATE
+FRAME_BYTES = CHUNK * SAMPLE_WIDTH
+# 每个成员最多缓冲的输入帧数，超出时丢弃最旧的帧以限制延迟
+MIX_INPUT_FRAMES = 4
+# 其他节点的成员超过该时间（秒）没有任何帧（含舒适噪声）即视为已离开
+REMOTE_IDLE = 10.0
+# 混音线程池：把混音移出事件循环，混音期间转发与收发不受影响。
+# μ-law 编解码与无 NumPy 的回退路径是纯 Python，受 GIL 限制不会多核并行，
+# 多核机器请用 main.py --workers 把房间分到多个进程
+MIX_WORKERS = min(4, os.cpu_count() or 1)
+
+_executor = ThreadPoolExecutor(max_workers=MIX_WORKERS, thread_name_prefix="voice-mix")
+
+
+def _fit(payload: bytes) -> bytes:
+    """截断或补零到一帧长度"""
+    if len(payload) >= FRAME_BYTES:
+        return payload[:FRAME_BYTES]
+    return payload + bytes(FRAME_BYTES - len(payload))
+
+
+def mix_minus(frames: List[bytes]) -> List[bytes]:
+    """N-1 混音：返回 N+1 路输出，第 i 路为除第 i 个发言者外所有人的混音，
+    最后一路为全部发言者的混音（给没有发言的成员）
+    """
+    if numpy is not None:
+        pcm = numpy.frombuffer(b"".join(frames), dtype=numpy.int16).reshape(len(frames), CHUNK)
+        pcm = pcm.astype(numpy.int32)
+        total = pcm.sum(axis=0)
+        mixes = numpy.vstack((total - pcm, total))
+        return [row.tobytes() for row in numpy.clip(mixes, -32768, 32767).astype(numpy.int16)]
+
+    pcm = [array("h", frame) for frame in frames]
+    total = [sum(samples) for samples in zip(*pcm)]
+    rows = [[t - s for t, s in zip(total, own)] for own in pcm] + [total]
+    return [array("h", [max(-32768, min(32767, v)) for v in row]).tobytes() for row in rows]
+
+
+def _mix_tick(inputs, outputs):
+    """在线程池中执行的一个混音周期：解码各路输入、N-1 混音、按接收者编码
+
+    inputs 为 [(解码器, 负载)]，outputs 为 [(编码器, 输入下标或 None)]，
+    下标为 None 表示该接收者没有发言，收到全部发言者的混音。无状态编码器
+    （pcm16、pcmu）对这路共同的混音只编码一次。
+    """
+    frames = [_fit(decoder.decode(payload)) for decoder, payload in inputs]
+    mixes = mix_minus(frames)
+    shared = {}
+    payloads = []
+    for encoder, index in outputs:
+        if index is not None:
+            payloads.append(encoder.encode(mixes[index]))
+        elif not encoder.stateless:
+            payloads.append(encoder.encode(mixes[-1]))
+        else:
+            if encoder.name not in shared:
+                shared[encoder.name] = encoder.encode(mixes[-1])
+            payloads.append(shared[encoder.name])
+    return payloads
+
+
+class RoomMixer:
+    """语音房间的服务端混音（MCU 模式）
+
+    成员上行的帧先放入各自的输入缓冲，混音任务按帧周期取出每人一帧，
+    在线程池中解码并做 N-1 混音，再按房间编解码器给每个成员编码一路
+    不含自己声音的混音流。下行带宽和客户端解码量与房间人数无关。
+    每个接收者有独立的 RTP 序列号，被跳过的周期不会在接收端表现为丢包。
+    线程池只让混音不阻塞事件循环，同一进程内的混音仍共用一个 GIL。
+    """
+
+    def __init__(self, room: Dict, stats):
+        self.room = room  # websocket -> VoicePeer，与 VoiceChatService 共用
+        self.stats = stats
+        self.ssrc = random.getrandbits(32)
+        self.timestamp = random.getrandbits(32)
+        self.mix_time_avg = 0.0
+        self.ticks_late = 0
+        self._talkspurt = True
+        self._silent_ticks = 0
+        self.codec = "pcm16"
+        self._inputs: Dict[object, deque] = {}
+        # 编解码器可能有状态（Opus），每个成员各用一个实例
+        self._decoders: Dict[object, object] = {}
+        self._encoders: Dict[object, object] = {}
+        self._noise_levels: Dict[object, int] = {}
+        self._seqs: Dict[object, int] = {}
+        self._resumed: set = set()  # 上个周期被跳过、下一帧需带 marker 位的成员
+        self._remote_seen: Dict[tuple, float] = {}  # 其他节点成员 (节点, 发送者) -> 最后收到帧的时间
+        self._task = asyncio.create_task(self._run())
+
+    def push(self, sender, data: bytes):
+        """收到成员的一帧音频（带帧头或旧版客户端的裸 PCM）"""
+        if isinstance(sender, tuple):
+            self._remote_seen[sender] = time.monotonic()
+        frame = unpack_frame(data)
+        if frame is None:
+            codec, payload = "pcm16", data
+        elif frame.payload_type == PT_CN:
+            # 成员静音，不参与混音，只记录其背景噪声电平
+            if frame.payload:
+                self._noise_levels[sender] = frame.payload[0]
+            return
+        else:
+            codec, payload = codec_for_payload_type(frame.payload_type), frame.payload
+            if codec is None:
+                return
+        decoder = self._decoders.get(sender)
+        if decoder is None or decoder.name != codec:
+            try:
+                decoder = self._decoders[sender] = create_codec(codec)
+            except Exception:
+                return
+        queue = self._inputs.get(sender)
+        if queue is None:
+            queue = self._inputs[sender] = deque(maxlen=MIX_INPUT_FRAMES)
+        if len(queue) == queue.maxlen:
+            self.stats.record_drop()
+        queue.append((decoder, payload))
+
+    def set_codec(self, codec: str):
+        """房间编解码器变化时重建所有编码器"""
+        self.codec = codec
+        self._encoders.clear()
+
+    def remove(self, member):
+        self._inputs.pop(member, None)
+        self._decoders.pop(member, None)
+        self._encoders.pop(member, None)
+        self._noise_levels.pop(member, None)
+        self._seqs.pop(member, None)
+        self._resumed.discard(member)
+        self._remote_seen.pop(member, None)
+
+    def prune_remote(self, nodes, now: Optional[float] = None):
+        """总线报告其他节点成员变化时调用：丢弃已不在 nodes 中的节点、
+        以及超过 REMOTE_IDLE 没有帧的远端成员的输入与解码器状态
+        """
+        now = now or time.monotonic()
+        for key, seen in list(self._remote_seen.items()):
+            if key[0] not in nodes or now - seen > REMOTE_IDLE:
+                self.remove(key)
+
+    def _take_frames(self):
+        speakers, inputs = [], []
+        for member, queue in self._inputs.items():
+            if queue:
+                speakers.append(member)
+                inputs.append(queue.popleft())
+        return speakers, inputs
+
+    def _plan_outputs(self, speakers):
+        """确定本周期的接收者及其使用的混音（只有自己在说话的成员不发送）"""
+        index = {member: i for i, member in enumerate(speakers)}
+        recipients, outputs = [], []
+        for websocket, peer in list(self.room.items()):
+            if len(speakers) == 1 and websocket is speakers[0]:
+                self._resumed.add(websocket)
+                continue
+            encoder = self._encoders.get(websocket)
+            if encoder is None:
+                encoder = self._encoders[websocket] = create_codec(self.codec)
+            recipients.append((websocket, peer))
+            outputs.append((encoder, index.get(websocket)))
+        return recipients, outputs
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        deadline = time.perf_counter()
+        while True:
+            deadline += FRAME_DURATION
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < -FRAME_DURATION:
+                # 落后超过一帧（线程池繁忙）时重新对齐，不补发积压的周期
+                self.ticks_late += 1
+                deadline = time.perf_counter()
+
+            speakers, inputs = self._take_frames()
+            recipients, outputs = self._plan_outputs(speakers)
+            if inputs and outputs:
+                started = time.perf_counter()
+                payloads = await loop.run_in_executor(_executor, _mix_tick, inputs, outputs)
+                self.mix_time_avg += (time.perf_counter() - started - self.mix_time_avg) * 0.05
+                self._send(recipients, outputs, payloads)
+            else:
+                # 无人说话时只定期发送舒适噪声电平，下一段语音的首帧带 marker 位
+                if self._silent_ticks % CN_INTERVAL == 0:
+                    self._send_comfort_noise()
+                self._silent_ticks += 1
+                self._talkspurt = True
+            # 时间戳按采样时钟推进，静音期间也不停止
+            self.timestamp = (self.timestamp + CHUNK) & 0xFFFFFFFF
+
+    def _next_seq(self, member) -> int:
+        seq = self._seqs.get(member)
+        if seq is None:
+            seq = random.getrandbits(16)
+        self._seqs[member] = (seq + 1) & 0xFFFF
+        return seq
+
+    def _send(self, recipients, outputs, payloads):
+        for (websocket, peer), (encoder, _), payload in zip(recipients, outputs, payloads):
+            marker = self._talkspurt or websocket in self._resumed
+            self._resumed.discard(websocket)
+            peer.enqueue(pack_frame(encoder.payload_type, self._next_seq(websocket), self.timestamp,
+                                    self.ssrc, payload, marker=marker))
+        self._talkspurt = False
+        self._silent_ticks = 0
+
+    def _send_comfort_noise(self):
+        if not self._noise_levels:
+            return
+        # 取房间中最响的背景噪声（-dBov 数值最小）
+        level = bytes([min(self._noise_levels.values())])
+        for websocket, peer in list(self.room.items()):
+            peer.enqueue(pack_frame(PT_CN, self._next_seq(websocket), self.timestamp, self.ssrc, level))
+
+    def to_dict(self) -> dict:
+        return {
+            "speakers_buffered": sum(1 for queue in self._inputs.values() if queue),
+            "mix_time_avg_ms": round(self.mix_time_avg * 1000, 3),
+            "ticks_late": self.ticks_late,
+            "numpy": numpy is not None,
+        }
+
+    def close(self):
+        self._task.cancel()
+        self._inputs.clear()
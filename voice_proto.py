@@ -0,0 +1,70 @@
+import struct
+from array import array
+from typing import List, NamedTuple, Optional
+
+# 音频参数配置：16kHz 宽带，20ms 一帧（Opus 支持的帧长）
+CHUNK = 320      # 每帧采样点数
+CHANNELS = 1
+RATE = 16000
+SAMPLE_WIDTH = 2  # 16-bit PCM
+
+# RTP 风格的帧头: V=2 | M+PT | 序列号 | 时间戳(采样时钟) | SSRC
+HEADER = struct.Struct("!BBHII")
+RTP_VERSION_BYTE = 0x80
+MARKER_BIT = 0x80
+
+# 负载类型（PCMU/CN 沿用 RTP 静态编号）
+PT_PCMU = 0
+PT_CN = 13      # 舒适噪声，负载为 1 字节噪声电平（-dBov）
+PT_PCM16 = 96
+PT_OPUS = 111
+
+
+class VoiceFrame(NamedTuple):
+    payload_type: int
+    marker: bool
+    seq: int
+    timestamp: int
+    ssrc: int
+    payload: bytes
+
+
+def pack_frame(payload_type: int, seq: int, timestamp: int, ssrc: int,
+               payload: bytes, marker: bool = False) -> bytes:
+    """为音频数据加上帧头"""
+    second = (MARKER_BIT if marker else 0) | (payload_type & 0x7F)
+    return HEADER.pack(RTP_VERSION_BYTE, second, seq & 0xFFFF,
+                       timestamp & 0xFFFFFFFF, ssrc) + payload
+
+
+def unpack_frame(data: bytes) -> Optional[VoiceFrame]:
+    """解析帧头，不是带帧头的数据（如旧版客户端的裸 PCM）时返回 None"""
+    if len(data) < HEADER.size or data[0] != RTP_VERSION_BYTE:
+        return None
+    _, second, seq, timestamp, ssrc = HEADER.unpack_from(data)
+    return VoiceFrame(second & 0x7F, bool(second & MARKER_BIT), seq, timestamp,
+                      ssrc, bytes(data[HEADER.size:]))
+
+
+def seq_diff(a: int, b: int) -> int:
+    """16 位序列号差值 a - b（考虑回绕）"""
+    return ((a - b + 0x8000) & 0xFFFF) - 0x8000
+
+
+def mix_pcm16(frames: List[bytes], samples: int = CHUNK) -> bytes:
+    """将多路 16-bit PCM 相加并限幅"""
+    if not frames:
+        return bytes(samples * SAMPLE_WIDTH)
+    if len(frames) == 1:
+        return frames[0]
+    total = [0] * samples
+    for frame in frames:
+        pcm = array("h", frame)
+        for i in range(min(samples, len(pcm))):
+            total[i] += pcm[i]
+    return array("h", [max(-32768, min(32767, v)) for v in total]).tobytes()
+
+
+def attenuate_pcm16(frame: bytes, gain: float) -> bytes:
+    """按比例衰减 PCM 音量"""
+    return array("h", [int(v * gain) for v in array("h", frame)]).tobytes()
@@ -0,0 +1,260 @@
+import struct
+import time
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
+
+from voice_proto import RATE, seq_diff
+
+# RTCP 包类型（RFC 3550 / RFC 4585），第二个字节落在 192~223 即为 RTCP，
+# 与 RTP 帧头（含 marker 位的负载类型）不会冲突，可在同一端口上区分
+RTCP_SR = 200
+RTCP_RR = 201
+RTCP_APP = 204
+RTCP_RTPFB = 205
+NACK_FMT = 1
+APP_NAME = b"LANC"  # UDP 握手包（APP）的名称
+
+# 每隔多久发送一次发送端报告（秒）
+RTCP_INTERVAL = 1.0
+# 超过该时间没有收到对端任何 UDP 包即认为 UDP 不可用，回退到 WebSocket（秒）
+UDP_TIMEOUT = 5.0
+# 重传缓存的帧数，以及一次最多请求重传的连续丢包数
+HISTORY_SIZE = 128
+MAX_NACK_GAP = 16
+
+_HEADER = struct.Struct("!BBH")
+_SSRC = struct.Struct("!I")
+_SENDER_INFO = struct.Struct("!IIIII")  # NTP 秒, NTP 小数, RTP 时间戳, 包数, 字节数
+_REPORT_BLOCK = struct.Struct("!IIIIII")
+_NACK_FCI = struct.Struct("!HH")
+
+NTP_EPOCH_OFFSET = 2208988800
+
+
+class ReportBlock(NamedTuple):
+    ssrc: int
+    fraction_lost: int      # 上次报告以来的丢包率 * 256
+    cumulative_lost: int
+    highest_seq: int        # 扩展后的最大序列号
+    jitter: int             # 到达间隔抖动（采样时钟单位）
+    lsr: int                # 最近一次收到的 SR 的 NTP 中间 32 位
+    dlsr: int               # 收到该 SR 到发送本报告的延迟（1/65536 秒）
+
+
+class RtcpPacket(NamedTuple):
+    packet_type: int
+    ssrc: int
+    ntp: int = 0                       # SR 的 NTP 中间 32 位
+    blocks: Tuple[ReportBlock, ...] = ()
+    media_ssrc: int = 0                # NACK 针对的媒体流
+    nack: Tuple[int, ...] = ()         # 请求重传的序列号
+    token: bytes = b""                 # 握手令牌
+
+
+def is_rtcp(data: bytes) -> bool:
+    return len(data) >= 8 and data[0] >> 6 == 2 and 192 <= data[1] <= 223
+
+
+def ntp_now() -> Tuple[int, int]:
+    now = time.time() + NTP_EPOCH_OFFSET
+    return int(now) & 0xFFFFFFFF, int((now % 1) * (1 << 32)) & 0xFFFFFFFF
+
+
+def ntp_middle(seconds: int, fraction: int) -> int:
+    return ((seconds & 0xFFFF) << 16) | (fraction >> 16)
+
+
+def round_trip_time(block: ReportBlock) -> Optional[float]:
+    """根据对端报告中的 LSR/DLSR 计算往返时延（秒）"""
+    if not block.lsr:
+        return None
+    rtt = (ntp_middle(*ntp_now()) - block.lsr - block.dlsr) & 0xFFFFFFFF
+    return rtt / 65536 if rtt < 0x80000000 else 0.0
+
+
+def _pack(packet_type: int, count: int, body: bytes) -> bytes:
+    return _HEADER.pack(0x80 | count, packet_type, len(body) // 4) + body
+
+
+def _pack_blocks(blocks) -> bytes:
+    return b"".join(
+        _REPORT_BLOCK.pack(b.ssrc, (min(255, b.fraction_lost) << 24) | (max(0, b.cumulative_lost) & 0xFFFFFF),
+                           b.highest_seq & 0xFFFFFFFF, b.jitter & 0xFFFFFFFF, b.lsr, b.dlsr)
+        for b in blocks[:31]
+    )
+
+
+def pack_sr(ssrc: int, rtp_timestamp: int, packets: int, octets: int,
+            blocks: List[ReportBlock] = ()) -> bytes:
+    seconds, fraction = ntp_now()
+    body = _SSRC.pack(ssrc) + _SENDER_INFO.pack(
+        seconds, fraction, rtp_timestamp & 0xFFFFFFFF, packets & 0xFFFFFFFF, octets & 0xFFFFFFFF
+    ) + _pack_blocks(blocks)
+    return _pack(RTCP_SR, min(len(blocks), 31), body)
+
+
+def pack_rr(ssrc: int, blocks: List[ReportBlock]) -> bytes:
+    return _pack(RTCP_RR, min(len(blocks), 31), _SSRC.pack(ssrc) + _pack_blocks(blocks))
+
+
+def pack_nack(ssrc: int, media_ssrc: int, seqs: List[int]) -> bytes:
+    """通用 NACK（RFC 4585）：每项为起始序列号 + 后续 16 个序列号的位图"""
+    fci = b""
+    first = seqs[0]
+    seqs = sorted(set(seqs), key=lambda s: seq_diff(s, first))
+    while seqs:
+        pid, bitmap = seqs[0], 0
+        rest = []
+        for seq in seqs[1:]:
+            offset = seq_diff(seq, pid)
+            if 1 <= offset <= 16:
+                bitmap |= 1 << (offset - 1)
+            else:
+                rest.append(seq)
+        fci += _NACK_FCI.pack(pid, bitmap)
+        seqs = rest
+    return _pack(RTCP_RTPFB, NACK_FMT, _SSRC.pack(ssrc) + _SSRC.pack(media_ssrc) + fci)
+
+
+def pack_hello(ssrc: int, token: bytes) -> bytes:
+    """UDP 握手包：客户端用 WebSocket 下发的令牌声明自己的 UDP 地址，服务端原样回应"""
+    return _pack(RTCP_APP, 0, _SSRC.pack(ssrc) + APP_NAME + token)
+
+
+def parse_rtcp(data: bytes) -> Optional[RtcpPacket]:
+    if not is_rtcp(data):
+        return None
+    first, packet_type, _ = _HEADER.unpack_from(data)
+    count = first & 0x1F
+    (ssrc,) = _SSRC.unpack_from(data, 4)
+    try:
+        if packet_type in (RTCP_SR, RTCP_RR):
+            offset, ntp = 8, 0
+            if packet_type == RTCP_SR:
+                seconds, fraction, _, _, _ = _SENDER_INFO.unpack_from(data, 8)
+                ntp = ntp_middle(seconds, fraction)
+                offset += _SENDER_INFO.size
+            blocks = []
+            for i in range(count):
+                b_ssrc, lost, highest, jitter, lsr, dlsr = _REPORT_BLOCK.unpack_from(
+                    data, offset + i * _REPORT_BLOCK.size
+                )
+                blocks.append(ReportBlock(b_ssrc, lost >> 24, lost & 0xFFFFFF, highest, jitter, lsr, dlsr))
+            return RtcpPacket(packet_type, ssrc, ntp, tuple(blocks))
+        if packet_type == RTCP_RTPFB and count == NACK_FMT:
+            (media_ssrc,) = _SSRC.unpack_from(data, 8)
+            seqs = []
+            for offset in range(12, len(data) - 3, 4):
+                pid, bitmap = _NACK_FCI.unpack_from(data, offset)
+                seqs.append(pid)
+                seqs.extend((pid + i + 1) & 0xFFFF for i in range(16) if bitmap >> i & 1)
+            return RtcpPacket(packet_type, ssrc, media_ssrc=media_ssrc, nack=tuple(seqs))
+        if packet_type == RTCP_APP and data[8:12] == APP_NAME:
+            return RtcpPacket(packet_type, ssrc, token=bytes(data[12:]))
+    except struct.error:
+        return None
+    return None
+
+
+class ReceiveStats:
+    """单路 RTP 流的接收统计（RFC 3550 附录 A.1/A.3/A.8）：丢包、抖动与 SR 记录"""
+
+    def __init__(self, ssrc: int, rate: int = RATE):
+        self.ssrc = ssrc
+        self.rate = rate
+        self.base_seq: Optional[int] = None
+        self.max_seq = 0
+        self.cycles = 0
+        self.received = 0
+        self.jitter = 0.0
+        self._last_transit: Optional[float] = None
+        self._expected_prior = 0
+        self._received_prior = 0
+        self._last_sr = 0
+        self._last_sr_arrival = 0.0
+
+    @property
+    def extended_max(self) -> int:
+        return self.cycles + self.max_seq
+
+    @property
+    def expected(self) -> int:
+        return 0 if self.base_seq is None else self.extended_max - self.base_seq + 1
+
+    @property
+    def lost(self) -> int:
+        return max(0, self.expected - self.received)
+
+    def update(self, seq: int, timestamp: int, arrival: float) -> List[int]:
+        """记录一个到达的包，返回新出现的缺失序列号（用于 NACK）"""
+        self.received += 1
+        transit = arrival * self.rate - timestamp
+        if self._last_transit is not None:
+            d = abs(transit - self._last_transit)
+            if d < self.rate * 10:  # 忽略时间戳回绕造成的跳变
+                self.jitter += (d - self.jitter) / 16
+        self._last_transit = transit
+
+        if self.base_seq is None:
+            self.base_seq = self.max_seq = seq
+            return []
+        delta = seq_diff(seq, self.max_seq)
+        if delta <= 0:
+            return []  # 乱序或重传的包
+        missing = [(self.max_seq + i) & 0xFFFF for i in range(1, delta)] if delta <= MAX_NACK_GAP else []
+        if seq < self.max_seq:
+            self.cycles += 1 << 16
+        self.max_seq = seq
+        return missing
+
+    def on_sender_report(self, ntp: int, arrival: float):
+        self._last_sr = ntp
+        self._last_sr_arrival = arrival
+
+    def report(self, now: float) -> ReportBlock:
+        expected_interval = self.expected - self._expected_prior
+        received_interval = self.received - self._received_prior
+        self._expected_prior = self.expected
+        self._received_prior = self.received
+        lost_interval = expected_interval - received_interval
+        fraction = (lost_interval << 8) // expected_interval if expected_interval > 0 and lost_interval > 0 else 0
+        dlsr = int((now - self._last_sr_arrival) * 65536) if self._last_sr else 0
+        return ReportBlock(self.ssrc, fraction, self.lost, self.extended_max,
+                           int(self.jitter), self._last_sr, dlsr)
+
+    def to_dict(self) -> dict:
+        return {
+            "received": self.received,
+            "lost": self.lost,
+            "loss_rate": round(self.lost / self.expected, 4) if self.expected else 0.0,
+            "jitter_ms": round(self.jitter / self.rate * 1000, 3),
+        }
+
+
+def block_to_dict(block: ReportBlock, rate: int = RATE) -> dict:
+    """对端报告的接收情况"""
+    return {
+        "fraction_lost": round(block.fraction_lost / 256, 4),
+        "cumulative_lost": block.cumulative_lost,
+        "jitter_ms": round(block.jitter / rate * 1000, 3),
+    }
+
+
+class SendHistory:
+    """最近发送的包，用于响应 NACK 重传"""
+
+    def __init__(self, size: int = HISTORY_SIZE):
+        self.size = size
+        self._packets: "OrderedDict[Tuple[int, int], bytes]" = OrderedDict()
+        self.retransmitted = 0
+
+    def put(self, ssrc: int, seq: int, packet: bytes):
+        self._packets[(ssrc, seq)] = packet
+        if len(self._packets) > self.size:
+            self._packets.popitem(last=False)
+
+    def get(self, ssrc: int, seq: int) -> Optional[bytes]:
+        packet = self._packets.get((ssrc, seq))
+        if packet is not None:
+            self.retransmitted += 1
+        return packet
@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from contextlib import asynccontextmanager
+from typing import Dict
+
+import uvicorn
+from fastapi import APIRouter, FastAPI, Response
+
+from metrics import CONTENT_TYPE, registry
+from profiler import watchdog
+from room_bus import BUS_HOST, RoomBus
+from voice_chat import app as voice_app, voice_service
+
+router = APIRouter()
+pool = None  # 主进程中的 VoiceWorkerPool，单进程模式为 None
+
+# 工作进程退出后重新拉起的间隔（秒）
+RESTART_DELAY = 1.0
+MONITOR_INTERVAL = 0.5
+# 房间还没有成员时，分配结果保留的时间（秒），让同时加入的成员落在同一进程
+PLACEMENT_TTL = 30.0
+# 主进程把总线令牌通过该环境变量传给工作进程（命令行参数对本机所有用户可见）
+BUS_TOKEN_ENV = "LANCHAT_BUS_TOKEN"
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("", 0))
+        return s.getsockname()[1]
+
+
+def create_worker_app(node: int, port: int, supervisor: tuple, server_ref: list, token: str = "") -> FastAPI:
+    """工作进程只提供语音服务（路径与主进程相同，客户端只需换端口）和自己的指标"""
+
+    @asynccontextmanager
+    async def lifespan(app):
+        watchdog.start(asyncio.get_running_loop())
+        bus = RoomBus(node, supervisor, port, token)
+        bus.on_orphaned = lambda: setattr(server_ref[0], "should_exit", True)
+        await bus.start()
+        voice_service.attach_bus(bus)
+        yield
+        bus.close()
+        watchdog.stop()
+
+    worker_app = FastAPI(lifespan=lifespan)
+    worker_app.mount("/voice", voice_app)
+
+    @worker_app.get("/metrics")
+    def metrics():
+        return Response(registry.render(), media_type=CONTENT_TYPE)
+
+    return worker_app
+
+
+def run_worker(node: int, port: int, supervisor: tuple, token: str = ""):
+    """工作进程入口（python voice_workers.py --node ...，只导入语音相关模块）"""
+    server_ref = []
+    app = create_worker_app(node, port, supervisor, server_ref, token)
+    server = uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=port, log_level="warning"))
+    server_ref.append(server)
+    server.run()
+
+
+class VoiceWorkerPool:
+    """语音工作进程池（主进程为节点 0，工作进程为节点 1..N）
+
+    每个工作进程在自己的端口上提供 WebSocket 与 UDP 语音服务，各自一个事件循环，
+    转发、混音与编解码分摊到多个 CPU 核心。房间按亲和性分配：已有成员的房间留在
+    成员最多的进程，新房间放到成员总数最少的进程，同一房间的成员因此集中在一个
+    进程中，互相转发不经过总线。没有按分配结果连接的成员（如旧版客户端直接连主
+    端口）仍能通过总线与房间里的其他人互通。
+    """
+
+    def __init__(self, count: int, service_port: int):
+        self.count = count
+        self.service_port = service_port
+        # 先绑定主进程的总线端口，工作进程启动时即可拿到地址
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind((BUS_HOST, 0))
+        self.bus_addr = self._sock.getsockname()
+        self.bus = RoomBus(0, service_port=service_port)
+        self.ports: Dict[int, int] = {}
+        self._processes: Dict[int, subprocess.Popen] = {}
+        self._placements: Dict[str, tuple] = {}  # 房间 -> (节点号, 分配时间)
+        self._running = False
+        self.restarts = 0
+
+    def start(self):
+        self._running = True
+        for node in range(1, self.count + 1):
+            self.ports[node] = _free_port()
+            self._spawn(node)
+        threading.Thread(target=self._monitor, name="voice-worker-monitor", daemon=True).start()
+        print(f"✅ 已启动 {self.count} 个语音工作进程，端口: {', '.join(map(str, self.ports.values()))}")
+
+    def _spawn(self, node: int):
+        command = [sys.executable, os.path.abspath(__file__), "--node", str(node),
+                   "--port", str(self.ports[node]), "--bus", f"{self.bus_addr[0]}:{self.bus_addr[1]}"]
+        # 每次启动换一个令牌：重启后的进程可以立即接替，旧进程的报文不再被接受
+        token = self.bus.tokens[node] = secrets.token_hex(16)
+        env = {**os.environ, BUS_TOKEN_ENV: token}
+        # 单独的进程组：终端的 Ctrl+C（例如退出语音通话时）不会停掉工作进程，由主进程负责停止
+        if os.name == "nt":
+            process = subprocess.Popen(command, env=env, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+        else:
+            process = subprocess.Popen(command, env=env, start_new_session=True)
+        self._processes[node] = process
+
+    def _monitor(self):
+        while self._running:
+            time.sleep(MONITOR_INTERVAL)
+            for node, process in list(self._processes.items()):
+                if process.poll() is None or not self._running:
+                    continue
+                print(f"⚠️ 语音工作进程 {node} 已退出（退出码 {process.returncode}），正在重启")
+                time.sleep(RESTART_DELAY)
+                if self._running:
+                    self.restarts += 1
+                    self._spawn(node)
+
+    async def attach(self):
+        """在主进程的事件循环上启动总线（主进程的语音服务作为节点 0 参与转发）"""
+        await self.bus.start(sock=self._sock)
+        voice_service.attach_bus(self.bus)
+
+    def place(self, room_id: str) -> dict:
+        """返回房间所在节点及其端口"""
+        members = self.bus.room_members(room_id)
+        ready = [node for node in self.bus.peers if node != 0]
+        now = time.monotonic()
+        if members:
+            node = max(members, key=lambda n: (members[n], n != 0))
+        else:
+            assigned = self._placements.get(room_id)
+            if assigned is not None and assigned[0] in ready and now - assigned[1] < PLACEMENT_TTL:
+                node = assigned[0]
+            elif ready:
+                load = self.bus.node_load()
+                pending = {}
+                for other, (other_node, at) in list(self._placements.items()):
+                    if now - at >= PLACEMENT_TTL:
+                        del self._placements[other]
+                    elif not self.bus.room_members(other):
+                        pending[other_node] = pending.get(other_node, 0) + 1
+                # 负载相同时按房间名哈希选择，避免新房间都挤到编号最小的进程
+                offset = zlib.crc32(room_id.encode("utf-8"))
+                node = min(ready, key=lambda n: (load.get(n, 0) + pending.get(n, 0),
+                                                 (n + offset) % len(ready)))
+            else:
+                node = 0  # 工作进程尚未就绪，由主进程承载
+        self._placements[room_id] = (node, now)
+        return {"node": node, "port": self.bus.ports.get(node) or self.service_port}
+
+    def stats(self) -> dict:
+        load = self.bus.node_load()
+        return {
+            "workers": self.count,
+            "restarts": self.restarts,
+            "nodes": {
+                node: {
+                    "port": self.ports.get(node, self.service_port),
+                    "pid": self._processes[node].pid if node in self._processes else os.getpid(),
+                    "alive": self._processes[node].poll() is None if node in self._processes else True,
+                    "ready": node in self.bus.peers,
+                    "members": load.get(node, 0),
+                }
+                for node in range(self.count + 1)
+            },
+            "bus": self.bus.stats(),
+        }
+
+    def stop(self):
+        self._running = False
+        for process in self._processes.values():
+            if process.poll() is None:
+                process.terminate()
+        for process in self._processes.values():
+            try:
+                process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def start_pool(count: int, service_port: int) -> VoiceWorkerPool:
+    global pool
+    pool = VoiceWorkerPool(count, service_port)
+    pool.start()
+    return pool
+
+
+def stop_pool():
+    if pool is not None:
+        pool.stop()
+
+
+registry.gauge(
+    "lanchat_voice_workers_ready", "已接入总线的语音工作进程数",
+    fn=lambda: len([node for node in pool.bus.peers if node != 0]) if pool is not None else 0
+)
+
+
+@router.get("")
+async def worker_stats():
+    """各语音进程的端口、存活状态与成员数"""
+    if pool is None:
+        return {"workers": 0}
+    return pool.stats()
+
+
+@router.get("/placement/{room_id}")
+async def room_placement(room_id: str):
+    """语音房间应连接的端口（单进程模式下 port 为 null，表示使用当前端口）"""
+    if pool is None:
+        return {"node": 0, "port": None}
+    return pool.place(room_id)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="语音工作进程（由 main.py --workers 启动）")
+    parser.add_argument("--node", type=int, required=True)
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--bus", required=True, help="主进程总线地址 host:port")
+    args = parser.parse_args()
+    host, _, bus_port = args.bus.rpartition(":")
+    run_worker(args.node, args.port, (host, int(bus_port)), os.environ.pop(BUS_TOKEN_ENV, ""))